@@ -3,14 +3,22 @@
 提供两种字符表读入方式：
 1.给定txt文本链接，从txt文本中读取，也可以提供一个链接数组
 2.给定一个字符串，从字符串读取
+字符按首次出现的顺序保存，并维护字符到下标的索引，查询与去重均为O(1)
+从txt读取的结果缓存在同目录的<文件名>.cache.json中，文件未修改时直接载入缓存
 '''
 
+import os
+import json
+
 class Alphabet(object):
 
-    def __init__(self, wordAddress=None, words=None):
+    def __init__(self, wordAddress=None, words=None, cache=True):
 
         self.wordAddress = wordAddress
-        self.str = ""
+        self.cache = cache
+        self.chars = []
+        self.index = {}
+        self._str = ""
 
         if wordAddress != None:
             self.readTextFromAddress(wordAddress)
@@ -18,27 +26,68 @@ class Alphabet(object):
             self.readTextFromWords(words)
 
     def __len__(self):
-        return len(self.str)
+        return len(self.chars)
+
+    def __contains__(self, char):
+        return char in self.index
+
+    @property
+    def str(self):
+        if len(self._str) != len(self.chars):
+            self._str = ''.join(self.chars)
+        return self._str
 
     def getStr(self):
         return self.str
 
+    def find(self, char):
+        '''
+        返回字符的下标，不存在时返回-1，与str.find一致
+        '''
+        return self.index.get(char, -1)
+
+    def addChar(self, char):
+        if char not in self.index:
+            self.index[char] = len(self.chars)
+            self.chars.append(char)
+
     def readTextFromWords(self,words):
         for char in words:
-            if char not in self.str:
-                self.str += char
+            self.addChar(char)
 
     def readTextFromAddress(self, address):
 
         if isinstance(address, list):
-            for add in self.wordAddress:
+            for add in address:
                 self.readTextFromAddress(add)
         elif isinstance(address, str):
-            f = open(address, 'r', encoding='utf-8')
-            for line in f.readlines():
-                line = line.strip()
-                for char in line:
-                    if char in self.str:
-                        continue
-                    else:
-                        self.str += char
+            self.readTextFromWords(self.loadText(address))
+
+    def loadText(self, address):
+        '''
+        读取txt中去重后的字符，文件的大小与修改时间未变化时读取缓存
+        '''
+        stat = os.stat(address)
+        cache_address = address + '.cache.json'
+        if self.cache and os.path.isfile(cache_address):
+            try:
+                with open(cache_address, 'r', encoding='utf-8') as f:
+                    cached = json.load(f)
+                if cached['mtime'] == stat.st_mtime and cached['size'] == stat.st_size:
+                    return cached['chars']
+            except (ValueError, KeyError):
+                pass
+
+        chars = Alphabet()
+        with open(address, 'r', encoding='utf-8') as f:
+            for line in f:
+                chars.readTextFromWords(line.strip())
+
+        if self.cache:
+            try:
+                with open(cache_address, 'w', encoding='utf-8') as f:
+                    json.dump({'mtime': stat.st_mtime, 'size': stat.st_size, 'chars': chars.str}, f, ensure_ascii=False)
+            except OSError:
+                # 字符表所在目录不可写时不使用缓存
+                pass
+        return chars.str
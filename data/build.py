@@ -40,6 +40,7 @@ def get_dataset(cfg, name, data_dir, anno_dir, split, alphabet):
                 /train_lmdb
                     /data.mdb
                     /lock.mdb
+              lmdbMaker以--shards生成的根目录（其下为shard-00000 ...）也可以直接赋值给cfg.ADDRESS.TRAIN(VAL)_DATA_DIR
                     
         custom: cfg.ADDRESS.TRAIN(VAL)_DATA_DIR为图片文件夹地址，cfg.ADDRESS.TRAIN(VAL)_GT_DIR为一个文本文件，记载图片地址与标签的一一映射
         
@@ -58,14 +59,26 @@ def get_dataset(cfg, name, data_dir, anno_dir, split, alphabet):
         '''
 
         if 'lmdb' == name.lower():
+            if LMDB.shardRoots(data_dir):
+                '''lmdbMaker --shards生成的根目录，各分片拼接为一个数据集'''
+                dataset = LMDB.lmdbConcatDataset(root=data_dir,
+                                                 transform=getTransforms(cfg),
+                                                 reverse=cfg.BidirDecoder, alphabet=alphabet.str,
+                                                 workers=cfg.BASE.WORKERS)
+                assert dataset
+                return dataset
             dataset = LMDB.lmdbDataset(root=data_dir,
                                        transform=getTransforms(cfg),
-                                       reverse=cfg.BidirDecoder, alphabet=alphabet.str)
+                                       reverse=cfg.BidirDecoder, alphabet=alphabet.str,
+                                       workers=cfg.BASE.WORKERS)
             assert dataset
             return dataset
 
         elif 'custom' == name.lower():
-            dataset = CUSTOM.CustomDataset(data_dir, anno_dir, transform=getTransforms(cfg))
+            dataset = CUSTOM.CustomDataset(data_dir, anno_dir, transform=getTransforms(cfg),
+                                           cache_dir=cfg.DATASETS.get('IMAGE_CACHE_DIR', ''),
+                                           cache_height=cfg.IMAGE.IMG_H,
+                                           cache_size=cfg.DATASETS.get('IMAGE_CACHE_SIZE', 1024))
 
             assert dataset
             return dataset
@@ -138,6 +151,24 @@ def get_dataloader(cfg, name, dataset, split):
         else:
             shuffle = False
 
+        '''
+        锁页内存：单进程读取时由alignCollate直接分配，多进程读取时由DataLoader负责
+        '''
+        pin_memory = cfg.DATASETS.get('PIN_MEMORY', False) and cfg.BASE.WORKERS > 0
+
+        '''
+        按宽高比分桶的批采样器，与batch_size、shuffle、sampler冲突
+        '''
+        if cfg.DATASETS.SAMPLER == 'BUCKETED':
+            dataloader = torch.utils.data.DataLoader(dataset,
+                                                     batch_sampler=getSampler(cfg, dataset, shuffle=shuffle),
+                                                     num_workers=cfg.BASE.WORKERS,
+                                                     collate_fn=getCollate(cfg, dataset),
+                                                     pin_memory=pin_memory
+                                                     )
+            assert dataloader
+            return dataloader
+
         '''
         torch中sampler和shuffle是冲突的
         '''
@@ -150,7 +181,8 @@ def get_dataloader(cfg, name, dataset, split):
                                                    batch_size=cfg.MODEL.BATCH_SIZE,
                                                    shuffle=shuffle, sampler=sampler,
                                                    num_workers=cfg.BASE.WORKERS,
-                                                 collate_fn=getCollate(cfg,dataset)
+                                                 collate_fn=getCollate(cfg,dataset),
+                                                 pin_memory=pin_memory
                                                  )
         assert dataloader
         return dataloader
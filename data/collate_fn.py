@@ -1,53 +1,99 @@
 import torch
 import random
 import numpy as np
-import torchvision.transforms as transforms
 import cv2
-from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageOps
+from PIL import Image, ImageDraw, ImageFont, ImageFilter
+
+
+def toArray(image):
+    '''
+    将PIL图片或numpy数组转换为HxWxC的uint8数组，无法读取或尺寸为0的图片返回None
+    4通道图片去掉alpha通道，与原先经过cv2.cvtColor的结果一样为3通道
+    '''
+    if image is None:
+        return None
+    try:
+        array = np.asarray(image)
+    except (IOError, OSError, ValueError):
+        return None
+    if array.ndim == 2:
+        array = array[:, :, None]
+    if array.ndim != 3 or array.shape[0] == 0 or array.shape[1] == 0:
+        return None
+    if array.shape[2] == 4:
+        array = array[:, :, :3]
+    if array.dtype != np.uint8:
+        array = array.astype(np.uint8)
+    return array
+
+
+def resizeInto(array, out, imgH):
+    '''
+    按高度imgH等比例放缩一次，直接写入out（CxHxmaxW）的左侧，右侧保持padding
+
+    :param np.ndarray array toArray的结果
+    :param torch.Tensor out 输出张量中该样本的位置
+    :return int 放缩后的宽度
+    '''
+    h, w = array.shape[:2]
+    maxW = out.shape[2]
+    imgW = min(max(int(imgH * (w / h)), 1), maxW)
+    resized = cv2.resize(array, (imgW, imgH))
+    if resized.ndim == 2:
+        resized = resized[:, :, None]
+    # 单通道图片广播到多通道的输出
+    out[:, :, :imgW].copy_(torch.from_numpy(resized).permute(2, 0, 1))
+    return imgW
 
 
 class alignCollate(object):
 
-    def __init__(self, opt, keep_ratio=True, min_ratio=1):
+    def __init__(self, opt, keep_ratio=True, min_ratio=1, pin_memory=False):
         """
         args:
             imgH: can be divided by 32
             maxW: the maximum width of the collection
             keep_ratio:
             min_ratio:
+            pin_memory: allocate the batch in pinned memory, only when collating in the main process
         """
         self.imgH = opt.IMAGE.IMG_H
         self.imgW = opt.IMAGE.IMG_W
         self.keep_ratio = keep_ratio
         self.min_ratio = min_ratio
+        self.pin_memory = pin_memory
 
     # 解耦
     def __call__(self, batch):
-        images, labels = zip(*batch)
+        '''
+        每张图片只放缩一次，写入预先分配的[B, C, H, maxW]张量
+        无法读取的样本被跳过，同时去掉对应的标签
+        '''
+        arrays = [toArray(sample[0]) if sample is not None else None for sample in batch]
+        kept = [i for i, array in enumerate(arrays) if array is not None]
+        if len(kept) < len(batch):
+            print('Skip {} corrupted samples in the batch'.format(len(batch) - len(kept)))
+        arrays = [arrays[i] for i in kept]
+        batch = [batch[i] for i in kept]
 
         imgH = self.imgH
         imgW = self.imgW
-        if self.keep_ratio:
-            ratios = []
-            for image in images:
-                try:
-                    w, h = image.size
-                except:
-                    w, h = image.shape[1], image.shape[0]  # image.size
-                ratios.append(w / float(h))
-            ratios.sort()
-            max_ratio = ratios[-1]
+        if self.keep_ratio and len(arrays) > 0:
+            max_ratio = max(array.shape[1] / float(array.shape[0]) for array in arrays)
             imgW = int(np.floor(max_ratio * imgH))
             imgW = max(self.min_ratio * imgH, imgW)  # assure imgW >= imgH
 
-        '''导入外部变换'''
+        channel = max([array.shape[2] for array in arrays] + [1])
+        # 子进程中分配的锁页内存在传回主进程时会失效，此时由DataLoader的pin_memory负责
+        pin = self.pin_memory and torch.cuda.is_available() and torch.utils.data.get_worker_info() is None
+        images = torch.zeros((len(arrays), channel, imgH, imgW), pin_memory=pin)
+        for image, array in zip(images, arrays):
+            resizeInto(array, image, imgH)
+        # 与ToTensor后sub_(0.5).div_(0.5)相同，padding为-1
+        images.div_(255).sub_(0.5).div_(0.5)
 
-
-        transform = resizeNormalize(imgW, imgH)
-        images = [transform(image) for image in images]
-        images = torch.cat([t.unsqueeze(0) for t in images], 0)
-
-        return images, labels
+        fields = list(zip(*batch)) if len(batch) > 0 else [(), ()]
+        return (images,) + tuple(fields[1:])
 
 class resizeNormalize(object):
 
@@ -55,49 +101,23 @@ class resizeNormalize(object):
         self.imgH = imgH
         self.maxW = maxW
         self.interpolation = interpolation
-        self.toTensor = transforms.ToTensor()
 
     def __call__(self, img):
-        try:
-            ratio = img.shape[1] / img.shape[0]
-        except:
-            ratio = img.size[1] / img.size[0]
-        # print(img.size)
-        imgW = int(self.imgH * ratio)
-        # print("resize weight:", img.shape, imgW, self.imgH)
-        # img = img.resize((imgW, self.imgH), self.interpolation)
-
-        # print("插入调试信息")
-        # print(type(img))
-        # # print(imgW)
-        # print("结束调试信息")
-
-        img = cv2.cvtColor(np.asarray(img), cv2.COLOR_RGB2BGR)
-        try:
-            # img = cv2.imread('/home/cjy/test.jpg')
-            # img = cv2.cvtColor(np.asarray(img), cv2.COLOR_RGB2BGR)
-            img = cv2.resize(img, (imgW, self.imgH))
-        except:
-            print("读取图片发生错误，使用替代图片")
-            img = cv2.imread('/home/cjy/test.jpg')
-            ratio = img.shape[1] / img.shape[0]
-            # print(img.size)
-            imgW = int(self.imgH * ratio)
-            img = cv2.cvtColor(np.asarray(img), cv2.COLOR_RGB2BGR)
-            img = cv2.resize(img, (imgW, self.imgH))
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        img = Image.fromarray(img)
-
-        padding = (0, 0, self.maxW - imgW, 0)
-        img = ImageOps.expand(img, border=padding, fill='black')
-        img = self.toTensor(img)
-        img.sub_(0.5).div_(0.5)
+        '''
+        单张图片的放缩与padding，结果与alignCollate中的每一项相同
+        '''
+        array = toArray(img)
+        if array is None:
+            raise ValueError('Corrupted image')
+        img = torch.zeros((array.shape[2], self.imgH, self.maxW))
+        resizeInto(array, img, self.imgH)
+        img.div_(255).sub_(0.5).div_(0.5)
         return img
 
 def getCollate(opt,dataset):
 
     if opt.DATASETS.COLLATE_FN == 'ALIGN_COLLATE':
-        return alignCollate(opt)
+        return alignCollate(opt, pin_memory=opt.DATASETS.get('PIN_MEMORY', False))
     else:
         from torch.utils.data.dataloader import default_collate
         return default_collate
@@ -2,36 +2,153 @@
 # -*- coding: utf-8 -*-
 
 '''
-Please execute the code with python2
+生成识别用的lmdb数据集（python3）
+
+    python -m data.lmdbMaker --image_root /img --label_file /img_label.txt --output /train_lmdb --workers 8
+
+标签文件每行为"图片路径 标签"，图片路径相对于--image_root，与CUSTOM数据集的标签文件格式相同
+中断后使用相同的参数重新运行即可从上次提交的位置继续
 '''
 
+import io
 import os
+import argparse
+from multiprocessing import Pool
+
 import lmdb
 import cv2
 import numpy as np
+from PIL import Image
 
 
 def checkImageIsValid(imageBin):
+    '''
+    返回图片的(高, 宽)，图片无法解码时返回None
+    '''
     if imageBin is None:
-        return False
+        return None
     try:
-        imageBuf = np.fromstring(imageBin, dtype=np.uint8)
+        imageBuf = np.frombuffer(imageBin, dtype=np.uint8)
         img = cv2.imdecode(imageBuf, cv2.IMREAD_GRAYSCALE)
         imgH, imgW = img.shape[0], img.shape[1]
         if imgH * imgW == 0:
-            return False
-    except:
+            return None
+    except Exception:
         print("Image is invalid!")
-    return True
+        return None
+    return imgH, imgW
+
+
+def readSample(args):
+    '''
+    在进程池中读取并检查一张图片
+
+    :return (图片二进制, 高, 宽)，图片不存在或无法解码时返回None
+    '''
+    imagePath, checkValid = args
+    if not os.path.exists(imagePath):
+        print('%s does not exist' % imagePath)
+        return None
+    with open(imagePath, 'rb') as f:
+        imageBin = f.read()
+    if not checkValid:
+        # 不解码，只从图片头读取尺寸作为元数据
+        try:
+            imgW, imgH = Image.open(io.BytesIO(imageBin)).size
+        except IOError:
+            imgW, imgH = 0, 0
+        return imageBin, imgH, imgW
+    shape = checkImageIsValid(imageBin)
+    if shape is None:
+        print('%s is not a valid image' % imagePath)
+        return None
+    return (imageBin,) + shape
 
 
 def writeCache(env, cache):
     with env.begin(write=True) as txn:
-        for k, v in cache.items():
-            txn.put(k, v)
+        txn.cursor().putmulti(cache.items())
+
+
+def readProgress(env):
+    '''
+    :return (已处理的输入数, 已写入的样本数)，新建的数据集为(0, 0)
+    '''
+    with env.begin(write=False) as txn:
+        consumed = txn.get('input-consumed'.encode())
+        written = txn.get('num-samples'.encode())
+    return (int(consumed) if consumed else 0), (int(written) if written else 0)
+
+
+def writeMeta(env, outputPath):
+    '''
+    将各批次的(宽, 高, 标签长度)合并为outputPath下的sample_meta.npy，第i行对应编号i+1的样本
+    '''
+    chunks = []
+    with env.begin(write=False) as txn:
+        cursor = txn.cursor()
+        prefix = 'meta-'.encode()
+        if cursor.set_range(prefix):
+            for key, value in cursor:
+                if not key.startswith(prefix):
+                    break
+                chunks.append(np.frombuffer(value, dtype=np.int32).reshape(-1, 3))
+    meta = np.concatenate(chunks) if chunks else np.zeros((0, 3), dtype=np.int32)
+    with open(os.path.join(outputPath, 'sample_meta.npy.tmp'), 'wb') as f:
+        np.save(f, meta)
+    os.replace(os.path.join(outputPath, 'sample_meta.npy.tmp'), os.path.join(outputPath, 'sample_meta.npy'))
+
+
+def createShard(pool, outputPath, imagePathList, labelList, lexiconList=None, checkValid=True, commitSize=10000):
+    '''
+    将一组样本写入一个lmdb，从上次提交的位置继续
+
+    每次提交在同一个事务中写入样本、本批次的元数据以及进度，中断后进度与数据保持一致
+    '''
+    nSamples = len(imagePathList)
+    env = lmdb.open(outputPath, map_size=1099511627776)
+    consumed, cnt = readProgress(env)
+    if consumed > 0:
+        print('Resume %s from input %d / %d with %d samples' % (outputPath, consumed, nSamples, cnt))
 
+    tasks = ((imagePath, checkValid) for imagePath in imagePathList[consumed:])
+    if pool is not None:
+        samples = pool.imap(readSample, tasks, chunksize=64)
+    else:
+        samples = map(readSample, tasks)
 
-def createDataset(outputPath, imagePathList, labelList, lexiconList=None, checkValid=True):
+    cache = {}
+    meta = []
+    for i, sample in enumerate(samples, consumed):
+        if sample is not None:
+            imageBin, imgH, imgW = sample
+            cnt += 1
+            cache['image-%09d'.encode() % cnt] = imageBin
+            cache['label-%09d'.encode() % cnt] = labelList[i].encode('utf-8')
+            if lexiconList:
+                cache['lexicon-%09d'.encode() % cnt] = ' '.join(lexiconList[i]).encode('utf-8')
+            meta.append((imgW, imgH, len(labelList[i])))
+
+        if (i + 1) % commitSize == 0 or i + 1 == nSamples:
+            if meta:
+                cache['meta-%09d'.encode() % (cnt - len(meta) + 1)] = np.array(meta, dtype=np.int32).tobytes()
+            cache['num-samples'.encode()] = str(cnt).encode()
+            cache['input-consumed'.encode()] = str(i + 1).encode()
+            writeCache(env, cache)
+            cache = {}
+            meta = []
+            print('Written %d / %d' % (i + 1, nSamples))
+
+    if nSamples == 0:
+        writeCache(env, {'num-samples'.encode(): b'0', 'input-consumed'.encode(): b'0'})
+    writeMeta(env, outputPath)
+    env.close()
+    print('Created dataset %s with %d samples' % (outputPath, cnt))
+    return cnt
+
+
+def createDataset(outputPath, imagePathList, labelList, lexiconList=None, checkValid=True,
+                  workers=0, commitSize=10000, numShards=1):
     """
     Create LMDB dataset for CRNN training.
     ARGS:
@@ -40,49 +157,48 @@ def createDataset(outputPath, imagePathList, labelList, lexiconList=None, checkV
         labelList     : list of corresponding groundtruth texts
         lexiconList   : (optional) list of lexicon lists
         checkValid    : if true, check the validity of every image
+        workers       : number of processes reading and checking images, 0 reads in this process
+        commitSize    : number of input samples per transaction
+        numShards     : split the samples into this many LMDBs, outputPath/shard-00000 ...
     """
 
     assert (len(imagePathList) == len(labelList))
 
     nSamples = len(imagePathList)
-
-    env = lmdb.open(outputPath, map_size=1099511627776)
-    cache = {}
-    cnt = 1
-    for i in range(nSamples):
-        imagePath = imagePathList[i]
-        label = labelList[i]
-
-        if not os.path.exists(imagePath):
-            print('%s does not exist' % imagePath)
-            continue
-
-        import codecs
-        with open(imagePath, 'r') as f:
-            imageBin = f.read()
-        if checkValid:
-            if not checkImageIsValid(imageBin):
-                print('%s is not a valid image' % imagePath)
+    pool = Pool(workers) if workers > 0 else None
+    total = 0
+    try:
+        if numShards <= 1:
+            total = createShard(pool, outputPath, imagePathList, labelList, lexiconList, checkValid, commitSize)
+        else:
+            os.makedirs(outputPath, exist_ok=True)
+            bounds = np.linspace(0, nSamples, numShards + 1).astype(int)
+            for shard in range(numShards):
+                start, stop = bounds[shard], bounds[shard + 1]
+                total += createShard(pool, os.path.join(outputPath, 'shard-%05d' % shard),
+                                     imagePathList[start:stop], labelList[start:stop],
+                                     lexiconList[start:stop] if lexiconList else None, checkValid, commitSize)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print('Created %d samples in total' % total)
+    return total
+
+
+def readLabelFile(imageRoot, labelFile):
+    '''
+    读取"图片路径 标签"格式的标签文件，标签中可以含有空格
+    '''
+    imagePathList, labelList = [], []
+    with open(labelFile, encoding='utf-8') as f:
+        for line in f:
+            items = line.strip().split()
+            if len(items) == 0:
                 continue
-
-        imageKey = 'image-%09d' % cnt
-        labelKey = 'label-%09d' % cnt
-        cache[imageKey] = imageBin
-
-        cache[labelKey] = label
-
-        if lexiconList:
-            lexiconKey = 'lexicon-%09d' % cnt
-            cache[lexiconKey] = ' '.join(lexiconList[i])
-        if cnt % 1000 == 0:
-            writeCache(env, cache)
-            cache = {}
-            print('Written %d / %d' % (cnt, nSamples))
-        cnt += 1
-    nSamples = cnt - 1
-    cache['num-samples'] = str(nSamples)
-    writeCache(env, cache)
-    print('Created dataset with %d samples' % nSamples)
+            imagePathList.append(os.path.join(imageRoot, items[0]))
+            labelList.append(' '.join(items[1:]))
+    return imagePathList, labelList
 
 
 def read_image_label(image_directory, label_address):
@@ -231,16 +347,23 @@ def syn90():
 
 if __name__ == '__main__':
     '''
-    将两个list传进createDataset函数
+    其他来源的数据可以参照上面的函数生成两个list后直接调用createDataset
     list1: 图片路径列表
     list2: 图片标签列表
     其中两个列表在相同位置
     '''
-
-    imgList, labelList = ic15()
-    print(imgList)
-    print(labelList)
+    parser = argparse.ArgumentParser(description='Create an lmdb dataset for recognition')
+    parser.add_argument('--image_root', default='', help='directory the image paths are relative to')
+    parser.add_argument('--label_file', required=True, help='one "image_path label" pair per line')
+    parser.add_argument('--output', required=True, help='the address you want to generate the lmdb file')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='processes reading and checking images')
+    parser.add_argument('--commit_size', type=int, default=10000, help='input samples per transaction')
+    parser.add_argument('--shards', type=int, default=1, help='number of lmdb files to split the samples into')
+    parser.add_argument('--no_check', action='store_true', help='do not decode images to check them')
+    args = parser.parse_args()
+
+    imgList, labelList = readLabelFile(args.image_root, args.label_file)
     print("The length of the list is ", len(imgList))
 
-    '''Input the address you want to generate the lmdb file.'''
-    createDataset('/mnt/sdb1/zifuzu/chenjingye/datasets/syn90_train_500000data_lmdb', imgList, labelList)
+    createDataset(args.output, imgList, labelList, checkValid=not args.no_check,
+                  workers=args.workers, commitSize=args.commit_size, numShards=args.shards)
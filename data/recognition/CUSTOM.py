@@ -9,24 +9,115 @@ import six
 import sys
 
 import os
+import fcntl
+import functools
+import hashlib
 import cv2
 from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageOps
 import numpy as np
 import model.recognition_model.GRCNN.utils.util as util
 import model.recognition_model.GRCNN.utils.keys as keys
 from imgaug import augmenters as iaa
+from data.sampler import loadSampleIndex
 # from autoaugment import ImageNetPolicy, CIFAR10Policy, SVHNPolicy
 
 
+class decodedImageCache(object):
+    '''
+    解码并按高度归一化后的灰度图缓存，保存在内存映射文件中，DataLoader的各个子进程共享同一份缓存
+
+    缓存分为固定大小的槽，样本key放在第key % 槽数个槽中（直接映射），
+    缓存总大小不超过max_bytes，槽被占用时后写入的样本替换原有的样本；
+    每个槽的读写由fcntl对索引文件中对应字节加锁，可以跨进程并发
+    文件在训练结束后保留，下一次训练直接复用已经解码的图片
+    '''
+
+    def __init__(self, path, height, slot_width, max_bytes):
+        '''
+        :param str path 缓存文件的前缀，生成path.pixels与path.table
+        :param int height 归一化后的高度
+        :param int slot_width 每个槽的宽度，更宽的图片不缓存
+        :param int max_bytes 像素文件的大小上限
+        '''
+        self.path = path
+        self.height = height
+        self.slot_width = slot_width
+        self.num_slots = max(1, max_bytes // (height * slot_width))
+        pixel_bytes = self.num_slots * height * slot_width
+        # 索引每一项为(样本编号 + 1, 宽度)，0表示空槽
+        table_bytes = self.num_slots * 2 * 8
+        if not (os.path.isfile(path + '.pixels') and os.path.getsize(path + '.pixels') == pixel_bytes and
+                os.path.isfile(path + '.table') and os.path.getsize(path + '.table') == table_bytes):
+            for suffix, size in (('.pixels', pixel_bytes), ('.table', table_bytes)):
+                with open(path + suffix, 'wb') as f:
+                    f.truncate(size)
+        self.pid = None
+
+    def open(self):
+        '''
+        每个进程第一次访问时各自映射文件，spawn方式启动的子进程同样可用
+        '''
+        if self.pid != os.getpid():
+            self.pixels = np.memmap(self.path + '.pixels', dtype=np.uint8, mode='r+',
+                                    shape=(self.num_slots, self.height, self.slot_width))
+            self.table = np.memmap(self.path + '.table', dtype=np.int64, mode='r+', shape=(self.num_slots, 2))
+            self.lock_file = open(self.path + '.table', 'rb+')
+            self.pid = os.getpid()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('pixels', 'table', 'lock_file'):
+            state.pop(name, None)
+        state['pid'] = None
+        return state
+
+    def lock(self, slot, mode):
+        fcntl.lockf(self.lock_file, mode, 1, slot)
+
+    def get(self, key):
+        '''
+        :return np.ndarray 缓存的灰度图，不在缓存中时返回None
+        '''
+        self.open()
+        slot = key % self.num_slots
+        self.lock(slot, fcntl.LOCK_SH)
+        try:
+            if self.table[slot, 0] != key + 1:
+                return None
+            return np.array(self.pixels[slot, :, :self.table[slot, 1]])
+        finally:
+            self.lock(slot, fcntl.LOCK_UN)
+
+    def put(self, key, img):
+        '''
+        :param np.ndarray img 高度为height的灰度图
+        '''
+        if img.shape[0] != self.height or img.shape[1] > self.slot_width:
+            return
+        self.open()
+        slot = key % self.num_slots
+        self.lock(slot, fcntl.LOCK_EX)
+        try:
+            self.pixels[slot, :, :img.shape[1]] = img
+            self.table[slot] = (key + 1, img.shape[1])
+        finally:
+            self.lock(slot, fcntl.LOCK_UN)
+
+
 class CustomDataset(Dataset):
-    def __init__(self, root, mapping, transform=None, target_transform=None):
+    def __init__(self, root, mapping, transform=None, target_transform=None,
+                 cache_dir=None, cache_height=32, cache_size=1024):
         """Initialization for image Dataset.
         args
         root (string): directory of images
         mapping (string): file of mapping filename and its labels
+        cache_dir (string): directory of the decoded image cache, None reads every image from disk
+        cache_height (int): height of the cached grayscale images
+        cache_size (int): size limit of the cache in MB
 
         """
         self.root = root
+        self.mapping = mapping
         self.transform = transform
         self.target_transform = target_transform
         self.images = list()
@@ -51,38 +142,90 @@ class CustomDataset(Dataset):
             self.images.append(img)
             self.labels.append(keyFilte(label, keys.alphabet))
 
+        # 只读取图片头检查一次尺寸，不再在每个epoch中解码后检查
+        self.dims = self.imageDims()
+        w, h = self.dims[:, 0], self.dims[:, 1]
+        valid = (w > 0) & (h > 0) & (h <= w) & (w <= 30 * h)
+        self.valid = np.flatnonzero(valid)
+        if len(self.valid) < len(self.images):
+            print('Ignore {} images that are unreadable, vertical or longer than 30:1'.format(
+                len(self.images) - len(self.valid)))
+
+        self.cache = None
+        if cache_dir:
+            self.cache = self.buildCache(cache_dir, cache_height, cache_size)
+
+    def imageDims(self):
+        '''
+        每张图片的(宽, 高, 标签长度)，只读取图片头，结果缓存于标签文件旁的<标签文件>.index.npy
+        '''
+        def build():
+            index = []
+            for image, label in zip(self.images, self.labels):
+                try:
+                    with Image.open(os.path.join(self.root, image)) as img:
+                        w, h = img.size
+                except IOError:
+                    w, h = 0, 0
+                index.append((w, h, len(label)))
+            return index
+
+        return loadSampleIndex(self.mapping + '.index.npy', len(self.images), build)
+
+    def buildCache(self, cache_dir, height, size):
+        '''
+        槽宽取99%的样本归一化后不超过的宽度，缓存文件名由标签文件及缓存参数决定
+        '''
+        w, h = self.dims[self.valid, 0], self.dims[self.valid, 1]
+        widths = np.maximum(np.round(height * w / np.maximum(h, 1)), 1)
+        slot_width = int(max(np.percentile(widths, 99), height)) if len(widths) > 0 else height
+        os.makedirs(cache_dir, exist_ok=True)
+        mapping = os.path.realpath(self.mapping)
+        digest = hashlib.md5('{} {} {} {} {}'.format(mapping, os.path.getmtime(mapping), os.path.realpath(self.root),
+                                                     height, slot_width).encode('utf-8')).hexdigest()[:8]
+        return decodedImageCache(os.path.join(cache_dir, 'custom_%s' % digest), height, slot_width, size << 20)
+
     def __len__(self):
-        return len(self.images)
+        return len(self.valid)
+
+    def sampleIndex(self):
+        '''
+        每个样本的(宽, 高, 标签长度)
+        '''
+        return self.dims[self.valid]
+
+    def loadImage(self, index):
+        '''
+        读取第index张图片，无法解码时返回None
+        使用缓存时返回高度归一化后的灰度图，转换为3通道以与cv2.imread的结果一致
+        '''
+        path = os.path.join(self.root, self.images[index])
+        if self.cache is None:
+            return cv2.imread(path)
+
+        img = self.cache.get(index)
+        if img is None:
+            img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+            if img is None or img.shape[0] <= 0 or img.shape[1] <= 0:
+                return None
+            height = self.cache.height
+            img = cv2.resize(img, (max(int(round(height * img.shape[1] / img.shape[0])), 1), height))
+            self.cache.put(index, img)
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
 
     def __getitem__(self, index):
-        img = None
-        data_size = len(self.images)
-        while (True):
-            index = index % data_size
-            # oper = iaa.Emboss(alpha=(0,1.0), strength=(0,2.0))
-            # oper = iaa.Sharpen(alpha=(0,1.0), lightness=1.0)
-            img = cv2.imread(os.path.join(self.root, self.images[index]))
-            # img = oper.augment_image(img)
-            if img is None:
-                index += 1
-            elif img.shape[0] <= 0 or img.shape[1] <= 0 or img.shape[0] > img.shape[1]:
-                index += 1
-            elif img.shape[1] / float(img.shape[0]) > 30:
-                print(self.images[index] + ' ---> rua...', img.shape)
-                index += 1
-            else:
-                # img = Image.open(os.path.join(self.root, self.images[index]))#.convert('L')
-                # img = iaa.CoarseDropout(p=0.2, size_percent=0.02).augment_image(img)
-                # img = Image.open(os.path.join(self.root, self.images[index]))
-                # policy = SVHNPolicy()
-                # policy = ImageNetPolicy()
-                # img = policy(img)
-                # img = np.array(img)
+        # 图片头正常但无法解码时依次尝试后面的有效样本
+        for offset in range(len(self)):
+            sample = int(self.valid[(index + offset) % len(self)])
+            img = self.loadImage(sample)
+            if img is not None:
                 break
+        else:
+            raise IOError('No readable image in %s' % self.root)
 
         if self.transform is not None:
             img = self.transform(img)
-        return (img, self.labels[index])
+        return (img, self.labels[sample])
 
 
 class testDataset(Dataset):
@@ -163,23 +306,97 @@ class testDataset(Dataset):
         return (img, self.labels[index])
 
 
+# (字体文件, 字号) -> ImageFont / glyphAtlas，每个进程各自缓存
+_fonts = {}
+_atlases = {}
+
+
+def loadFont(font_path, size):
+    key = (font_path, size)
+    if key not in _fonts:
+        _fonts[key] = ImageFont.truetype(font_path, size)
+    return _fonts[key]
+
+
+class glyphAtlas(object):
+    '''
+    某个字体与字号下每个字符的覆盖率图（0~255），字符第一次使用时光栅化后缓存
+
+    覆盖率图的高度为size + 4，字符绘制在y=1处，与逐字draw.text时的位置相同
+    '''
+
+    def __init__(self, font_path, size):
+        self.font = loadFont(font_path, size)
+        self.size = size
+        self.height = size + 4
+        self.glyphs = {}
+
+    def glyph(self, char):
+        '''
+        :return (覆盖率图, 相对于绘制位置的横向偏移)
+        '''
+        if char not in self.glyphs:
+            left, _, right, _ = self.font.getbbox(char)
+            # 左侧超出绘制位置的部分（负的左侧留白）也要保留
+            pad = max(0, -left)
+            canvas = Image.new('L', (max(pad + right, 1), self.height), color=0)
+            ImageDraw.Draw(canvas).text((pad, 1), char, 255, font=self.font)
+            self.glyphs[char] = (np.asarray(canvas), -pad)
+        return self.glyphs[char]
+
+    def coverage(self, text, step, width, offset=1):
+        '''
+        将text中的字符按step的间距拼接为宽width的覆盖率图，重叠处取最大值
+        '''
+        cover = np.zeros((self.height, width), dtype=np.uint8)
+        for char in text:
+            mask, shift = self.glyph(char)
+            x0 = offset + shift
+            x1 = min(x0 + mask.shape[1], width)
+            if x1 > max(x0, 0):
+                part = mask[:, max(-x0, 0):x1 - x0]
+                np.maximum(cover[:, max(x0, 0):x1], part, out=cover[:, max(x0, 0):x1])
+            offset += step
+        return cover
+
+
+@functools.lru_cache(maxsize=None)
+def boxKernel(a, b):
+    '''
+    长度为a与b的两个方框滤波核的卷积
+    '''
+    return np.convolve(np.ones(a) / a, np.ones(b) / b)
+
+
+def getGlyphAtlas(font_path, size):
+    key = (font_path, size)
+    if key not in _atlases:
+        _atlases[key] = glyphAtlas(font_path, size)
+    return _atlases[key]
+
+
 class synthDataset(Dataset):
-    def __init__(self, fontpath, fontsize_range='32-36', text_generator=None, transform=None, target_transform=None):
+    def __init__(self, fontpath, fontsize_range='32-36', text_generator=None, transform=None, target_transform=None,
+                 atlas=True):
         '''Initialization of synthDataset
         args
             fonts (string): font file path
             fontsize_range (int): font sizes
             text_generator: class of text generator
+            atlas (bool): composite the text from cached glyphs and apply the augmentations
+                in fused passes, False draws every character with PIL as before
         '''
         self.fontsize_range = fontsize_range.strip().split('-')
         font_list = os.listdir(fontpath)
         self.fonts = [os.path.join(fontpath, font) for font in font_list]
         self.alphabet = keys.alphabet
+        self.alphabet_set = frozenset(self.alphabet)
         self.text_generator = text_generator
         self.gen_len = self.text_generator.__len__()
         self.len_thr = self.text_generator.__len_thr__()
         self.transform = transform
         self.target_transform = target_transform
+        self.atlas = atlas
 
     def __len__(self):
         if self.gen_len < 128000:
@@ -188,21 +405,16 @@ class synthDataset(Dataset):
             length = self.gen_len
         return length
 
-    def __getitem__(self, index):
-        cur = index % self.gen_len
-        text = self.text_generator.__getitem__(cur)
-        text = keyFilte(text, self.alphabet)
-
-        # Random foreground and background gray.
-        # Notice: background is close to 0, and text is close to 255.
-        bg_gray = util.random_scale(0, 10)
-        tx_gray = util.random_scale(bg_gray + 100, 255)
-        interval = random.randint(0, 5)
+    def replaceUnknown(self, text):
+        # If not in keys, randomly replace
+        return ''.join(char if char in self.alphabet_set else
+                       self.alphabet[random.randint(0, len(self.alphabet) - 1)] for char in text)
 
-        # Add multiple fonts
-        font_choice = random.choice(self.fonts)
-        fontsize_choice = random.randint(int(self.fontsize_range[0]), int(self.fontsize_range[1]))
-        font = ImageFont.truetype(font_choice, fontsize_choice)
+    def renderPIL(self, text, bg_gray, tx_gray, interval, font_choice, fontsize_choice):
+        '''
+        逐字绘制后依次旋转、模糊、运动模糊、错切、缩小再放大
+        '''
+        font = loadFont(font_choice, fontsize_choice)
 
         # Text width
         a_r = len(text)
@@ -211,11 +423,7 @@ class synthDataset(Dataset):
         bg = Image.new('L', (imgW, imgH), color=bg_gray)
         offset = 1
         draw = ImageDraw.Draw(bg)
-        for i in range(len(text)):
-            # If not in keys, randomly replace
-            o_char = text[i]
-            if self.alphabet.find(o_char) == -1:
-                o_char = self.alphabet[random.randint(0, len(self.alphabet) - 1)]
+        for o_char in text:
             draw.text((offset, 1), o_char, tx_gray, font=font)
             offset += fontsize_choice + interval
 
@@ -231,6 +439,67 @@ class synthDataset(Dataset):
         scale = random.randint(1, 4)
         nptxt = cv2.resize(nptxt, (0, 0), fx=1.0 / scale, fy=1.0 / scale, interpolation=cv2.INTER_LINEAR)
         nptxt = cv2.resize(nptxt, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_LINEAR)
+        return nptxt
+
+    def renderAtlas(self, text, bg_gray, tx_gray, interval, font_choice, fontsize_choice):
+        '''
+        由缓存的字形拼接文字，随机参数的分布与renderPIL相同，增强合并为三次整图运算：
+        1.模糊与运动模糊两个方框滤波合并为一次可分离滤波
+        2.旋转、错切与缩小合并为一次仿射变换
+        3.放大回原尺寸
+        '''
+        atlas = getGlyphAtlas(font_choice, fontsize_choice)
+
+        # Text width
+        a_r = len(text)
+        imgH = atlas.height
+        imgW = 2 + imgH * a_r + interval * (a_r - 1)
+        cover = atlas.coverage(text, fontsize_choice + interval, imgW)
+        nptxt = cv2.convertScaleAbs(cover, alpha=(tx_gray - bg_gray) / 255.0, beta=bg_gray)
+
+        # 两个方框滤波的卷积，运动模糊的锚点相当于平移
+        blur = util.random_scale(2, 3)
+        motion_x, motion_y = util.random_scale(2, 2), util.random_scale(2, 2)
+        anchor_x, anchor_y = util.random_scale(0, motion_x - 1), util.random_scale(0, motion_y - 1)
+        nptxt = cv2.sepFilter2D(nptxt, -1, boxKernel(blur, motion_x), boxKernel(blur, motion_y),
+                                anchor=(blur // 2 + anchor_x, blur // 2 + anchor_y), borderType=cv2.BORDER_REFLECT_101)
+
+        # 旋转（扩展画布）、错切、缩小
+        rotate_angle = random.gauss(0, 0.05)
+        theta = random.randint(0, 10) * np.pi / 180
+        scale = random.randint(1, 4)
+        rotate = cv2.getRotationMatrix2D((imgW / 2.0, imgH / 2.0), rotate_angle, 1.0)
+        cos, sin = abs(rotate[0, 0]), abs(rotate[0, 1])
+        outW = int(np.ceil(imgW * cos + imgH * sin))
+        outH = int(np.ceil(imgH * cos + imgW * sin))
+        rotate[:, 2] += ((outW - imgW) / 2.0, (outH - imgH) / 2.0)
+        # 错切矩阵[[1, tan, 0], [0, 1, 0]]左乘旋转矩阵，再整体缩小
+        matrix = rotate
+        matrix[0] += np.tan(theta) * matrix[1]
+        matrix /= scale
+        small = (max(int(round(outW / float(scale))), 1), max(int(round(outH / float(scale))), 1))
+        nptxt = cv2.warpAffine(nptxt, matrix, small, flags=cv2.INTER_LINEAR)
+        if scale > 1:
+            nptxt = cv2.resize(nptxt, (outW, outH), interpolation=cv2.INTER_LINEAR)
+        return nptxt
+
+    def __getitem__(self, index):
+        cur = index % self.gen_len
+        text = self.text_generator.__getitem__(cur)
+        text = keyFilte(text, self.alphabet)
+
+        # Random foreground and background gray.
+        # Notice: background is close to 0, and text is close to 255.
+        bg_gray = util.random_scale(0, 10)
+        tx_gray = util.random_scale(bg_gray + 100, 255)
+        interval = random.randint(0, 5)
+
+        # Add multiple fonts
+        font_choice = random.choice(self.fonts)
+        fontsize_choice = random.randint(int(self.fontsize_range[0]), int(self.fontsize_range[1]))
+
+        render = self.renderAtlas if self.atlas else self.renderPIL
+        nptxt = render(self.replaceUnknown(text), bg_gray, tx_gray, interval, font_choice, fontsize_choice)
         img = Image.fromarray(nptxt)
 
         if self.transform is not None:
@@ -1,91 +1,322 @@
+import io
+import os
+import hashlib
 import random
 import torch
 from torch.utils.data import Dataset
+from torch.utils.data import ConcatDataset
 from torch.utils.data import sampler
 import torchvision.transforms as transforms
 import lmdb
-import six
 import sys
+import numpy as np
+from multiprocessing import Pool
 from PIL import Image
 
+# root -> (打开环境的进程号, lmdb环境)
+_envs = {}
+
+# 索引文件中每个有效样本的记录，标签的utf-8编码按顺序拼接保存在.labels文件中
+INDEX_DTYPE = np.dtype([('key', '<i8'), ('width', '<i4'), ('height', '<i4'), ('label_len', '<i4'),
+                        ('label_offset', '<i8'), ('label_bytes', '<i4')])
+
+
+def openEnv(root, max_readers=126):
+    '''
+    返回当前进程中root对应的lmdb环境，不存在时打开
+    lmdb环境不能跨进程共享，每个DataLoader子进程在第一次读取时各自打开；
+    同一进程中root相同的数据集（例如训练集与验证集相同）共用一个环境
+    '''
+    key = os.path.realpath(root)
+    pid, env = _envs.get(key, (None, None))
+    if env is not None and pid != os.getpid():
+        # fork时继承的父进程环境，同一路径在一个进程中只能打开一次
+        env.close()
+        env = None
+    if env is None:
+        env = lmdb.open(
+            root,
+            max_readers=max_readers,
+            readonly=True,
+            lock=False,
+            readahead=False,
+            meminit=False)
+        if not env:
+            print('cannot creat lmdb from %s' % (root))
+            sys.exit(0)
+        _envs[key] = (os.getpid(), env)
+    return env
+
+
+def filterLabel(label, alphabet_set):
+    return ''.join(char for char in label if char.lower() in alphabet_set)
+
+
+def indexChunk(args):
+    '''
+    为编号在[start, stop)内的样本建立索引，跳过过滤后标签为空以及图片头无法解析的样本
+    sizes为这些样本的(宽, 高)时不再读取图片头，见loadSampleMeta
+
+    :return list 每一项为(编号, 宽, 高, 过滤后的标签)
+    '''
+    root, alphabet_set, start, stop, sizes = args
+    records = []
+    with openEnv(root).begin(write=False, buffers=True) as txn:
+        for i in range(start, stop):
+            label = txn.get(('label-%09d' % i).encode())
+            if label is None:
+                continue
+            label = filterLabel(bytes(label).decode('utf-8'), alphabet_set)
+            if len(label) <= 0:
+                continue
+            if sizes is not None:
+                # lmdbMaker无法解析图片头时记录的宽高为0
+                w, h = int(sizes[i - start, 0]), int(sizes[i - start, 1])
+                if w <= 0 or h <= 0:
+                    print('Corrupted image for %d' % i)
+                    continue
+                records.append((i, w, h, label))
+                continue
+            imgbuf = txn.get(('image-%09d' % i).encode())
+            try:
+                # 只解析图片头，不解码像素
+                w, h = Image.open(io.BytesIO(imgbuf)).size
+            except (IOError, TypeError):
+                print('Corrupted image for %d' % i)
+                continue
+            if w <= 0 or h <= 0:
+                continue
+            records.append((i, w, h, label))
+    return records
+
+
+def loadSampleMeta(root, nSamples):
+    '''
+    读取lmdbMaker保存在data.mdb旁的sample_meta.npy，第i行为编号i+1的样本的(宽, 高, 标签长度)
+    文件不存在或行数与样本数不一致（例如旧版本生成或中断后未完成的数据集）时返回None
+    '''
+    path = os.path.join(root, 'sample_meta.npy')
+    if not os.path.isfile(path):
+        return None
+    meta = np.load(path, mmap_mode='r')
+    if meta.ndim != 2 or len(meta) != nSamples:
+        return None
+    return meta
+
+
+def shardRoots(root):
+    '''
+    lmdbMaker以--shards生成的数据集根目录下为shard-00000 ...，返回按编号排序的各分片路径
+    root本身是一个lmdb时返回空列表
+    '''
+    if os.path.isfile(os.path.join(root, 'data.mdb')) or not os.path.isdir(root):
+        return []
+    return [os.path.join(root, name) for name in sorted(os.listdir(root))
+            if name.startswith('shard-') and os.path.isfile(os.path.join(root, name, 'data.mdb'))]
+
+
 class lmdbDataset(Dataset):
     '''
     Dataset是torch的数据集基类，lmdbDataset继承该类，通过读取lmdb文件夹，获得图片-标签对
     '''
 
-    def __init__(self, root=None, transform=None, reverse=False, alphabet=None):
+    def __init__(self, root=None, transform=None, reverse=False, alphabet=None, max_readers=126, workers=0):
         '''
         :param str root LMDB文件的路径
         :param torchvision.transforms transform 对数据集需要做何种变换
         :param bool reverse 是否需要使用双向LSTM,构造逆标签
         :param str alphabet 字符表
+        :param int max_readers 同时读取的进程/线程数上限，需要不小于DataLoader的num_workers
+        :param int workers 第一次建立索引时使用的进程数，0表示在当前进程中建立
         '''
 
         assert alphabet != None
 
-        self.env = lmdb.open(
-            root,
-            max_readers=1,
-            readonly=True,
-            lock=False,
-            readahead=False,
-            meminit=False)
-
-        if not self.env:
-            print('cannot creat lmdb from %s' % (root))
-            sys.exit(0)
-
-        with self.env.begin(write=False) as txn:
-            nSamples = int(txn.get('num-samples'.encode()))
-            self.nSamples = nSamples
-
+        self.root = root
         self.transform = transform
         self.alphabet = alphabet
+        # 过滤标签时按字符查询，集合的查询为O(1)
+        self.alphabet_set = frozenset(alphabet)
         self.reverse = reverse
+        self.max_readers = max_readers
+        self.workers = workers
 
-    def __len__(self):
-        return self.nSamples
+        with self.openEnv().begin(write=False) as txn:
+            self.nSamples = int(txn.get('num-samples'.encode()))
+        self.loadIndex()
 
-    def __getitem__(self, index):
-        # print("在tools.dataset里,",index)
-        if index > len(self):
-            index = len(self) - 1
-        assert index <= len(self), 'index range error 报错index为 %d' % index
-        index += 1
-        with self.env.begin(write=False) as txn:
-            img_key = 'image-%09d' % index
-            imgbuf = txn.get(img_key.encode())
-
-            buf = six.BytesIO()
-            buf.write(imgbuf)
-            buf.seek(0)
+    def openEnv(self):
+        return openEnv(self.root, self.max_readers)
+
+    def indexPath(self):
+        '''
+        索引文件与data.mdb放在同一目录下，过滤后的标签与字符表有关，文件名中带有字符表的摘要
+        '''
+        digest = hashlib.md5(''.join(sorted(self.alphabet_set)).encode('utf-8')).hexdigest()[:8]
+        prefix = os.path.join(self.root, 'valid_index_%s' % digest)
+        return prefix + '.npy', prefix + '.labels'
+
+    def loadIndex(self):
+        '''
+        读取索引文件，不存在或比data.mdb旧时重新建立
+        索引以内存映射的方式读取，DataLoader的子进程共享同一份物理内存
+        '''
+        index_path, labels_path = self.indexPath()
+        data_path = os.path.join(self.root, 'data.mdb')
+        fresh = os.path.isfile(index_path) and os.path.isfile(labels_path) and \
+            os.path.getmtime(index_path) >= os.path.getmtime(data_path)
+        if fresh:
+            self.index = np.load(index_path, mmap_mode='r')
+            self.labels = np.memmap(labels_path, dtype=np.uint8, mode='r') \
+                if os.path.getsize(labels_path) > 0 else np.zeros(0, dtype=np.uint8)
+        else:
+            self.index, self.labels = self.buildIndex()
+            try:
+                self.saveIndex(index_path, labels_path)
+            except OSError:
+                # 数据集目录不可写时只在内存中使用
+                pass
+
+    def buildIndex(self):
+        '''
+        遍历所有样本建立索引，workers大于0时按编号分块并行
+        '''
+        step = 10000
+        meta = loadSampleMeta(self.root, self.nSamples)
+        chunks = [(self.root, self.alphabet_set, start, min(start + step, self.nSamples + 1),
+                   None if meta is None else np.array(meta[start - 1:start - 1 + step, :2]))
+                  for start in range(1, self.nSamples + 1, step)]
+        if self.workers > 0 and len(chunks) > 1:
+            pool = Pool(self.workers)
             try:
-                img = Image.open(buf).convert('L')
-            except IOError:
-                print('Corrupted image for %d' % index)
-                return self[index + 1]
+                results = pool.map(indexChunk, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [indexChunk(chunk) for chunk in chunks]
 
-            label_key = 'label-%09d' % index
-            label = str(txn.get(label_key.encode()).decode('utf-8'))
+        records = [record for result in results for record in result]
+        encoded = [record[3].encode('utf-8') for record in records]
+        index = np.zeros(len(records), dtype=INDEX_DTYPE)
+        index['key'] = [record[0] for record in records]
+        index['width'] = [record[1] for record in records]
+        index['height'] = [record[2] for record in records]
+        index['label_len'] = [len(record[3]) for record in records]
+        index['label_bytes'] = [len(label) for label in encoded]
+        if len(records) > 0:
+            index['label_offset'][1:] = np.cumsum(index['label_bytes'])[:-1]
+        return index, np.frombuffer(b''.join(encoded), dtype=np.uint8)
 
-            label = ''.join(label[i] if label[i].lower() in self.alphabet else ''
-                            for i in range(len(label)))
-            # print("在tools.dataset里,label为",label)
-            if len(label) <= 0:
-                return self[index + 1]
-            if self.reverse:
-                label_rev = label[-1::-1]
-                label_rev += '$'
-            label += '$'
+    def saveIndex(self, index_path, labels_path):
+        # 先写入临时文件再替换，中断时不会留下不完整的索引；.npy最后写入
+        with open(labels_path + '.tmp', 'wb') as f:
+            f.write(self.labels.tobytes())
+        os.replace(labels_path + '.tmp', labels_path)
+        with open(index_path + '.tmp', 'wb') as f:
+            np.save(f, self.index)
+        os.replace(index_path + '.tmp', index_path)
+
+    def __getstate__(self):
+        # spawn方式启动子进程时不复制索引，在子进程中重新内存映射
+        state = self.__dict__.copy()
+        del state['index'], state['labels']
+        return state
 
-            if self.transform is not None:
-                img = self.transform(img)
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.loadIndex()
+
+    def __len__(self):
+        return len(self.index)
+
+    def label(self, index):
+        '''
+        第index个有效样本过滤后的标签
+        '''
+        record = self.index[index]
+        start = int(record['label_offset'])
+        return self.labels[start:start + int(record['label_bytes'])].tobytes().decode('utf-8')
+
+    def sampleIndex(self):
+        '''
+        每个样本的(宽, 高, 标签长度)，取自索引文件
+        '''
+        return np.stack([self.index['width'], self.index['height'], self.index['label_len']], axis=1).astype(np.int64)
+
+    def readSample(self, txn, index):
+        '''
+        在事务txn中读取第index个有效样本，图片损坏时返回None
+
+        buffers=True时txn.get返回指向lmdb内存映射的memoryview，只在事务内有效，
+        所以图片在事务内完成解码
+        '''
+        key = int(self.index[index]['key'])
+        imgbuf = txn.get(('image-%09d' % key).encode())
+        try:
+            img = Image.open(io.BytesIO(imgbuf)).convert('L')
+        except IOError:
+            print('Corrupted image for %d' % key)
+            return None
+
+        label = self.label(index)
+        if self.reverse:
+            label_rev = label[-1::-1]
+            label_rev += '$'
+        label += '$'
+
+        if self.transform is not None:
+            img = self.transform(img)
 
         if self.reverse:
             return (img, label, label_rev)
         else:
             return (img, label)
 
+    def readValid(self, txn, index):
+        '''
+        读取第index个有效样本，图片头正常但无法解码时依次尝试后面的样本
+        '''
+        assert 0 <= index < len(self), 'index range error 报错index为 %d' % index
+        for offset in range(len(self)):
+            sample = self.readSample(txn, (index + offset) % len(self))
+            if sample is not None:
+                return sample
+        raise IOError('No readable image in %s' % self.root)
+
+    def __getitem__(self, index):
+        with self.openEnv().begin(write=False, buffers=True) as txn:
+            return self.readValid(txn, index)
+
+    def __getitems__(self, indices):
+        '''
+        DataLoader按批取样时调用，一个批的样本在同一个事务中读取
+        '''
+        with self.openEnv().begin(write=False, buffers=True) as txn:
+            return [self.readValid(txn, index) for index in indices]
+
+
+class lmdbConcatDataset(ConcatDataset):
+    '''
+    由lmdbMaker --shards生成的多个分片组成的数据集，每个分片是一个lmdbDataset
+    '''
+
+    def __init__(self, root=None, **kwargs):
+        '''
+        :param str root 分片所在的根目录，其下为shard-00000 ...
+        其余参数与lmdbDataset相同
+        '''
+        roots = shardRoots(root)
+        assert roots, 'No lmdb shard in %s' % root
+        self.root = root
+        super(lmdbConcatDataset, self).__init__([lmdbDataset(root=shard, **kwargs) for shard in roots])
+
+    def sampleIndex(self):
+        '''
+        各分片的(宽, 高, 标签长度)按分片顺序拼接
+        '''
+        return np.concatenate([dataset.sampleIndex() for dataset in self.datasets])
+
 class resizeNormalize(object):
     '''
     将图片进行放缩，并标准化
@@ -1,6 +1,8 @@
 from torch.utils.data import sampler
+import os
 import torch
 import random
+import numpy as np
 
 # sampler=LMDB.randomSequentialSampler(dataset, cfg.MODEL.BATCH_SIZE)
 
@@ -47,7 +49,73 @@ class randomSequentialSampler(sampler.Sampler):
 
         return iter(index)
 
-def getSampler(opt,dataset):
+class bucketedBatchSampler(sampler.Sampler):
+    '''
+    按宽高比分桶的批采样
+    样本按(宽高比, 标签长度)排序后每bucket_batches个批划为一个桶，桶内打乱后切成批，再打乱所有批的顺序
+    同一批内样本的宽度接近，alignCollate按最宽样本放缩时的padding更少
+    '''
+    def __init__(self, sample_index, batch_size, bucket_batches=8, shuffle=True, drop_last=False):
+        '''
+
+        :param numpy.ndarray sample_index 每个样本的(宽, 高, 标签长度)，见dataset.sampleIndex()
+        :param int batch_size 批大小
+        :param int bucket_batches 每个桶包含的批数，越大批的组成越随机，宽度越不均匀
+        :param bool shuffle 是否在桶内与桶间打乱
+        :param bool drop_last 是否丢弃不足batch_size的批
+        '''
+        sample_index = np.asarray(sample_index, dtype=np.float64)
+        ratios = sample_index[:, 0] / np.maximum(sample_index[:, 1], 1)
+        self.order = np.lexsort((sample_index[:, 2], ratios))
+        self.batch_size = batch_size
+        self.bucket_size = batch_size * bucket_batches
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.order) // self.batch_size
+        return (len(self.order) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        '''
+        :return iter 返回批的迭代器，每个批是样本下标的列表
+        '''
+        batches = []
+        for start in range(0, len(self.order), self.bucket_size):
+            bucket = self.order[start:start + self.bucket_size].copy()
+            if self.shuffle:
+                np.random.shuffle(bucket)
+            batches.extend(bucket[i:i + self.batch_size].tolist() for i in range(0, len(bucket), self.batch_size))
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        if self.shuffle:
+            random.shuffle(batches)
+        return iter(batches)
+
+
+def loadSampleIndex(path, num_samples, build):
+    '''
+    读取缓存的样本索引，不存在或样本数不一致时调用build重新生成并保存
+
+    :param str path 索引文件路径（.npy）
+    :param int num_samples 数据集样本数
+    :param build 生成索引的函数，返回(num_samples, 3)的(宽, 高, 标签长度)
+    '''
+    if os.path.isfile(path):
+        index = np.load(path)
+        if len(index) == num_samples:
+            return index
+    index = np.asarray(build(), dtype=np.int64).reshape(-1, 3)
+    try:
+        np.save(path, index)
+    except OSError:
+        # 数据集目录不可写时只在内存中使用
+        pass
+    return index
+
+
+def getSampler(opt,dataset,shuffle=True):
 
     if opt.DATASETS.SAMPLER == 'Random_Sequential':
         return randomSequentialSampler(dataset, opt.MODEL.BATCH_SIZE)
@@ -61,6 +129,10 @@ def getSampler(opt,dataset):
         import torch.utils.data.SequentialSampler as SequentialSampler
         return SequentialSampler(dataset)
 
+    elif opt.DATASETS.SAMPLER == 'BUCKETED':
+        '''批采样器，需要以batch_sampler传给DataLoader'''
+        return bucketedBatchSampler(dataset.sampleIndex(), opt.MODEL.BATCH_SIZE, shuffle=shuffle)
+
     else:
         return None
 
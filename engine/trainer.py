@@ -15,10 +15,12 @@ from engine.loss import getLoss
 from engine.optimizer import getOptimizer
 from alphabet.alphabet import Alphabet
 from engine.pretrain import pretrain_model
-from logger.info import file_summary
+from engine.validator import BackgroundValidator
+from logger.info import ResultWriter
 from logger.logger import Logger
 from utils.average import averager
-from utils.Pascal_VOC import eval_func
+from utils.Pascal_VOC import generate_json
+from utils.det_evaluator import DetectionEvaluator
 from utils.AverageMeter import AverageMeter
 
 
@@ -42,6 +44,8 @@ class Trainer(object):
 
         # 基本信息
         self.opt = opt
+        # pretreatment把数据放到self.device上，后台验证时会替换为验证所用的设备
+        self.device = torch.device('cuda' if self.opt.BASE.CUDA else 'cpu')
         # 读取识别组件需要的字符表
 
         '''初始化模型，并且加载预训练模型'''
@@ -201,6 +205,11 @@ class Trainer(object):
 
         self.val_times += 1
 
+        '''验证结果缓冲写入，每个结果文件只打开一次'''
+        result_format = self.opt.FUNCTION.get('RESULT_FORMAT', 'txt')
+        result_name = self.opt.BASE.MODEL + '_' + str(self.val_times) + '_{}.' + result_format
+        writer = ResultWriter(self.opt.ADDRESS.LOGGER_DIR, fmt=result_format)
+
         for i in range(len(val_loader)):
             data = val_iter.next()
 
@@ -213,21 +222,24 @@ class Trainer(object):
             loss_avg.add(cost)
 
             for pred, target in zip(preds, targets):
-                if pred == target.lower():
+                correct = pred == target.lower()
+                if correct:
                     n_correct += 1
 
                 '''利用logger工具将结果记录于文件夹中'''
-                file_summary(self.opt.ADDRESS.LOGGER_DIR,self.opt.BASE.MODEL +'_'+str(self.val_times)+ "_result" +".txt","预测 %s      目标 %s\n" % (pred, target))
+                if result_format == 'jsonl':
+                    content = {'pred': pred, 'target': target}
+                else:
+                    content = "预测 %s      目标 %s\n" % (pred, target)
+                writer.write(result_name.format('result'), content)
 
                 '''添加功能：对正确文本和错误文本进行分类'''
-                if pred == target.lower():
-                    file_summary(self.opt.ADDRESS.LOGGER_DIR,self.opt.BASE.MODEL +'_' +str(self.val_times)+ "_right"+".txt","预测 %s      目标 %s\n" % (pred, target))
-                else:
-                    file_summary(self.opt.ADDRESS.LOGGER_DIR,self.opt.BASE.MODEL +'_' +str(self.val_times)+ "_wrong"+".txt","预测 %s      目标 %s\n" % (pred, target))
+                writer.write(result_name.format('right' if correct else 'wrong'), content)
 
                 distance += Levenshtein.distance(pred, target) / max(len(pred), len(target))
                 n_total += 1
 
+        writer.close()
         accuracy = n_correct / float(n_total)
         '''利用logger工具将结果进行可视化'''
         total_index = (epoch-1)*(iteration * self.opt.FREQ.VAL_FREQ) + iteration // self.opt.FREQ.VAL_FREQ
@@ -250,6 +262,7 @@ class Trainer(object):
 
         # loss
         losses = AverageMeter()
+        writer = ResultWriter(self.opt.ADDRESS.LOGGER_DIR)
         for i in range(len(val_loader)):
             data = val_iter.next()
             pretreatmentData = self.pretreatment(data)
@@ -257,14 +270,16 @@ class Trainer(object):
             modelResult = self.model(img)
             loss = self.posttreatment(modelResult, pretreatmentData, data, True)
             print("No.%d, loss:%f" % (i, loss))
-            file_summary(self.opt.ADDRESS.LOGGER_DIR, self.opt.BASE.MODEL + "_result.txt",
-                         "No.%d, loss:%f \n" % (i, loss))
+            writer.write(self.opt.BASE.MODEL + "_result.txt", "No.%d, loss:%f \n" % (i, loss))
             losses.update(loss.item(), img.size(0))
+        writer.close()
         tqdm.write('Validate Loss - Avg Loss {0}'.format(losses.avg))
 
         # Precision / Recall / F_score
-        precision, recall, f_score = \
-            eval_func(input_json_path, gt_json_path, self.opt)
+        generate_json(self.opt)
+        result = self.getDetEvaluator(gt_json_path).evaluate(input_json_path)
+        precision, recall, f_score = result['precision'], result['recall'], result['f_score']
+        print('Global Precision: {:.4f}, Recall: {:.4f}, F_score: {:.4f}'.format(precision, recall, f_score))
 
         # Generate log
         total_index = (epoch-1)*(iteration * self.opt.FREQ.VAL_FREQ) + iteration // self.opt.FREQ.VAL_FREQ
@@ -275,6 +290,20 @@ class Trainer(object):
 
         return precision
 
+    def getDetEvaluator(self, gt_json_path):
+        '''
+        检测评估器，groundtruth只解析一次并缓存，图片在进程池中并行评估
+        多边形面积的计算方式由FUNCTION.POLYGON_BACKEND指定，默认'raster'与以往的结果一致
+        '''
+        evaluator = getattr(self, 'det_evaluator', None)
+        if evaluator is None or evaluator.gt_json_path != gt_json_path:
+            evaluator = DetectionEvaluator(gt_json_path, protocol='pascal_voc',
+                                           iou_threshold=self.opt.THRESHOLD.iou_threshold,
+                                           workers=int(self.opt.BASE.WORKERS),
+                                           backend=self.opt.FUNCTION.get('POLYGON_BACKEND', 'raster'))
+            self.det_evaluator = evaluator
+        return evaluator
+
     def get_img_data(self, pretreatmentData):
         '''
         从pretreatment中提取出img数据，可根据需要重载
@@ -326,6 +355,7 @@ class Trainer(object):
         t0 = time.time()
         self.highestAcc = 0
         iteration = 0
+        self.validator = self.getValidator()
 
         for epoch in range(self.opt.MODEL.EPOCH):
 
@@ -369,11 +399,23 @@ class Trainer(object):
         '''动态调整学习率'''
         if self.scheduler != None:
             scheduler.step()
+        '''等待最后一次后台验证结束'''
+        if self.validator is not None:
+            for result in self.validator.collect(block=True):
+                self.recordValResult(*result)
         self.Logger.close_summary()
 
     def checkSaveOrVal(self, epoch, iteration):
+        '''后台验证：记录已经结束的验证，并在快照上开始新的验证'''
+        if self.validator is not None:
+            block = iteration % self.opt.FREQ.VAL_FREQ == 0
+            for result in self.validator.collect(block=block):
+                self.recordValResult(*result)
+            if block:
+                self.validator.submit(epoch, iteration)
+
         '''验证'''
-        if iteration % self.opt.FREQ.VAL_FREQ == 0:
+        if self.validator is None and iteration % self.opt.FREQ.VAL_FREQ == 0:
             self.setModelState('test')
             acc_tmp = self.validate(epoch, iteration)
             '''记录训练结果最大值的模型文件'''
@@ -390,6 +432,28 @@ class Trainer(object):
         '''恢复训练状态'''
         self.setModelState('train')
 
+    def getValidator(self):
+        '''
+        根据配置文件FUNCTION.VAL_ASYNC（'thread'/'process'）与FUNCTION.VAL_DEVICE创建后台验证器
+        VAL_DEVICE为空时在训练所用的设备上验证
+        未配置VAL_ASYNC时返回None，验证在训练循环中同步执行
+        '''
+        mode = self.opt.FUNCTION.get('VAL_ASYNC', '')
+        if not mode:
+            return None
+        return BackgroundValidator(self, mode, self.opt.FUNCTION.get('VAL_DEVICE', ''))
+
+    def recordValResult(self, epoch, iteration, acc, calls, state_dict):
+        '''
+        记录一次后台验证的结果：回放Logger调用，并保存验证所用快照中结果最好的模型
+        '''
+        for name, args in calls:
+            getattr(self.Logger, name)(*args)
+        if acc > self.highestAcc:
+            self.highestAcc = acc
+            torch.save(state_dict, '{0}/{1}_{2}.pth'.format(
+                self.opt.ADDRESS.CHECKPOINTS_DIR, iteration, str(self.highestAcc)[:6]))
+
     def setModelState(self, state):
         '''
         根据传入的状态判断模型处于训练或者验证状态
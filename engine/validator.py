@@ -0,0 +1,153 @@
+'''
+后台验证模块
+在模型权重的快照上异步执行Trainer.validate，训练循环无需等待验证结束
+'''
+
+import copy
+import queue
+import traceback
+import threading
+import multiprocessing
+
+import torch
+
+
+class RecordLogger(object):
+    '''
+    代替Trainer.Logger在后台验证中使用，只记录调用，由训练进程回放到真正的Logger中
+    '''
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        # 双下划线属性按正常规则处理，否则pickle会把__setstate__等当作Logger调用
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        def record(*args):
+            self.calls.append((name, tuple(a.item() if isinstance(a, torch.Tensor) and a.numel() == 1 else a
+                                           for a in args)))
+        return record
+
+
+def _run_validate(worker, device, epoch, iteration, results):
+    '''
+    在快照上执行验证，结果为(epoch, iteration, 验证指标, Logger调用记录, 异常信息)
+    验证正常结束时异常信息为None
+    '''
+    try:
+        # process模式下快照以CPU权重传入子进程，在子进程中再移到验证设备上
+        worker.model = worker.model.to(device)
+        if device.type == 'cuda':
+            # pretreatment使用worker.device，仍直接调用.cuda()的代码也落在验证设备上
+            with torch.cuda.device(device):
+                value = worker.validate(epoch, iteration)
+        else:
+            value = worker.validate(epoch, iteration)
+        if isinstance(value, torch.Tensor):
+            value = value.item()
+        results.put((epoch, iteration, value, worker.Logger.calls, None))
+    except Exception:
+        results.put((epoch, iteration, None, [], traceback.format_exc()))
+
+
+class BackgroundValidator(object):
+
+    def __init__(self, trainer, mode='thread', device=None):
+        '''
+        后台验证器
+
+        传入参数：
+        1.trainer：需要验证的训练器
+        2.mode：'thread'在线程中验证；
+                'process'在spawn出的进程中验证，训练器需要可以pickle，启动训练的脚本需要有__main__保护
+        3.device：验证所用的设备，例如'cpu'或'cuda:1'，默认为训练器的设备trainer.device
+
+        同一时间只有一个验证任务，pretreatment需要把数据放到self.device上
+        '''
+        if mode not in ('thread', 'process'):
+            raise ValueError('Unknown validation mode {}, expected thread or process'.format(mode))
+        self.trainer = trainer
+        self.mode = mode
+        self.device = torch.device(device) if device else trainer.device
+        if mode == 'process':
+            # fork出的子进程无法重新初始化CUDA
+            self.context = multiprocessing.get_context('spawn')
+            self.results = self.context.Queue()
+        else:
+            self.results = queue.Queue()
+        self.job = None
+        self.snapshot = None
+
+    def snapshotTrainer(self):
+        '''
+        复制一份训练器，模型替换为当前权重的快照，Logger替换为RecordLogger
+        '''
+        model = copy.deepcopy(self.trainer.model)
+        if self.mode == 'thread':
+            model = model.to(self.device)
+        else:
+            model = model.to('cpu')
+        worker = copy.copy(self.trainer)
+        worker.model = model
+        worker.device = self.device
+        # criterion可能带有buffer，移动设备时不能影响训练使用的criterion
+        worker.criterion = copy.deepcopy(self.trainer.criterion)
+        worker.Logger = RecordLogger()
+        if self.mode == 'process':
+            # 子进程中用不到训练相关的对象，不需要pickle
+            worker.optimizer = None
+            worker.scheduler = None
+            worker.train_loader = None
+            worker.validator = None
+        worker.setModelState('test')
+        # 最优模型保存的是快照的权重，而不是验证结束时的权重
+        self.snapshot = {k: v.detach().to('cpu', copy=True) for k, v in self.trainer.model.state_dict().items()}
+        return worker
+
+    def submit(self, epoch, iteration):
+        '''
+        提交一次验证任务后立即返回，提交前需要用collect(block=True)取走上一次的结果
+        '''
+        assert self.job is None, "The previous validation is still running, collect its result first."
+        worker = self.snapshotTrainer()
+        # validate_recognition用val_times为结果文件编号，训练器本身也要计数
+        if hasattr(self.trainer, 'val_times'):
+            self.trainer.val_times += 1
+        args = (worker, self.device, epoch, iteration, self.results)
+        if self.mode == 'process':
+            self.job = self.context.Process(target=_run_validate, args=args)
+        else:
+            self.job = threading.Thread(target=_run_validate, args=args)
+        self.job.start()
+
+    def collect(self, block=False):
+        '''
+        取回已经结束的验证结果
+        block为True时等待正在进行的验证结束
+
+        返回数据：
+        列表，每一项为(epoch, iteration, 验证指标, Logger调用记录, 快照权重)
+        验证出错时抛出RuntimeError，训练不会在没有验证结果的情况下继续
+        '''
+        if self.job is None or (not block and self.job.is_alive()):
+            return []
+        result = None
+        while result is None:
+            try:
+                result = self.results.get(timeout=1)
+            except queue.Empty:
+                # 异常退出时队列中没有结果
+                if not self.job.is_alive():
+                    break
+        self.job.join()
+        self.job = None
+        snapshot, self.snapshot = self.snapshot, None
+        if result is None:
+            raise RuntimeError('Background validation exited without a result')
+        epoch, iteration, value, calls, error = result
+        if error is not None:
+            raise RuntimeError('Background validation of epoch {} iteration {} failed:\n{}'.format(
+                epoch, iteration, error))
+        return [(epoch, iteration, value, calls, snapshot)]
@@ -1,4 +1,5 @@
 import os
+import json
 import torch
 
 def file_summary(path, file_name, content, encoding='utf8',mode= 'a'):
@@ -14,3 +15,72 @@ def file_summary(path, file_name, content, encoding='utf8',mode= 'a'):
     f = open(os.path.join(path, file_name), mode, encoding=encoding)
     f.write(content)
     f.close()
+
+
+class ResultWriter(object):
+    '''
+    Buffered, append-only writer for many small results, e.g. one line per validation sample.
+    Each output file gets a single handle, opened on its first flush and kept until close().
+    '''
+
+    def __init__(self, path, encoding='utf8', mode='a', fmt='txt', buffer_size=1024):
+        '''
+        Args:
+            path(string):the directory of the output files.
+            encoding(string):the coding scheme of the files.
+            mode(string):'a' to append to existing files, 'w' to truncate them on the first flush.
+            fmt(string):'txt' writes the given strings as they are, 'jsonl' writes every
+                content as one compact json line.
+            buffer_size(int):number of buffered contents that triggers a flush of all files.
+        '''
+        if fmt not in ('txt', 'jsonl'):
+            raise ValueError('Unknown result format {}, expected txt or jsonl'.format(fmt))
+        if os.path.exists(path) is False:
+            os.makedirs(path)
+        self.path = path
+        self.encoding = encoding
+        self.mode = mode
+        self.fmt = fmt
+        self.buffer_size = buffer_size
+        self.buffers = {}
+        self.files = {}
+        self.pending = 0
+
+    def write(self, file_name, content):
+        '''
+        Args:
+            file_name(string):the name of the file. e.g.`test.txt`
+            content(string or json-serializable object):the content needed to write.
+        '''
+        if self.fmt == 'jsonl':
+            content = json.dumps(content, ensure_ascii=False, separators=(',', ':')) + '\n'
+        self.buffers.setdefault(file_name, []).append(content)
+        self.pending += 1
+        if self.pending >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        for file_name, contents in self.buffers.items():
+            if not contents:
+                continue
+            f = self.files.get(file_name)
+            if f is None:
+                f = open(os.path.join(self.path, file_name), self.mode, encoding=self.encoding)
+                self.files[file_name] = f
+            f.write(''.join(contents))
+            f.flush()
+            del contents[:]
+        self.pending = 0
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        self.buffers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
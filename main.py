@@ -24,7 +24,7 @@ class GRCNN_Trainer(Trainer):
         '''
         from torch.autograd import Variable
         cpu_images, cpu_gt = data
-        v_images = Variable(cpu_images.cuda())
+        v_images = Variable(cpu_images.to(self.device))
         return (v_images,)
 
     def posttreatment(self, modelResult, pretreatmentData, originData, test=False):
@@ -47,7 +47,7 @@ class GRCNN_Trainer(Trainer):
             cpu_images, cpu_gt = originData
             bsz = cpu_images.size(0)
             text, text_len = self.converter.encode(cpu_gt)
-            v_Images = Variable(cpu_images.cuda())
+            v_Images = Variable(cpu_images.to(self.device))
             v_gt = Variable(text)
             v_gt_len = Variable(text_len)
 
@@ -74,11 +74,17 @@ class TextSnake_Trainer(Trainer):
 
     def __init__(self, modelObject, opt, train_loader, val_loader):
         Trainer.__init__(self, modelObject, opt, train_loader, val_loader)
+        import torch
         from model.detection_model.TextSnake_pytorch.util import global_data
+        from utils.average import averager
         global_data._init()
+        self.device = torch.device(self.opt.TEXTSNAKE.device)
+        # dataset生成训练目标所用的时间（meta['target_time']），每SHOW_FREQ次迭代输出一次平均值
+        self.target_time = averager()
+        self.train_steps = 0
 
     def to_device(self, *tensors):
-        return (t.to(self.opt.TEXTSNAKE.device) for t in tensors)
+        return (t.to(self.device) for t in tensors)
 
     def pretreatment(self, data, test=False):
 
@@ -97,6 +103,14 @@ class TextSnake_Trainer(Trainer):
             tr_loss, tcl_loss, sin_loss, cos_loss, radii_loss = \
                 self.criterion(modelResult, tr_mask, tcl_mask, sin_map, cos_map, radius_map, train_mask)
             loss = tr_loss + tcl_loss + sin_loss + cos_loss + radii_loss
+
+            self.target_time.add(meta['target_time'])
+            if self.train_steps % self.opt.FREQ.SHOW_FREQ == 0:
+                target_time = float(self.target_time.val())
+                print('Target generation: %f s per image' % target_time)
+                self.Logger.scalar_summary('Target time', target_time, self.train_steps)
+                self.target_time.reset()
+            self.train_steps += 1
             return loss
 
         else:
@@ -105,6 +119,7 @@ class TextSnake_Trainer(Trainer):
             import json
             from PIL import Image
             from model.detection_model.TextSnake_pytorch.util.detection import TextDetector
+            from model.detection_model.TextSnake_pytorch.util.misc import calc_confidence
             from model.detection_model.TextSnake_pytorch.util.visualize import visualize_detection
             from model.detection_model.TextSnake_pytorch.util import global_data
 
@@ -131,8 +146,9 @@ class TextSnake_Trainer(Trainer):
 
                 tcl_pred_mask = (tcl_pred * tr_pred_mask)[1] > detector.tcl_conf_thresh
 
-                batch_result = detector.complete_detect(tr_pred_mask, tcl_pred_mask, sin_pred, cos_pred,
-                                                        radii_pred)  # (n_tcl, 3)
+                # complete: sampled tcl points; batch: center lines traced together, see TextDetector.batch_detect
+                detect = getattr(detector, '{}_detect'.format(self.opt.TEXTSNAKE.get('detect_mode', 'complete')))
+                batch_result = detect(tr_pred_mask, tcl_pred_mask, sin_pred, cos_pred, radii_pred)  # (n_tcl, 3)
                 # visualization
                 img_show = img[idx].permute(1, 2, 0).cpu().numpy()
                 img_show = ((img_show * self.opt.TEXTSNAKE.stds + self.opt.TEXTSNAKE.means) * 255).astype(np.uint8)
@@ -154,22 +170,7 @@ class TextSnake_Trainer(Trainer):
 
                 contours = [cont[:, 0, :] for cont in contours]
 
-                polygons = []
-                for cnt in contours:
-                    drawing = np.zeros(tr_pred.shape[1:], np.int8)
-                    mask = cv2.fillPoly(drawing, [cnt.astype(np.int32)], 1)
-                    area = np.sum(np.greater(mask, 0))
-                    if not area > 0:
-                        continue
-
-                    confidence = np.sum(mask * tr_pred[0]) / area
-
-                    polygon = {
-                        'points': cnt,
-                        'confidence': confidence
-                    }
-
-                    polygons.append(polygon)
+                polygons = calc_confidence(contours, tr_pred)
 
                 h, w = img_show.shape[:2]
                 # get no-padding image size
@@ -248,12 +249,11 @@ class MORAN_Trainer(Trainer):
         text_rev = torch.LongTensor(self.opt.MODEL.BATCH_SIZE * 5)
         length = torch.IntTensor(self.opt.MODEL.BATCH_SIZE)
 
-        if self.opt.CUDA:
-            # self.model = torch.nn.DataParallel(self.model, device_ids=range(self.opt.ngpu))
-            image = image.cuda()
-            text = text.cuda()
-            text_rev = text_rev.cuda()
-            self.criterion = self.criterion.cuda()
+        # self.model = torch.nn.DataParallel(self.model, device_ids=range(self.opt.ngpu))
+        image = image.to(self.device)
+        text = text.to(self.device)
+        text_rev = text_rev.to(self.device)
+        self.criterion = self.criterion.to(self.device)
 
         image = Variable(image)
         text = Variable(text)
@@ -357,8 +357,8 @@ class AEAST_Trainer(Trainer):
 
     def pretreatment(self, data, test=False):
         img, gt = data
-        img = img.cuda()
-        gt = gt.cuda()
+        img = img.to(self.device)
+        gt = gt.to(self.device)
         return img, gt
 
     def posttreatment(self, modelResult, pretreatmentData, originData, test=False):
@@ -372,6 +372,8 @@ class AEAST_Trainer(Trainer):
 
 
 
-env = Env()
-train_loader, test_loader = build_dataloader(env.opt)
-newTrainer = MORAN_Trainer(modelObject=env.model, opt=env.opt, train_loader=train_loader, val_loader=test_loader).train()
+# 后台验证的process模式用spawn启动子进程，子进程会重新导入本脚本
+if __name__ == '__main__':
+    env = Env()
+    train_loader, test_loader = build_dataloader(env.opt)
+    newTrainer = MORAN_Trainer(modelObject=env.model, opt=env.opt, train_loader=train_loader, val_loader=test_loader).train()
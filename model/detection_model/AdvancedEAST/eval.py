@@ -3,7 +3,6 @@ import time
 import argparse
 import numpy as np
 import torch
-from multiprocessing import Pool, RLock, set_start_method
 from PIL import Image, ImageDraw
 from tqdm import tqdm
 import json
@@ -11,7 +10,8 @@ import json
 from utils.preprocess import point_inside_of_quad
 from utils.data_utils import transform
 from network.AEast import East
-from nms.nms import nms
+from nms.nms_py import nms
+from nms.nms_torch import activate, batch_nms
 from tools.Pascal_VOC import eval_func
 import config as cfg
 
@@ -81,27 +81,20 @@ class Wrapped:
         if not os.path.exists(self.result_dir):
             os.makedirs(self.result_dir)
 
-    def init_lock(self, lock_):
-        global lock
-        lock = lock_
-
     def __call__(self):
         img_list = [img_name for img_name in os.listdir(self.img_dir)]
         miss = []
 
         if cfg.batch_size_per_gpu > 1:
-            set_start_method('forkserver')
-            lock_ = RLock()
-            processes = 2
-            pool = Pool(processes=processes, initializer=self.init_lock, initargs=(lock_,))
+            # batches of images share one forward pass and one nms on the gpu
+            batch_size = cfg.batch_size_per_gpu
             with tqdm(total=len(img_list), desc='Detect') as pbar:
-                for _, r in enumerate(pool.imap_unordered(self.process, img_list)):
-                    if r[0] == 0:
-                        miss.append(r[1])
-                        # tqdm.write(f"{r[1]}: {r[0]} quads.")
-                    pbar.update()
-            pool.close()
-            pool.join()
+                for start in range(0, len(img_list), batch_size):
+                    for r in self.process_batch(img_list[start:start + batch_size]):
+                        if r[0] == 0:
+                            miss.append(r[1])
+                            # tqdm.write(f"{r[1]}: {r[0]} quads.")
+                        pbar.update()
         else:
             for img_name in tqdm(img_list):
                 r = self.process(img_name)
@@ -122,15 +115,7 @@ class Wrapped:
                 txt_items = f_txt.readlines()
                 return len(txt_items), img_name
 
-        img_path = os.path.join(self.img_dir, img_name)
-        im = Image.open(img_path).convert('RGB')
-        if cfg.predict_cut_text_line:
-            im_array = np.array(im, dtype=np.float32)
-
-        d_width, d_height = resize_image(im.size)
-        scale_ratio_w = d_width / im.width
-        scale_ratio_h = d_height / im.height
-        im = im.resize((d_width, d_height), Image.BICUBIC)
+        im, im_array, scale_ratio_w, scale_ratio_h = self.load_image(img_name)
 
         x = transform(im)
         x = x[np.newaxis, :]
@@ -143,9 +128,55 @@ class Wrapped:
         cond = np.greater_equal(y[:, :, 0], cfg.pixel_threshold)
         activation_pixels = np.asarray(np.where(cond), dtype=np.int32)
 
-        quad_scores, quad_after_nms = nms(y, activation_pixels[0], activation_pixels[1])
+        # nms_py groups the 8-connected pixels like batch_nms, the cython nms.nms misses some diagonal runs
+        quad_scores, quad_after_nms = nms(y, activation_pixels)
+        return self.save_result(img_name, im, im_array, scale_ratio_w, scale_ratio_h, y, quad_scores, quad_after_nms)
+
+    def process_batch(self, img_names):
+        '''
+        Detect a list of images, the images resized to the same size go through the network
+        together and their quads are restored on the gpu by batch_nms.
+        '''
+        results = [None] * len(img_names)
+        same_size = {}
+        for k, img_name in enumerate(img_names):
+            txt_path = self.result_dir + img_name[:-4] + '.txt'
+            if os.path.exists(txt_path):
+                with open(txt_path, 'r') as f_txt:
+                    results[k] = (len(f_txt.readlines()), img_name)
+                continue
+            loaded = self.load_image(img_name)
+            same_size.setdefault(loaded[0].size, []).append((k, img_name, loaded))
+
+        for items in same_size.values():
+            x = torch.stack([transform(loaded[0]) for _, _, loaded in items])
+            with torch.no_grad():
+                y = self.model(x.cuda())
+            detections = batch_nms(y)
+            # the activation map is only needed on the host for drawing
+            y = activate(y).cpu().numpy() if self.isDraw else [None] * len(items)
+            for (k, img_name, loaded), y_i, (quad_scores, quad_after_nms) in zip(items, y, detections):
+                results[k] = self.save_result(img_name, *loaded, y_i, quad_scores, quad_after_nms)
+        return results
+
+    def load_image(self, img_name):
+        img_path = os.path.join(self.img_dir, img_name)
+        im = Image.open(img_path).convert('RGB')
+        im_array = None
+        if cfg.predict_cut_text_line:
+            im_array = np.array(im, dtype=np.float32)
+
+        d_width, d_height = resize_image(im.size)
+        scale_ratio_w = d_width / im.width
+        scale_ratio_h = d_height / im.height
+        im = im.resize((d_width, d_height), Image.BICUBIC)
+        return im, im_array, scale_ratio_w, scale_ratio_h
 
+    def save_result(self, img_name, im, im_array, scale_ratio_w, scale_ratio_h, y, quad_scores, quad_after_nms):
+        txt_path = self.result_dir + img_name[:-4] + '.txt'
         if self.isDraw:
+            cond = np.greater_equal(y[:, :, 0], cfg.pixel_threshold)
+            activation_pixels = np.where(cond)
             quad_im = im.copy()
             draw = ImageDraw.Draw(im)
             for i, j in zip(activation_pixels[0], activation_pixels[1]):
@@ -1,6 +1,7 @@
 # coding=utf-8
 # NMS by https://github.com/huoyijie/AdvancedEAST
 
+import cv2
 import numpy as np
 
 import config as cfg
@@ -50,7 +51,74 @@ def rec_region_merge(region_list, m, S):
     return rows
 
 
+def group_pixels(shape, rows, cols):
+    '''
+    Group the activated pixels the way nms_region_merge does in linear time.
+
+    The regions of nms_region_merge are the horizontal runs of activated pixels
+    and region_group joins the runs of adjacent rows whose columns overlap or
+    touch diagonally, i.e. the groups are the 8-connected components. Groups are
+    numbered in the raster order of their first pixel, like region_group.
+
+    Returns:
+        group index of every activated pixel, number of groups
+    '''
+    if len(rows) == 0:
+        return np.zeros(0, dtype=np.int64), 0
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[rows, cols] = 1
+    _, labels = cv2.connectedComponents(mask, connectivity=8)
+    pixel_labels = labels[rows, cols]
+    unique_labels, first = np.unique(pixel_labels, return_index=True)
+    group_of_label = np.zeros(unique_labels[-1] + 1, dtype=np.int64)
+    group_of_label[unique_labels[np.argsort(first)]] = np.arange(len(unique_labels))
+    return group_of_label[pixel_labels], len(unique_labels)
+
+
 def nms(predict, activation_pixels, threshold=cfg.side_vertex_pixel_threshold):
+    '''
+    Group the activated pixels into text regions and average the side-vertex
+    predictions of every group into a quad.
+
+    Args:
+        predict: (h, w, 7) network output with sigmoid applied to the first 3 channels
+        activation_pixels: (rows, cols) of the activated pixels in raster order, e.g. np.where(cond)
+        threshold: side-vertex pixel threshold
+
+    Returns:
+        score_list (n, 4), quad_list (n, 4, 2), the same as nms_region_merge
+    '''
+    rows = np.asarray(activation_pixels[0], dtype=np.int64)
+    cols = np.asarray(activation_pixels[1], dtype=np.int64)
+    groups, group_num = group_pixels(predict.shape[:2], rows, cols)
+
+    score = predict[rows, cols, 1]
+    ith_score = predict[rows, cols, 2]
+    ith = np.around(ith_score).astype(np.int64)
+    side = (score >= threshold) & ~((cfg.trunc_threshold <= ith_score) & (ith_score < 1 - cfg.trunc_threshold))
+    side &= (ith == 0) | (ith == 1)
+
+    # accumulate the scores and the weighted side vertexes per (group, ith)
+    key = groups[side] * 2 + ith[side]
+    weight = score[side].astype(np.float64)
+    px = (cols[side] + 0.5) * cfg.pixel_size
+    py = (rows[side] + 0.5) * cfg.pixel_size
+    p_v = np.stack((px, py, px, py), axis=-1) + predict[rows[side], cols[side], 3:7]
+    weighted = weight[:, None] * p_v
+
+    # bincount of an empty key returns integers
+    total_score = np.bincount(key, weights=weight, minlength=group_num * 2).astype(np.float64)
+    total_score = np.repeat(total_score.reshape(group_num, 2), 2, axis=1)
+    quad_list = np.stack([np.bincount(key, weights=weighted[:, k], minlength=group_num * 2) for k in range(4)],
+                         axis=-1).astype(np.float64).reshape(group_num, 4, 2)
+    quad_list /= (total_score[:, :, None] + cfg.epsilon)
+    return total_score, quad_list
+
+
+def nms_region_merge(predict, activation_pixels, threshold=cfg.side_vertex_pixel_threshold):
+    '''
+    Set based reference of nms, merging the regions pixel by pixel.
+    '''
     region_list = []
     for i, j in zip(activation_pixels[0], activation_pixels[1]):
         merge = False
@@ -72,7 +140,7 @@ def nms(predict, activation_pixels, threshold=cfg.side_vertex_pixel_threshold):
             for ij in region_list[row]:
                 score = predict[ij[0], ij[1], 1]
                 if score >= threshold:
-                    ith_score = predict[ij[0], ij[1], 2:3]
+                    ith_score = predict[ij[0], ij[1], 2]
                     if not (cfg.trunc_threshold <= ith_score < 1 - cfg.trunc_threshold):
                         ith = int(np.around(ith_score))
                         total_score[ith * 2:(ith + 1) * 2] += score
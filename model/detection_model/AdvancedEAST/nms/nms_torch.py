@@ -0,0 +1,129 @@
+# coding=utf-8
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+import config as cfg
+
+
+def activate(predict):
+    '''
+    Apply sigmoid to the inside score, side vertex code and side vertex order channels.
+
+    Args:
+        predict: (b, h, w, 7) raw output of East
+
+    Returns:
+        a new (b, h, w, 7) tensor
+    '''
+    return torch.cat((torch.sigmoid(predict[..., :3]), predict[..., 3:]), dim=-1)
+
+
+def neighbour_min(labels, background):
+    '''
+    Smallest label of the 3x3 neighbourhood of every pixel.
+    '''
+    h, w = labels.shape[1:]
+    padded = F.pad(labels, (1, 1, 1, 1), value=background)
+    out = labels
+    for dy in range(3):
+        for dx in range(3):
+            out = torch.min(out, padded[:, dy:dy + h, dx:dx + w])
+    return out
+
+
+def label_components(mask):
+    '''
+    Label the 8-connected components of a batch of masks on their device.
+
+    Union-find over the flat pixel indices: the root of every label is hooked to the
+    smallest label next to any of its pixels, then all the labels are compressed to
+    their roots, until no pixel touches a smaller label.
+
+    Args:
+        mask: (b, h, w) bool
+
+    Returns:
+        flat indices of the activated pixels, (k,) int64
+        their labels, (k,) int64, the flat index (over the whole batch) of the first
+        pixel of the component in raster order
+    '''
+    n = mask.numel()
+    pixels = torch.nonzero(mask.view(-1), as_tuple=True)[0]
+    # parent of every pixel, the background and the padding point at the sentinel n
+    parent = torch.full((n + 1,), n, dtype=torch.int64, device=mask.device)
+    parent[pixels] = pixels
+    while True:
+        labels = parent[:n].view_as(mask)
+        smallest = neighbour_min(labels, n).view(-1)[pixels]
+        own = parent[pixels]
+        hook = smallest < own
+        if not hook.any():
+            return pixels, own
+        parent.scatter_reduce_(0, own[hook], smallest[hook], reduce='amin')
+        # compress, every pixel follows its parents up to a root
+        while True:
+            grand = parent[parent[pixels]]
+            if torch.equal(grand, parent[pixels]):
+                break
+            parent[pixels] = grand
+
+
+def batch_nms(predict, pixel_threshold=cfg.pixel_threshold, threshold=cfg.side_vertex_pixel_threshold,
+              valid_only=False):
+    '''
+    Batched nms on the device of the prediction, only the quads are copied to the host.
+
+    Args:
+        predict: (b, h, w, 7) raw output of East, before sigmoid
+        pixel_threshold: pixel activation threshold
+        threshold: side-vertex pixel threshold
+        valid_only: drop the quads without a head or a tail, i.e. with a zero score
+
+    Returns:
+        one (score_list (n, 4), quad_list (n, 4, 2)) pair per image, the same as nms on
+        the activated pixels of the image
+    '''
+    batch_size, h, w = predict.shape[:3]
+    predict = activate(predict.detach())
+    mask = predict[..., 0] >= pixel_threshold
+    index, labels = label_components(mask)
+
+    # groups in raster order of their first pixel, images one after the other
+    group_labels, groups = torch.unique(labels, sorted=True, return_inverse=True)
+    group_num = len(group_labels)
+    group_image = group_labels // (h * w)
+    rows = index % (h * w) // w
+    cols = index % w
+
+    pixels = predict.view(-1, predict.shape[-1])[index]
+    score = pixels[:, 1]
+    ith_score = pixels[:, 2]
+    ith = torch.round(ith_score).long()
+    side = (score >= threshold) & ~((cfg.trunc_threshold <= ith_score) & (ith_score < 1 - cfg.trunc_threshold))
+    side &= (ith == 0) | (ith == 1)
+
+    # accumulate the scores and the weighted side vertexes per (group, ith)
+    key = groups[side] * 2 + ith[side]
+    weight = score[side].double()
+    px = (cols[side].double() + 0.5) * cfg.pixel_size
+    py = (rows[side].double() + 0.5) * cfg.pixel_size
+    p_v = torch.stack((px, py, px, py), dim=-1) + pixels[side, 3:7].double()
+
+    total_score = torch.zeros(group_num * 2, dtype=torch.float64, device=predict.device)
+    total_score.index_add_(0, key, weight)
+    quad_list = torch.zeros((group_num * 2, 4), dtype=torch.float64, device=predict.device)
+    quad_list.index_add_(0, key, weight[:, None] * p_v)
+
+    total_score = total_score.view(group_num, 2).repeat_interleave(2, dim=1)
+    quad_list = quad_list.view(group_num, 4, 2) / (total_score[:, :, None] + cfg.epsilon)
+
+    if valid_only:
+        keep = total_score.min(dim=1)[0] > 0
+        total_score, quad_list, group_image = total_score[keep], quad_list[keep], group_image[keep]
+
+    counts = torch.bincount(group_image, minlength=batch_size).tolist()
+    split = np.cumsum(counts)[:-1]
+    score_lists = np.split(total_score.cpu().numpy(), split)
+    quad_lists = np.split(quad_list.cpu().numpy(), split)
+    return list(zip(score_lists, quad_lists))
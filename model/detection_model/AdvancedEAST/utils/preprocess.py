@@ -24,19 +24,34 @@ class Anno:
             os.makedirs(self.nimg_dir)
 
     def check_anno(self):
-        if os.path.isdir(self.anno_dir) and len(os.listdir(self.anno_dir)) == len(self.img_list) and os.path.isdir(self.nimg_dir) and len(os.listdir(self.nimg_dir)) == len(self.img_list):
+        '''
+        Build the missing cache files in a process pool.
+
+        Every file is written to a temporary name and renamed when complete, so an
+        interrupted run leaves no truncated cache and simply resumes from the
+        images that are still missing.
+        '''
+        missing = [img_name for img_name in self.img_list if not self.cached(img_name)]
+        if len(missing) == 0:
+            return
+        pool = Pool(processes=cfg.num_process)
+        chunksize = max(1, len(missing) // (cfg.num_process * 16))
+        for _ in tqdm(pool.imap_unordered(self.create_anno, missing, chunksize=chunksize), total=len(missing)):
             pass
-        else:  # accelerate via multiprocessing
-            pool = Pool(processes=cfg.num_process)
-            with tqdm(total=len(self.img_list)) as pbar:
-                for _, _ in tqdm(enumerate(pool.imap_unordered(self.create_anno, self.img_list))):
-                    pbar.update()
-            pool.close()
-            pool.join()
+        pool.close()
+        pool.join()
 
-    def create_anno(self, img_name):
+    def cache_files(self, img_name):
         anno_file = os.path.join(self.anno_dir, img_name[:-4] + '.npy')
         nimg_file = os.path.join(self.nimg_dir, img_name[:-4] + '.jpg')
+        return anno_file, nimg_file
+
+    def cached(self, img_name):
+        anno_file, nimg_file = self.cache_files(img_name)
+        return os.path.exists(anno_file) and os.path.exists(nimg_file)
+
+    def create_anno(self, img_name):
+        anno_file, nimg_file = self.cache_files(img_name)
         if os.path.exists(anno_file) and os.path.exists(nimg_file):
             return
         with Image.open(os.path.join(self.img_dir, img_name)) as im:
@@ -50,10 +65,12 @@ class Anno:
             delta_h = (tsize - dsize[1]) // 2
 
             # resize and save input image to cache_dir
-            im = im.resize(dsize, Image.BICUBIC)
-            new_img = Image.new("RGB", (tsize, tsize), (128, 128, 128))
-            new_img.paste(im, ((tsize - dsize[0]) // 2, (tsize - dsize[1]) // 2))
-            new_img.save(nimg_file, quality=95)
+            if not os.path.exists(nimg_file):
+                im = im.resize(dsize, Image.BICUBIC)
+                new_img = Image.new("RGB", (tsize, tsize), (128, 128, 128))
+                new_img.paste(im, ((tsize - dsize[0]) // 2, (tsize - dsize[1]) // 2))
+                new_img.save(nimg_file + '.tmp', format='JPEG', quality=95)
+                os.replace(nimg_file + '.tmp', nimg_file)
 
             if os.path.exists(anno_file):
                 return
@@ -61,7 +78,7 @@ class Anno:
                 anno_list = f.readlines()
 
             gt = np.zeros((tsize // cfg.pixel_size, tsize // cfg.pixel_size, 7), dtype=np.float32)
-            for i, anno in enumerate(anno_list):
+            for anno in anno_list:
                 anno_column = anno.strip().split(',')
                 anno_array = np.asarray(anno_column)
                 xy_list = np.reshape(anno_array[:8].astype(np.float32), (4, 2))
@@ -71,44 +88,98 @@ class Anno:
                 xy_list[:, 1] = xy_list[:, 1] * scale_ratio_h + delta_h
                 xy_list = reorder_vertexes(xy_list)
 
-                '''Prepare ground-truth map.'''
-                _, shrink_xy_list, _ = shrink(xy_list, cfg.shrink_ratio)
-                shrink_1, _, long_edge = shrink(xy_list, cfg.shrink_side_ratio)
-
-                p_min = np.amin(shrink_xy_list, axis=0)
-                p_max = np.amax(shrink_xy_list, axis=0)
-                # floor of the float
-                ji_min = (p_min / cfg.pixel_size - 0.5).astype(np.int32) - 1
-                # +1 for ceil of the float and +1 for include the end
-                ji_max = (p_max / cfg.pixel_size - 0.5).astype(np.int32) + 3
-                imin = np.maximum(0, ji_min[1])
-                imax = np.minimum(tsize // cfg.pixel_size, ji_max[1])
-                jmin = np.maximum(0, ji_min[0])
-                jmax = np.minimum(tsize // cfg.pixel_size, ji_max[0])
-                for i in range(imin, imax):
-                    for j in range(jmin, jmax):
-                        px = (j + 0.5) * cfg.pixel_size
-                        py = (i + 0.5) * cfg.pixel_size
-                        # Genereate ground-truth
-                        if point_inside_of_quad(px, py, shrink_xy_list, p_min, p_max):
-                            # inside score
-                            gt[i, j, 0] = 1
-                            ith = point_inside_of_nth_quad(px, py, xy_list, shrink_1, long_edge)
-                            vs = [[[3, 0], [1, 2]], [[0, 1], [2, 3]]]
-                            if ith in range(2):
-                                # side-vertex code
-                                gt[i, j, 1] = 1
-                                gt[i, j, 2:3] = ith
-                                # side-vertex geo
-                                gt[i, j, 3:5] = xy_list[vs[long_edge][ith][0]] - [px, py]
-                                gt[i, j, 5:] = xy_list[vs[long_edge][ith][1]] - [px, py]
-        np.save(anno_file, gt)
+                quad_gt(gt, xy_list)
+        with open(anno_file + '.tmp', 'wb') as f:
+            np.save(f, gt)
+        os.replace(anno_file + '.tmp', anno_file)
 
     def get_dir(self):
         '''Return anno_dir, nimg_dir.'''
         return self.anno_dir, self.nimg_dir
 
 
+def quad_gt(gt, xy_list):
+    '''
+    Prepare the ground-truth map of one reordered quad, all cells around the
+    shrunk quad at once. Cells covered by several quads keep the values of the
+    last one, as in the per-cell reference.
+    '''
+    _, shrink_xy_list, _ = shrink(xy_list, cfg.shrink_ratio)
+    shrink_1, _, long_edge = shrink(xy_list, cfg.shrink_side_ratio)
+
+    p_min = np.amin(shrink_xy_list, axis=0)
+    p_max = np.amax(shrink_xy_list, axis=0)
+    # floor of the float
+    ji_min = (p_min / cfg.pixel_size - 0.5).astype(np.int32) - 1
+    # +1 for ceil of the float and +1 for include the end
+    ji_max = (p_max / cfg.pixel_size - 0.5).astype(np.int32) + 3
+    size = gt.shape[0]
+    imin = np.maximum(0, ji_min[1])
+    imax = np.minimum(size, ji_max[1])
+    jmin = np.maximum(0, ji_min[0])
+    jmax = np.minimum(size, ji_max[0])
+    if imin >= imax or jmin >= jmax:
+        return
+
+    py, px = np.meshgrid((np.arange(imin, imax) + 0.5) * cfg.pixel_size,
+                         (np.arange(jmin, jmax) + 0.5) * cfg.pixel_size, indexing='ij')
+    # inside score
+    inside = points_inside_of_quad(px, py, shrink_xy_list, p_min, p_max)
+    region = gt[imin:imax, jmin:jmax]
+    region[inside, 0] = 1
+
+    ith = points_inside_of_nth_quad(px, py, xy_list, shrink_1, long_edge)
+    vs = [[[3, 0], [1, 2]], [[0, 1], [2, 3]]]
+    for nth in range(2):
+        side = inside & (ith == nth)
+        if not side.any():
+            continue
+        pxy = np.stack((px[side], py[side]), axis=-1)
+        # side-vertex code
+        region[side, 1] = 1
+        region[side, 2] = nth
+        # side-vertex geo
+        region[side, 3:5] = xy_list[vs[long_edge][nth][0]] - pxy
+        region[side, 5:] = xy_list[vs[long_edge][nth][1]] - pxy
+
+
+def points_inside_of_quad(px, py, quad_xy_list, p_min, p_max):
+    '''
+    point_inside_of_quad for arrays of points px, py of the same shape.
+    '''
+    xy_list = np.zeros((4, 2))
+    xy_list[:3, :] = quad_xy_list[1:4, :] - quad_xy_list[:3, :]
+    xy_list[3] = quad_xy_list[0, :] - quad_xy_list[3, :]
+    yx_list = np.zeros((4, 2))
+    yx_list[:, :] = quad_xy_list[:, -1:-3:-1]
+    a_y = xy_list[:, 0] * (py[..., None] - yx_list[:, 0])
+    a_x = xy_list[:, 1] * (px[..., None] - yx_list[:, 1])
+    b = a_y - a_x
+    in_box = (p_min[0] <= px) & (px <= p_max[0]) & (p_min[1] <= py) & (py <= p_max[1])
+    return in_box & ((np.amin(b, axis=-1) >= 0) | (np.amax(b, axis=-1) <= 0))
+
+
+def points_inside_of_nth_quad(px, py, xy_list, shrink_1, long_edge):
+    '''
+    point_inside_of_nth_quad for arrays of points px, py of the same shape.
+    '''
+    vs = [[[0, 0, 3, 3, 0], [1, 1, 2, 2, 1]],
+          [[0, 0, 1, 1, 0], [2, 2, 3, 3, 2]]]
+    inside = []
+    for ith in range(2):
+        quad_xy_list = np.stack((xy_list[vs[long_edge][ith][0]],
+                                 shrink_1[vs[long_edge][ith][1]],
+                                 shrink_1[vs[long_edge][ith][2]],
+                                 xy_list[vs[long_edge][ith][3]]), axis=0)
+        p_min = np.amin(quad_xy_list, axis=0)
+        p_max = np.amax(quad_xy_list, axis=0)
+        inside.append(points_inside_of_quad(px, py, quad_xy_list, p_min, p_max))
+    nth = np.full(px.shape, -1, dtype=np.int64)
+    nth[inside[0] & ~inside[1]] = 0
+    nth[inside[1] & ~inside[0]] = 1
+    return nth
+
+
 def point_inside_of_quad(px, py, quad_xy_list, p_min, p_max):
     '''
     Part of shrinking process, for ground-truth preparation.
@@ -1,5 +1,12 @@
 import numpy as np
-from shapely.geometry import Polygon
+
+import quad_iou
+
+try:
+    from shapely.geometry import Polygon
+except ImportError:
+    # the numpy engine in quad_iou does not need shapely
+    Polygon = None
 
 
 def cal_distance(point1, point2):
@@ -24,7 +31,7 @@ def helen_formula(coord):
     return area1 + area2
 
 
-def intersection(g, p):
+def shapely_intersection(g, p):
     g = Polygon(g[:8].reshape((4, 2)))
     p = Polygon(p[:8].reshape((4, 2)))
     if not g.is_valid or not p.is_valid:
@@ -37,6 +44,10 @@ def intersection(g, p):
         return inter/union
 
 
+def intersection(g, p):
+    return quad_iou.iou_single(g, p)
+
+
 def weighted_merge(g, p):
     #g[:8] = (g[8] * g[:8] + p[8] * p[:8])/(g[8] + p[8])
     area_g = helen_formula(g[:8])
@@ -66,78 +77,90 @@ def merge(g, p):
     return res_box
 
 
-def standard_nms(S, thres):
-    order = np.argsort(S[:, 8])[::-1]
+def _suppress(S, order, thres, backend):
+    if backend == 'shapely':
+        def overlaps(i, others):
+            return np.array([shapely_intersection(S[i], S[t]) for t in others])
+    else:
+        overlaps = quad_iou.QuadSet(S).iou
     keep = []
     while order.size > 0:
         i = order[0]
         keep.append(i)
-        ovr = np.array([intersection(S[i], S[t]) for t in order[1:]])
+        ovr = overlaps(i, order[1:])
 
         inds = np.where(ovr <= thres)[0]
         order = order[inds+1]
 
+    return keep
+
+
+def standard_nms(S, thres, backend='numpy'):
+    order = np.argsort(S[:, 8])[::-1]
+    keep = _suppress(S, order, thres, backend)
+
     return S[keep]
 
 
-def two_criterion_nms(S, thres):
+def two_criterion_nms(S, thres, backend='numpy'):
     S = S[np.argsort(S[:, 8])][::-1]    # order by score (higher better)
     order = np.argsort(S[:, 9])[::-1]   # order by rescore (higher better)
-    keep = []
-    while order.size > 0:
-        i = order[0]
-        keep.append(i)
-        ovr = np.array([intersection(S[i], S[t]) for t in order[1:]])
-
-        inds = np.where(ovr <= thres)[0]
-        order = order[inds+1]
+    keep = _suppress(S, order, thres, backend)
 
     return S[keep]
 
 
-def merge_nms(polys, thres):
-    '''
-    :param polys: a N*9 numpy array. first 8 coordinates, then prob
-    :return: boxes after nms
-    '''
+def _locality_merge(polys, thres, merge_fn, backend):
+    if backend == 'shapely':
+        pair_iou = shapely_intersection
+        prev_iou = None
+    else:
+        pair_iou = intersection
+        # IoU of every box with its predecessor, computed in one batch. It is
+        # only valid while the predecessor has not been merged into.
+        prev_iou = quad_iou.iou_pairwise(polys[1:], polys[:-1]) if len(polys) > 1 else []
     S = []
     p = None
-    for g in polys:
-        if p is not None and intersection(g, p) > thres:
-            p = merge(g, p)
+    merged = False
+    for k, g in enumerate(polys):
+        if p is not None and (pair_iou(g, p) if merged or prev_iou is None else prev_iou[k - 1]) > thres:
+            p = merge_fn(g, p)
+            merged = True
         else:
             if p is not None:
                 S.append(p)
             p = g
+            merged = False
     if p is not None:
         S.append(p)
+    return S
+
+
+def merge_nms(polys, thres, backend='numpy'):
+    '''
+    :param polys: a N*9 numpy array. first 8 coordinates, then prob
+    :param backend: 'numpy' for the batched quad_iou engine, 'shapely' for the reference path
+    :return: boxes after nms
+    '''
+    S = _locality_merge(polys, thres, merge, backend)
 
     if len(S) == 0:
         return np.array([])
-    return standard_nms(np.array(S), thres)
+    return standard_nms(np.array(S), thres, backend)
 
 
-def nms_locality(polys, thres=0.3):
+def nms_locality(polys, thres=0.3, backend='numpy'):
     '''
     locality aware nms of EAST
     :param polys: a N*9 numpy array. first 8 coordinates, then prob
+    :param backend: 'numpy' for the batched quad_iou engine, 'shapely' for the reference path
     :return: boxes after nms
     '''
-    S = []
-    p = None
-    for g in polys:
-        if p is not None and intersection(g, p) > thres:
-            p = weighted_merge(g, p)
-        else:
-            if p is not None:
-                S.append(p)
-            p = g
-    if p is not None:
-        S.append(p)
+    S = _locality_merge(polys, thres, weighted_merge, backend)
 
     if len(S) == 0:
         return np.array([])
-    return standard_nms(np.array(S), thres)
+    return standard_nms(np.array(S), thres, backend)
 
 
 if __name__ == '__main__':
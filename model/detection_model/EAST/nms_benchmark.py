@@ -0,0 +1,75 @@
+#coding=utf-8
+'''
+Compare the batched quad_iou NMS with the shapely path on synthetic EAST
+candidates. Usage:
+
+    python nms_benchmark.py --sizes 1000 10000 50000
+'''
+import argparse
+import time
+
+import numpy as np
+
+import locality_aware_nms as nms_locality
+
+
+def make_candidates(n, num_lines=40, seed=0):
+    '''
+    imitate restored geometry: every activated pixel of a text line predicts a
+    slightly jittered rotated rectangle around the line, rows sorted by y
+    '''
+    rng = np.random.RandomState(seed)
+    centers = rng.uniform(100, 1900, (num_lines, 2))
+    widths = rng.uniform(80, 400, num_lines)
+    heights = rng.uniform(15, 50, num_lines)
+    angles = rng.uniform(-0.3, 0.3, num_lines)
+
+    line = rng.randint(0, num_lines, n)
+    w = widths[line] * rng.uniform(0.9, 1.1, n)
+    h = heights[line] * rng.uniform(0.9, 1.1, n)
+    a = angles[line] + rng.normal(0, 0.02, n)
+    c = centers[line] + rng.normal(0, 3, (n, 2))
+
+    corners = np.array([[-0.5, -0.5], [0.5, -0.5], [0.5, 0.5], [-0.5, 0.5]])
+    pts = corners[None] * np.stack([w, h], axis=1)[:, None]
+    cos, sin = np.cos(a)[:, None], np.sin(a)[:, None]
+    xs = pts[..., 0] * cos - pts[..., 1] * sin + c[:, 0:1]
+    ys = pts[..., 0] * sin + pts[..., 1] * cos + c[:, 1:2]
+
+    boxes = np.zeros((n, 9), dtype=np.float32)
+    boxes[:, 0:8:2] = xs
+    boxes[:, 1:8:2] = ys
+    boxes[:, 8] = rng.uniform(0.8, 1.0, n)
+    return boxes[np.argsort(c[:, 1])]
+
+
+def run(fn, boxes, thres, backend):
+    start = time.time()
+    out = fn(boxes.copy(), thres, backend=backend)
+    return out, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--thres', type=float, default=0.3)
+    parser.add_argument('--skip_shapely_above', type=int, default=None,
+                        help='only time the numpy engine above this many boxes')
+    args = parser.parse_args()
+
+    for n in args.sizes:
+        boxes = make_candidates(n)
+        for name in ['nms_locality', 'merge_nms', 'standard_nms']:
+            fn = getattr(nms_locality, name)
+            fast, t_fast = run(fn, boxes, args.thres, 'numpy')
+            if args.skip_shapely_above is not None and n > args.skip_shapely_above:
+                print('{:>6d} boxes {:<13s} numpy {:8.3f}s'.format(n, name, t_fast))
+                continue
+            ref, t_ref = run(fn, boxes, args.thres, 'shapely')
+            same = ref.shape == fast.shape and np.allclose(ref, fast)
+            print('{:>6d} boxes {:<13s} shapely {:8.3f}s  numpy {:8.3f}s  speedup {:6.1f}x  same: {}'.format(
+                n, name, t_ref, t_fast, t_ref / max(t_fast, 1e-9), same))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+import numpy as np
+
+
+'''
+Batched quadrilateral IoU used by the NMS in locality_aware_nms.py.
+
+Every quad is split into two triangles along a diagonal that stays inside the
+quad (the one starting at the reflex vertex for concave quads), so the
+intersection of two quads is the sum of four convex triangle/triangle
+intersections. These are clipped with Sutherland-Hodgman on fixed size
+arrays, which lets one box be compared against many boxes without building a
+shapely Polygon per pair. Self-intersecting or degenerate quads get an IoU of
+0, the same as the shapely path (`Polygon.is_valid`).
+'''
+
+
+def _cross(o, a, b):
+    return (a[..., 0] - o[..., 0]) * (b[..., 1] - o[..., 1]) - \
+           (a[..., 1] - o[..., 1]) * (b[..., 0] - o[..., 0])
+
+
+def signed_areas(quads):
+    '''
+    :param quads: a N*4*2 array
+    :return: signed area of each quad (positive for counter-clockwise)
+    '''
+    x = quads[..., 0]
+    y = quads[..., 1]
+    return 0.5 * np.sum(x * np.roll(y, -1, axis=-1) - np.roll(x, -1, axis=-1) * y, axis=-1)
+
+
+def _segments_cross(p1, p2, q1, q2):
+    d1 = _cross(q1, q2, p1)
+    d2 = _cross(q1, q2, p2)
+    d3 = _cross(p1, p2, q1)
+    d4 = _cross(p1, p2, q2)
+    return (d1 * d2 < 0) & (d3 * d4 < 0)
+
+
+def valid_quads(quads, areas=None):
+    '''
+    a quad is valid when it is not self-intersecting and has a non-zero area
+    '''
+    if areas is None:
+        areas = signed_areas(quads)
+    bowtie = _segments_cross(quads[:, 0], quads[:, 1], quads[:, 2], quads[:, 3]) | \
+        _segments_cross(quads[:, 1], quads[:, 2], quads[:, 3], quads[:, 0])
+    return ~bowtie & (areas != 0)
+
+
+def split_triangles(quads, areas=None):
+    '''
+    :param quads: a N*4*2 array
+    :return: a N*2*3*2 array of counter-clockwise triangles covering each quad
+    '''
+    if areas is None:
+        areas = signed_areas(quads)
+    n = quads.shape[0]
+    corner = _cross(np.roll(quads, 1, axis=1), quads, np.roll(quads, -1, axis=1))
+    reflex = corner * np.sign(areas)[:, None] < 0
+    # split along the diagonal starting at the reflex vertex (vertex 0 if convex)
+    start = np.where(reflex.any(axis=1), np.argmax(reflex, axis=1), 0)
+    order = (start[:, None] + np.array([0, 1, 2, 0, 2, 3])[None, :]) % 4
+    tris = quads[np.arange(n)[:, None], order].reshape((n, 2, 3, 2))
+    flip = _cross(tris[:, :, 0], tris[:, :, 1], tris[:, :, 2]) < 0
+    tris[flip] = tris[flip][:, [0, 2, 1]]
+    return tris
+
+
+def _clip_halfplane(pts, cnt, a, b):
+    '''
+    clip convex polygons (pts: M*V*2, with cnt valid vertices each) by the
+    left side of the directed edges a->b (M*2)
+    '''
+    m, v = pts.shape[:2]
+    idx = np.arange(v)[None, :]
+    alive = idx < cnt[:, None]
+    nxt_idx = (idx + 1) % np.maximum(cnt, 1)[:, None]
+    nxt = pts[np.arange(m)[:, None], nxt_idx]
+
+    s_cur = _cross(a[:, None], b[:, None], pts)
+    s_nxt = _cross(a[:, None], b[:, None], nxt)
+    in_cur = s_cur >= 0
+    in_nxt = s_nxt >= 0
+
+    denom = s_cur - s_nxt
+    t = np.divide(s_cur, denom, out=np.zeros_like(s_cur), where=denom != 0)
+    inter = pts + t[..., None] * (nxt - pts)
+
+    cand = np.stack([pts, inter], axis=2).reshape((m, 2 * v, 2))
+    keep = np.stack([in_cur & alive, (in_cur != in_nxt) & alive], axis=2).reshape((m, 2 * v))
+    order = np.argsort(~keep, axis=1, kind='stable')[:, :v + 1]
+    out = cand[np.arange(m)[:, None], order]
+    return out, keep.sum(axis=1)
+
+
+def triangle_intersection_areas(t1, t2):
+    '''
+    :param t1, t2: M*3*2 arrays of counter-clockwise triangles
+    :return: area of the intersection of each pair
+    '''
+    pts = t1
+    cnt = np.full(t1.shape[0], 3)
+    for k in range(3):
+        pts, cnt = _clip_halfplane(pts, cnt, t2[:, k], t2[:, (k + 1) % 3])
+    v = pts.shape[1]
+    idx = np.arange(v)[None, :]
+    nxt = pts[np.arange(pts.shape[0])[:, None], (idx + 1) % np.maximum(cnt, 1)[:, None]]
+    term = pts[..., 0] * nxt[..., 1] - nxt[..., 0] * pts[..., 1]
+    return 0.5 * np.sum(np.where(idx < cnt[:, None], term, 0), axis=1)
+
+
+class QuadSet(object):
+    '''
+    precomputed triangles, areas, validity and bounding boxes of N quads, so
+    that the IoU of one member against many others can be queried repeatedly
+    '''
+
+    def __init__(self, polys):
+        polys = np.asarray(polys, dtype=np.float64)
+        self.quads = polys[:, :8].reshape((-1, 4, 2))
+        signed = signed_areas(self.quads)
+        self.areas = np.abs(signed)
+        self.valid = valid_quads(self.quads, signed)
+        self.tris = split_triangles(self.quads, signed)
+        self.mins = self.quads.min(axis=1)
+        self.maxs = self.quads.max(axis=1)
+
+    def __len__(self):
+        return self.quads.shape[0]
+
+    def pair_iou(self, first, second):
+        '''
+        :param first, second: index arrays of equal length
+        :return: IoU of quads first[k] and second[k] for every k
+        '''
+        first = np.asarray(first, dtype=np.int64)
+        second = np.asarray(second, dtype=np.int64)
+        ious = np.zeros(first.shape[0])
+        # only clip pairs whose bounding boxes overlap
+        hit = self.valid[first] & self.valid[second] & \
+            np.all(self.mins[second] <= self.maxs[first], axis=1) & \
+            np.all(self.maxs[second] >= self.mins[first], axis=1)
+        a = first[hit]
+        b = second[hit]
+        if a.shape[0] == 0:
+            return ious
+        t1 = self.tris[a][:, [0, 0, 1, 1]].reshape((-1, 3, 2))
+        t2 = self.tris[b][:, [0, 1, 0, 1]].reshape((-1, 3, 2))
+        inter = triangle_intersection_areas(t1, t2).reshape((-1, 4)).sum(axis=1)
+        union = self.areas[a] + self.areas[b] - inter
+        ious[hit] = np.divide(inter, union, out=np.zeros_like(inter), where=union != 0)
+        return ious
+
+    def iou(self, i, others):
+        '''
+        :param i: index of the reference quad
+        :param others: index array of the quads to compare with
+        :return: IoU of quad i with each of the others
+        '''
+        others = np.asarray(others, dtype=np.int64)
+        return self.pair_iou(np.full(others.shape[0], i, dtype=np.int64), others)
+
+
+def iou_one_to_many(g, polys):
+    '''
+    :param g: a quad, first 8 values are its coordinates
+    :param polys: a N*8 (or wider) array of quads
+    :return: IoU of g with every row of polys
+    '''
+    polys = np.asarray(polys, dtype=np.float64)
+    if polys.shape[0] == 0:
+        return np.zeros(0)
+    stacked = np.concatenate([np.asarray(g, dtype=np.float64)[None, :8], polys[:, :8]], axis=0)
+    return QuadSet(stacked).iou(0, np.arange(1, stacked.shape[0]))
+
+
+def _as_points(q):
+    return [(float(q[0]), float(q[1])), (float(q[2]), float(q[3])),
+            (float(q[4]), float(q[5])), (float(q[6]), float(q[7]))]
+
+
+def _polygon_area(pts):
+    s = 0.0
+    for k in range(len(pts)):
+        x1, y1 = pts[k - 1]
+        x2, y2 = pts[k]
+        s += x1 * y2 - x2 * y1
+    return 0.5 * s
+
+
+def _is_convex(pts, sign):
+    for k in range(4):
+        (ox, oy), (ax, ay), (bx, by) = pts[k - 1], pts[k], pts[(k + 1) % 4]
+        if ((ax - ox) * (by - oy) - (ay - oy) * (bx - ox)) * sign < 0:
+            return False
+    return True
+
+
+def iou_single(g, p):
+    '''
+    scalar IoU of two quads for the sequential merge loop, where building
+    arrays for a single pair costs more than the geometry itself. Pairs with a
+    concave quad go through the batched engine.
+    '''
+    g_pts = _as_points(g)
+    p_pts = _as_points(p)
+    g_area = _polygon_area(g_pts)
+    p_area = _polygon_area(p_pts)
+    if g_area == 0 or p_area == 0:
+        return 0.0
+    g_sign = 1 if g_area > 0 else -1
+    p_sign = 1 if p_area > 0 else -1
+    if not (_is_convex(g_pts, g_sign) and _is_convex(p_pts, p_sign)):
+        return float(iou_one_to_many(g, np.asarray(p)[None])[0])
+    if max(x for x, _ in g_pts) < min(x for x, _ in p_pts) or \
+            max(x for x, _ in p_pts) < min(x for x, _ in g_pts) or \
+            max(y for _, y in g_pts) < min(y for _, y in p_pts) or \
+            max(y for _, y in p_pts) < min(y for _, y in g_pts):
+        return 0.0
+    if p_sign < 0:
+        p_pts = p_pts[::-1]
+
+    out = g_pts
+    for k in range(4):
+        if not out:
+            break
+        ax, ay = p_pts[k]
+        bx, by = p_pts[(k + 1) % 4]
+        ex, ey = bx - ax, by - ay
+        pts = out
+        out = []
+        for i in range(len(pts)):
+            cx, cy = pts[i]
+            nx, ny = pts[(i + 1) % len(pts)]
+            s_cur = ex * (cy - ay) - ey * (cx - ax)
+            s_nxt = ex * (ny - ay) - ey * (nx - ax)
+            if s_cur >= 0:
+                out.append((cx, cy))
+            if (s_cur >= 0) != (s_nxt >= 0):
+                t = s_cur / (s_cur - s_nxt)
+                out.append((cx + t * (nx - cx), cy + t * (ny - cy)))
+    inter = abs(_polygon_area(out)) if len(out) > 2 else 0.0
+    union = abs(g_area) + abs(p_area) - inter
+    if union == 0:
+        return 0.0
+    return inter / union
+
+
+def iou_pairwise(polys1, polys2):
+    '''
+    :param polys1, polys2: two N*8 (or wider) arrays of quads
+    :return: IoU of polys1[k] and polys2[k] for every k
+    '''
+    polys1 = np.asarray(polys1, dtype=np.float64)
+    polys2 = np.asarray(polys2, dtype=np.float64)
+    n = polys1.shape[0]
+    if n == 0:
+        return np.zeros(0)
+    qs = QuadSet(np.concatenate([polys1[:, :8], polys2[:, :8]], axis=0))
+    return qs.pair_iou(np.arange(n), np.arange(n, 2 * n))
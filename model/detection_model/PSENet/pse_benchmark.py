@@ -0,0 +1,66 @@
+'''
+Timing harness for the python PSE: compares the frontier based pypse.pse with
+the pixel queue reference pypse.pse_bfs on synthetic kernel stacks and checks
+that both produce the same label map. Usage:
+
+    python pse_benchmark.py --sizes 256 512 1024 --kernel_nums 3 7
+'''
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from pypse import pse, pse_bfs
+
+
+def make_kernels(size, kernel_num, text_num=30, seed=0):
+    '''
+    random text-like rotated rectangles, the i-th kernel shrunk by i pixels,
+    stacked from the full text map (index 0) to the smallest kernel
+    '''
+    rng = np.random.RandomState(seed)
+    text = np.zeros((size, size), dtype=np.uint8)
+    for _ in range(text_num):
+        center = tuple(rng.uniform(0, size, 2))
+        box_size = (rng.uniform(size / 20., size / 4.), rng.uniform(size / 60., size / 15.))
+        box = cv2.boxPoints((center, box_size, rng.uniform(-30, 30)))
+        cv2.fillPoly(text, [box.astype(np.int32)], 1)
+    shrink = max(1, size // 256)
+    kernel = np.ones((2 * shrink + 1, 2 * shrink + 1), dtype=np.uint8)
+    kernels = [text]
+    for _ in range(1, kernel_num):
+        kernels.append(cv2.erode(kernels[-1], kernel))
+    return np.stack(kernels)
+
+
+def timeit(fn, kernels, min_area, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        out = fn(kernels, min_area)
+        cost = time.time() - start
+        best = cost if best is None else min(best, cost)
+    return out, best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512, 1024])
+    parser.add_argument('--kernel_nums', type=int, nargs='+', default=[3, 7])
+    parser.add_argument('--text_num', type=int, default=30)
+    parser.add_argument('--min_area', type=float, default=5.0)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        for kernel_num in args.kernel_nums:
+            kernels = make_kernels(size, kernel_num, args.text_num)
+            fast, t_fast = timeit(pse, kernels, args.min_area, args.repeat)
+            ref, t_ref = timeit(pse_bfs, kernels, args.min_area, 1)
+            print('{:>5d}x{:<5d} kernels {:2d}  bfs {:8.3f}s  frontier {:8.3f}s  speedup {:6.1f}x  same: {}'.format(
+                size, size, kernel_num, t_ref, t_fast, t_ref / max(t_fast, 1e-9), np.array_equal(ref, fast)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,56 +1,109 @@
 import numpy as np
 import cv2
-import Queue
+from collections import deque
+
+# 4-neighbourhood in the order the original queue based expansion visits it
+dx = np.array([-1, 1, 0, 0])
+dy = np.array([0, 0, -1, 1])
+
+
+def kernel_labels(kernal, min_area):
+    # connected components of the smallest kernel, small ones filtered with one bincount
+    label_num, label = cv2.connectedComponents(kernal, connectivity=4)
+    area = np.bincount(label.ravel(), minlength=label_num)
+    small = area < min_area
+    small[0] = False
+    label[small[label]] = 0
+    return label
+
 
 def pse(kernals, min_area):
+    '''
+    progressive scale expansion, one whole BFS frontier at a time.
+
+    A pixel reached by several frontier points goes to the one that comes first
+    in queue order, and the next frontier keeps the order a FIFO queue would
+    give (parent order, then dx/dy order), so the result is the same label map
+    as pse_bfs.
+    '''
+    kernal_num = len(kernals)
+    label = kernel_labels(kernals[kernal_num - 1], min_area)
+    h, w = label.shape
+    pred = label.astype('int32')
+
+    xs, ys = np.where(pred > 0)
+    ls = pred[xs, ys]
+
+    for kernal_idx in range(kernal_num - 2, -1, -1):
+        if xs.size == 0:
+            break
+        kernal = kernals[kernal_idx]
+        edges = []
+        while xs.size > 0:
+            nx = xs[:, None] + dx[None, :]
+            ny = ys[:, None] + dy[None, :]
+            inside = (nx >= 0) & (nx < h) & (ny >= 0) & (ny < w)
+            cand = np.flatnonzero(inside)
+            cx, cy = nx.ravel()[cand], ny.ravel()[cand]
+            free = (kernal[cx, cy] != 0) & (pred[cx, cy] == 0)
+            cand, cx, cy = cand[free], cx[free], cy[free]
+
+            # the first candidate in queue order wins every contested pixel
+            _, first = np.unique(cx * w + cy, return_index=True)
+            first.sort()
+            won = cand[first]
+            parent = won // 4
+
+            is_edge = np.ones(xs.size, dtype=bool)
+            is_edge[parent] = False
+            edges.append((xs[is_edge], ys[is_edge], ls[is_edge]))
+
+            xs, ys, ls = cx[first], cy[first], ls[parent]
+            pred[xs, ys] = ls
+
+        xs = np.concatenate([e[0] for e in edges])
+        ys = np.concatenate([e[1] for e in edges])
+        ls = np.concatenate([e[2] for e in edges])
+
+    return pred
+
+
+def pse_bfs(kernals, min_area):
+    '''
+    reference implementation expanding one pixel at a time with a FIFO queue
+    '''
     kernal_num = len(kernals)
-    pred = np.zeros(kernals[0].shape, dtype='int32')
-    
-    label_num, label = cv2.connectedComponents(kernals[kernal_num - 1], connectivity=4)  #return the number of connected components(different connected components have different label,the smallest kernel
-    
-    for label_idx in range(1, label_num):
-        if np.sum(label == label_idx) < min_area:  #filter small connected components
-            label[label == label_idx] = 0
-
-    queue = Queue.Queue(maxsize = 0)# store all the points and corresbond labels(x,y,label)
-    next_queue = Queue.Queue(maxsize = 0)
+    label = kernel_labels(kernals[kernal_num - 1], min_area)
+    pred = label.astype('int32')
+
+    queue = deque()  # store all the points and corresbond labels(x,y,label)
+    next_queue = deque()
     points = np.array(np.where(label > 0)).transpose((1, 0))
-    
+
     for point_idx in range(points.shape[0]):
         x, y = points[point_idx, 0], points[point_idx, 1]
-        l = label[x, y]
-        queue.put((x, y, l))
-        pred[x, y] = l
+        queue.append((x, y, label[x, y]))
 
-    dx = [-1, 1, 0, 0]
-    dy = [0, 0, -1, 1]
     for kernal_idx in range(kernal_num - 2, -1, -1):
-        kernal = kernals[kernal_idx].copy()
-        while not queue.empty():
-            (x, y, l) = queue.get()
+        kernal = kernals[kernal_idx]
+        while queue:
+            (x, y, l) = queue.popleft()
 
             is_edge = True
             for j in range(4):
                 tmpx = x + dx[j]
-                tmpy = y + dy[j] #adjacent points
+                tmpy = y + dy[j]  # adjacent points
                 if tmpx < 0 or tmpx >= kernal.shape[0] or tmpy < 0 or tmpy >= kernal.shape[1]:
                     continue
                 if kernal[tmpx, tmpy] == 0 or pred[tmpx, tmpy] > 0:
                     continue
 
-                queue.put((tmpx, tmpy, l))
+                queue.append((tmpx, tmpy, l))
                 pred[tmpx, tmpy] = l
                 is_edge = False
             if is_edge:
-                next_queue.put((x, y, l))
-        
-        # kernal[pred > 0] = 0
+                next_queue.append((x, y, l))
+
         queue, next_queue = next_queue, queue
-        
-        # points = np.array(np.where(pred > 0)).transpose((1, 0))
-        # for point_idx in range(points.shape[0]):
-        #     x, y = points[point_idx, 0], points[point_idx, 1]
-        #     l = pred[x, y]
-        #     queue.put((x, y, l))
-
-    return pred
\ No newline at end of file
+
+    return pred
@@ -36,89 +36,123 @@ def mask_to_box(pixel_mask, link_mask, neighbors=8, scale=4):
             if distance(point, bounding_box[(i+1)%4]) < 5**2:
                 return True  # ignore it
         return False  # do not ignore
-    batch_size = link_mask.size(0)
-    mask_height = link_mask.size(2)
-    mask_width = link_mask.size(3)
-    pixel_class = nn.Softmax2d()(pixel_mask)
-    pixel_class = pixel_class[:, 1] > 0.7
-    link_neighbors = torch.zeros([batch_size, neighbors, mask_height, mask_width], \
-                                    dtype=torch.uint8, device=pixel_mask.device)
-    
-    for i in range(neighbors):
-        tmp = nn.Softmax2d()(link_mask[:, [2 * i, 2 * i + 1]])
-        link_neighbors[:, i] = tmp[:, 1] > 0.7
-        link_neighbors[:, i] = link_neighbors[:, i] & pixel_class
+    pixel_class, link_neighbors = mask_filter(pixel_mask, link_mask, neighbors, scale)
+    all_labels = link_components(pixel_class, link_neighbors)
     all_boxes = []
-    for i in range(batch_size):
-        res_mask = func(pixel_class[i], link_neighbors[i])
-        box_num = np.amax(res_mask)
+    for res_mask in all_labels:
         bounding_boxes = []
-        for i in range(1, box_num + 1):
-            box_mask = (res_mask == i).astype(np.uint8)
-            if box_mask.sum() < 100:
-                pass
-            box_mask, contours, _ = cv2.findContours(box_mask, mode=cv2.RETR_EXTERNAL, method=cv2.CHAIN_APPROX_NONE)
-            bounding_box = cv2.minAreaRect(contours[0])
+        for contour in component_contours(res_mask):
+            bounding_box = cv2.minAreaRect(contour)
             bounding_box = cv2.boxPoints(bounding_box)
             if short_side_filter(bounding_box):
-                pass
                 continue
-            bounding_box = np.clip(bounding_box * scale, 0, 128 * scale - 1).astype(np.int)
+            bounding_box = np.clip(bounding_box * scale, 0, 128 * scale - 1).astype(int)
             bounding_boxes.append(bounding_box)
         all_boxes.append(bounding_boxes)
     return all_boxes
 
+# (dh, dw) of the 8 link channels, same order as get_neighbors
+NEIGHBOR_OFFSETS = [(-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1)]
+
 def get_neighbors(h_index, w_index):
-    res = []
-    res.append((h_index - 1, w_index - 1))
-    res.append((h_index - 1, w_index))
-    res.append((h_index - 1, w_index + 1))
-    res.append((h_index, w_index + 1))
-    res.append((h_index + 1, w_index + 1))
-    res.append((h_index + 1, w_index))
-    res.append((h_index + 1, w_index - 1))
-    res.append((h_index, w_index - 1))
-    return res
+    return [(h_index + dh, w_index + dw) for dh, dw in NEIGHBOR_OFFSETS]
 
-def func(pixel_cls, link_cls):
-    def joint(pointa, pointb):
-        roota = find_root(pointa)
-        rootb = find_root(pointb)
-        if roota != rootb:
-            group_mask[rootb] = roota
-        return
+def link_components(pixel_cls, link_cls):
+    """
+    Connected components of positive pixels joined by positive links, for a
+    whole batch at once. Union-find runs on a flat parent array over the
+    positive pixels (hooking roots onto the smaller root, then pointer jumping)
+    instead of a dict keyed by (h, w) tuples.
+    pixel_cls: batch_size * H * W (or H * W), bool
+    link_cls: batch_size * 8 * H * W (or 8 * H * W)
+    return: int32 labels of the same shape as pixel_cls, components numbered
+            from 1 per image in raster order of their first pixel
+    """
+    pixel_cls = np.asarray(pixel_cls).astype(bool)
+    link_cls = np.asarray(link_cls).astype(bool)
+    single = pixel_cls.ndim == 2
+    if single:
+        pixel_cls = pixel_cls[None]
+        link_cls = link_cls[None]
+    batch_size, h, w = pixel_cls.shape
 
-    def find_root(pointa):
-        root = pointa
-        while group_mask.get(root) != -1:
-            root = group_mask.get(root)
-        return root
+    pos = np.flatnonzero(pixel_cls)
+    node = np.full(pixel_cls.size, -1, dtype=np.int64)
+    node[pos] = np.arange(pos.size)
+    node = node.reshape(pixel_cls.shape)
 
-    pixel_cls = pixel_cls.cpu().numpy()
-    link_cls = link_cls.cpu().numpy()
+    src_list, dst_list = [], []
+    for i, (dh, dw) in enumerate(NEIGHBOR_OFFSETS):
+        hs = slice(max(0, -dh), h - max(0, dh))
+        ws = slice(max(0, -dw), w - max(0, dw))
+        hn = slice(max(0, dh), h - max(0, -dh))
+        wn = slice(max(0, dw), w - max(0, -dw))
+        linked = pixel_cls[:, hs, ws] & link_cls[:, i, hs, ws] & pixel_cls[:, hn, wn]
+        src_list.append(node[:, hs, ws][linked])
+        dst_list.append(node[:, hn, wn][linked])
+    src = np.concatenate(src_list)
+    dst = np.concatenate(dst_list)
 
-    pixel_points = list(zip(*np.where(pixel_cls)))
-    h, w = pixel_cls.shape
-    group_mask = dict.fromkeys(pixel_points, -1)
+    parent = np.arange(pos.size)
+    while True:
+        root_src = parent[src]
+        root_dst = parent[dst]
+        differ = root_src != root_dst
+        if not differ.any():
+            break
+        src, dst = src[differ], dst[differ]
+        root_src, root_dst = root_src[differ], root_dst[differ]
+        np.minimum.at(parent, np.maximum(root_src, root_dst), np.minimum(root_src, root_dst))
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
 
-    for point in pixel_points:
-        h_index, w_index = point
-        neighbors = get_neighbors(h_index, w_index)
-        for i, neighbor in enumerate(neighbors):
-            nh_index, nw_index = neighbor
-            if nh_index < 0 or nw_index < 0 or nh_index >= h or nw_index >= w:
-                continue
-            if pixel_cls[nh_index, nw_index] == 1 and link_cls[i, h_index, w_index] == 1:
-                joint(point, neighbor)
+    # renumber roots per image by the raster order of their first pixel
+    roots, first, inverse = np.unique(parent, return_index=True, return_inverse=True)
+    rank = np.empty(roots.size, dtype=np.int64)
+    rank[np.argsort(first, kind='stable')] = np.arange(roots.size)
+    image = pos[first] // (h * w)
+    offsets = np.cumsum(np.bincount(image, minlength=batch_size)) - np.bincount(image, minlength=batch_size)
+    label = rank - offsets[image] + 1
 
-    res = np.zeros(pixel_cls.shape, dtype=np.uint8)
-    root_map = {}
-    for point in pixel_points:
-        h_index, w_index = point
-        root = find_root(point)
-        if root not in root_map:
-            root_map[root] = len(root_map) + 1
-        res[h_index, w_index] = root_map[root]
+    res = np.zeros(pixel_cls.size, dtype=np.int32)
+    res[pos] = label[inverse.reshape(-1)]
+    res = res.reshape(pixel_cls.shape)
+    return res[0] if single else res
 
-    return res
+def component_contours(labels):
+    """
+    outer contour of every component of a label map, in label order. Bounding
+    boxes of all labels come from one pass over the positive pixels, so each
+    contour is traced on its own crop instead of a full-image mask per label.
+    """
+    ys, xs = np.nonzero(labels)
+    if ys.size == 0:
+        return []
+    ids = labels[ys, xs]
+    order = np.argsort(ids, kind='stable')
+    ids, ys, xs = ids[order], ys[order], xs[order]
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    y0s = np.minimum.reduceat(ys, starts)
+    y1s = np.maximum.reduceat(ys, starts)
+    x0s = np.minimum.reduceat(xs, starts)
+    x1s = np.maximum.reduceat(xs, starts)
+    contours = []
+    for k, start in enumerate(starts):
+        y0, y1, x0, x1 = y0s[k], y1s[k], x0s[k], x1s[k]
+        # keep a zero border around the crop for the contour tracer
+        crop = np.zeros((y1 - y0 + 3, x1 - x0 + 3), dtype=np.uint8)
+        crop[1:-1, 1:-1] = labels[y0:y1 + 1, x0:x1 + 1] == ids[start]
+        found = cv2.findContours(crop, mode=cv2.RETR_EXTERNAL, method=cv2.CHAIN_APPROX_NONE,
+                                 offset=(int(x0) - 1, int(y0) - 1))[-2]
+        contours.append(found[0])
+    return contours
 
+def func(pixel_cls, link_cls):
+    if torch.is_tensor(pixel_cls):
+        pixel_cls = pixel_cls.cpu().numpy()
+    if torch.is_tensor(link_cls):
+        link_cls = link_cls.cpu().numpy()
+    return link_components(pixel_cls, link_cls).astype(np.uint8)
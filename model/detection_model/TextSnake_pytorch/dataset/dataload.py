@@ -1,5 +1,6 @@
 import cv2
 import os
+import time
 import torch.utils.data as data
 import scipy.io as io
 import numpy as np
@@ -7,7 +8,7 @@ from PIL import Image
 from model.detection_model.TextSnake_pytorch.util.config import config as cfg
 from skimage.draw import polygon as drawpoly
 from model.detection_model.TextSnake_pytorch.util.misc import find_bottom, find_long_edges, split_edge_seqence, \
-    norm2, vector_cos, vector_sin
+    norm2
 
 
 class TextInstance(object):
@@ -125,8 +126,17 @@ class TextDataset(data.Dataset):
         rr, cc = drawpoly(polygon[:, 1], polygon[:, 0], shape=(mask.shape[0], mask.shape[1]))
         mask[rr, cc] = value
 
-    def make_text_center_line(self, sideline1, sideline2, center_line, radius, \
-                              tcl_mask, radius_map, sin_map, cos_map, expand=0.2, shrink=5):
+    def center_line_segments(self, sideline1, sideline2, center_line, radius, expand=0.2, shrink=5):
+        """
+        quads of the text center line segments and their target values
+        Args:
+            sideline1, sideline2, center_line, radius: output of TextInstance.disk_cover
+            expand: expand ratio of the center line towards the sidelines
+            shrink: number of disks skipped at both line ends
+
+        Returns:
+            quads (n, 4, 2), radius (n,), sin (n,), cos (n,)
+        """
 
         # TODO: shrink 1/2 * radius at two line end
         while len(center_line)-1 - shrink < 0 or shrink > len(center_line):
@@ -136,31 +146,60 @@ class TextDataset(data.Dataset):
             shrink -= 1
             shrink = shrink if shrink > 0 else 1
 
-        for i in range(shrink, len(center_line) - 1 - shrink):
-            c1 = center_line[i]
-            c2 = center_line[i + 1]
-            top1 = sideline1[i]
-            top2 = sideline1[i + 1]
-            bottom1 = sideline2[i]
-            bottom2 = sideline2[i + 1]
+        index = np.arange(shrink, len(center_line) - 1 - shrink)
+        c1 = center_line[index]
+        c2 = center_line[index + 1]
+        top1 = sideline1[index]
+        top2 = sideline1[index + 1]
+        bottom1 = sideline2[index]
+        bottom2 = sideline2[index + 1]
+
+        # vector_sin / vector_cos of every segment
+        direction = c2 - c1
+        length = np.sqrt(direction[:, 0] ** 2 + direction[:, 1] ** 2)
+        sin_theta = direction[:, 1] / length
+        cos_theta = direction[:, 0] / length
+
+        p1 = c1 + (top1 - c1) * expand
+        p2 = c1 + (bottom1 - c1) * expand
+        p3 = c2 + (bottom2 - c2) * expand
+        p4 = c2 + (top2 - c2) * expand
+        quads = np.stack([p1, p2, p3, p4], axis=1)
+
+        return quads, np.asarray(radius)[index], sin_theta, cos_theta
+
+    def fill_center_line(self, segments, tcl_mask, radius_map, sin_map, cos_map):
+        """
+        rasterize every segment quad once into an index map, later segments
+        overwrite earlier ones, then fill the four target maps from it
+        Args:
+            segments: list of center_line_segments outputs
+        """
+        if len(segments) == 0:
+            return
+        quads, radius, sin_theta, cos_theta = [np.concatenate(item) for item in zip(*segments)]
 
-            sin_theta = vector_sin(c2 - c1)
-            cos_theta = vector_cos(c2 - c1)
+        index_map = np.full(tcl_mask.shape, -1, dtype=np.int32)
+        for k, polygon in enumerate(quads):
+            self.fill_polygon(index_map, polygon, value=k)
 
-            p1 = c1 + (top1 - c1) * expand
-            p2 = c1 + (bottom1 - c1) * expand
-            p3 = c2 + (bottom2 - c2) * expand
-            p4 = c2 + (top2 - c2) * expand
-            polygon = np.stack([p1, p2, p3, p4])
+        inside = index_map >= 0
+        index = index_map[inside]
+        tcl_mask[inside] = 1
+        radius_map[inside] = radius[index]
+        sin_map[inside] = sin_theta[index]
+        cos_map[inside] = cos_theta[index]
+
+    def make_text_center_line(self, sideline1, sideline2, center_line, radius, \
+                              tcl_mask, radius_map, sin_map, cos_map, expand=0.2, shrink=5):
 
-            self.fill_polygon(tcl_mask, polygon, value=1)
-            self.fill_polygon(radius_map, polygon, value=radius[i])
-            self.fill_polygon(sin_map, polygon, value=sin_theta)
-            self.fill_polygon(cos_map, polygon, value=cos_theta)
+        segments = self.center_line_segments(sideline1, sideline2, center_line, radius, expand, shrink)
+        self.fill_center_line([segments], tcl_mask, radius_map, sin_map, cos_map)
 
     def get_training_data(self, image, polygons, image_id, image_path, image_shape):
 
         H, W, _ = image_shape
+        start = time.time()
 
         # if self.transform:
         #     image, polygons = self.transform(image, copy.copy(polygons))
@@ -174,11 +213,13 @@ class TextDataset(data.Dataset):
         sin_map = np.zeros(image.shape[:2], np.float32)
         cos_map = np.zeros(image.shape[:2], np.float32)
 
+        segments = []
         for i, polygon in enumerate(polygons):
             if polygon.text != '###' and polygon.text != '#':
                 if len(polygon.e1) > 0 and len(polygon.e2) > 0:
                     sideline1, sideline2, center_points, radius = polygon.disk_cover(n_disk=cfg.n_disk)
-                    self.make_text_center_line(sideline1, sideline2, center_points, radius, tcl_mask, radius_map, sin_map, cos_map)
+                    segments.append(self.center_line_segments(sideline1, sideline2, center_points, radius))
+        self.fill_center_line(segments, tcl_mask, radius_map, sin_map, cos_map)
         tr_mask, train_mask, illegal_mask = self.make_text_region(image, polygons)
 
         # to pytorch channel sequence
@@ -189,7 +230,9 @@ class TextDataset(data.Dataset):
             'image_path': image_path,
             'Height': H,
             'Width': W,
-            'illegal_mask': illegal_mask
+            'illegal_mask': illegal_mask,
+            # seconds spent generating the training targets of this sample
+            'target_time': time.time() - start
         }
         return image, train_mask, tr_mask, tcl_mask, radius_map, sin_map, cos_map, meta
 
@@ -2,6 +2,7 @@ import numpy as np
 import cv2
 from skimage.measure import find_contours
 import pycocotools.mask as maskUtils
+from model.detection_model.TextSnake_pytorch.util.misc import polygon_roi
 
 
 def to_poly(rle):
@@ -67,6 +68,44 @@ def get_mask(box, shape):
     return tmp_mask, cv2.countNonZero(tmp_mask)
 
 
+def roi_intersection(roi_a, roi_b):
+    """
+    count the pixels shared by two masks cropped to their bounding boxes, see polygon_roi
+    """
+    xa, ya, mask_a = roi_a
+    xb, yb, mask_b = roi_b
+    x0, y0 = max(xa, xb), max(ya, yb)
+    x1 = min(xa + mask_a.shape[1], xb + mask_b.shape[1])
+    y1 = min(ya + mask_a.shape[0], yb + mask_b.shape[0])
+    if x1 <= x0 or y1 <= y0:
+        return 0
+    crop_a = mask_a[y0 - ya:y1 - ya, x0 - xa:x1 - xa]
+    crop_b = mask_b[y0 - yb:y1 - yb, x0 - xb:x1 - xb]
+    return np.count_nonzero(crop_a & crop_b)
+
+
+def roi_union(roi_a, roi_b):
+    """
+    merge two cropped masks
+
+    Returns:
+        the outer contour of the union in image coordinates and its area
+    """
+    xa, ya, mask_a = roi_a
+    xb, yb, mask_b = roi_b
+    x0, y0 = min(xa, xb), min(ya, yb)
+    x1 = max(xa + mask_a.shape[1], xb + mask_b.shape[1])
+    y1 = max(ya + mask_a.shape[0], yb + mask_b.shape[0])
+    # one pixel of padding, same as padding the full image
+    padded_mask = np.zeros((y1 - y0 + 2, x1 - x0 + 2), dtype=np.uint8)
+    padded_mask[ya - y0 + 1:ya - y0 + 1 + mask_a.shape[0], xa - x0 + 1:xa - x0 + 1 + mask_a.shape[1]] = mask_a
+    region_b = padded_mask[yb - y0 + 1:yb - y0 + 1 + mask_b.shape[0], xb - x0 + 1:xb - x0 + 1 + mask_b.shape[1]]
+    np.bitwise_or(region_b, mask_b, out=region_b)
+    contours = find_contours(padded_mask, 0.5)
+    poly = (np.fliplr(contours[0]) + (x0, y0)).astype(np.int32).tolist()
+    return poly, np.count_nonzero(padded_mask)
+
+
 def comput_mmi(area_a, area_b, intersect):
     """
     calculate MMI
@@ -115,27 +154,30 @@ def mask_nms(polygons, shape, mmi_thres=0.5, conf_thres=0.4):
     order = np.array(areas).argsort()[::-1]
     # print("order:{}".format(order))
     nums = len(bbox_infos)
-    suppressed = np.zeros(nums, dtype=np.int)
+    suppressed = np.zeros(nums, dtype=np.int32)
     # print("lens:{}".format(nums))
 
+    # 每个文本只在其外接矩形内栅格化一次，合并时总是使用保留文本的原始mask，无需更新
+    rois = [polygon_roi(box, shape, 255) for box in bbox_infos]
+    mask_areas = [np.count_nonzero(mask) for _, _, mask in rois]
+
     # 循环遍历
     for i in range(nums):
         idx = order[i]
         if suppressed[idx] == 1:
             continue
         keep.append(idx)
-        mask_a, area_a = get_mask(bbox_infos[idx], shape)
+        area_a = mask_areas[idx]
 
         # child_masks = []
         for j in range(i+1, nums):
             idx_j = order[j]
             if suppressed[idx_j] == 1:
                 continue
-            mask_b, area_b = get_mask(bbox_infos[idx_j], shape)
+            area_b = mask_areas[idx_j]
 
             # 获取两个文本的相交面积
-            merge_mask = cv2.bitwise_and(mask_a, mask_b)
-            area_intersect = cv2.countNonZero(merge_mask)
+            area_intersect = roi_intersection(rois[idx], rois[idx_j])
 
             # 计算MMI
             mmi = comput_mmi(area_a, area_b, area_intersect)
@@ -146,12 +188,7 @@ def mask_nms(polygons, shape, mmi_thres=0.5, conf_thres=0.4):
             # elif mmi >= mmi_thres:
             if mmi >= mmi_thres:
                 suppressed[idx_j] = 1
-                or_mask = cv2.bitwise_or(mask_a, mask_b)
-                sum_area = cv2.countNonZero(or_mask)
-                padded_mask = np.zeros((or_mask.shape[0] + 2, or_mask.shape[1] + 2), dtype=np.uint8)
-                padded_mask[1:-1, 1:-1] = or_mask
-                contours = find_contours(padded_mask, 0.5)
-                poly = np.fliplr(contours[0]).astype(np.int32).tolist()
+                poly, sum_area = roi_union(rois[idx], rois[idx_j])
                 bbox_infos[idx] = poly
                 areas[idx] = sum_area
 
@@ -13,7 +13,7 @@ from network.textnet import TextNet
 from util.detection import TextDetector
 from util.augmentation import BaseTransform, EvalTransform
 from util.config import config as cfg, update_config, print_config
-from util.misc import to_device, fill_hole
+from util.misc import to_device, fill_hole, calc_confidence
 from util.option import BaseOptions
 from util.visualize import visualize_detection
 import cv2
@@ -79,27 +79,6 @@ def rescale_padding_result(image, polygons, ori_h, ori_w):
     return no_padding_image, polygons
 
 
-def calc_confidence(contours, score_map):
-    polygons = []
-    for cnt in contours:
-        drawing = np.zeros(score_map.shape[1:], np.int8)
-        mask = cv2.fillPoly(drawing, [cnt.astype(np.int32)], 1)
-        area = np.sum(np.greater(mask, 0))
-        if not area > 0:
-            continue
-
-        confidence = np.sum(mask * score_map[0]) / area
-
-        polygon = {
-            'points': cnt,
-            'confidence': confidence
-        }
-
-        polygons.append(polygon)
-
-    return polygons
-
-
 def load_model(model, model_path):
     print('Loading from {}'.format(model_path))
     state_dict = torch.load(model_path)
@@ -597,6 +597,246 @@ class TextDetector(object):
 
         return tcl_result
 
+    def roi_lookup(self, flat, rois, walker_roi, x, y):
+        """
+        Read the tcl masks of many walkers at once
+        Args:
+            flat: all roi masks, flattened and concatenated
+            rois: (n_roi, 5) array of (x0, y0, w, h, offset in flat)
+            walker_roi: roi index of each walker, (n,)
+            x, y: float coordinates in the image, (n,) or (n, k)
+
+        Returns:
+            bool array shaped like x, same as `is_inside(mask, x, y) and mask[int(y), int(x)]`
+        """
+        roi = rois[walker_roi]
+        if x.ndim == 2:
+            roi = roi[:, None, :]
+        # int() truncates toward zero
+        rx = np.trunc(x).astype(np.int64) - roi[..., 0]
+        ry = np.trunc(y).astype(np.int64) - roi[..., 1]
+        inside = (rx >= 0) & (rx < roi[..., 2]) & (ry >= 0) & (ry < roi[..., 3])
+        index = np.where(inside, roi[..., 4] + ry * roi[..., 2] + rx, 0)
+        return inside & (flat[index] > 0)
+
+    def centerlize_batch(self, x, y, tangent_cos, tangent_sin, lookup, chunk=16):
+        """
+        centerlize for many points at once, each point marches along its normal line
+        `chunk` steps at a time
+
+        Args:
+            x, y: (n,) float64
+            tangent_cos, tangent_sin: (n,)
+            lookup: function (walker indices, x, y) -> bool mask
+
+        Returns:
+            (n,) x and (n,) y of the centers
+        """
+        # calculate normal sin and cos
+        normal_cos = -tangent_sin
+        normal_sin = tangent_cos
+
+        ends = []
+        for sign in (1, -1):
+            end_x, end_y = x.copy(), y.copy()
+            todo = np.arange(len(x))
+            cur_x, cur_y = x, y
+            while len(todo) > 0:
+                # cumsum repeats the additions of the scalar loop, so the positions are identical
+                path_x = np.empty((len(todo), chunk + 1))
+                path_y = np.empty((len(todo), chunk + 1))
+                path_x[:, 0], path_y[:, 0] = cur_x, cur_y
+                path_x[:, 1:] = (sign * normal_cos[todo])[:, None]
+                path_y[:, 1:] = (sign * normal_sin[todo])[:, None]
+                path_x = np.cumsum(path_x, axis=1)
+                path_y = np.cumsum(path_y, axis=1)
+
+                valid = lookup(todo, path_x, path_y)
+                first_out = np.argmin(valid, axis=1)
+                done = ~valid[np.arange(len(todo)), first_out]
+                end_x[todo[done]] = path_x[done, first_out[done]]
+                end_y[todo[done]] = path_y[done, first_out[done]]
+
+                todo = todo[~done]
+                cur_x, cur_y = path_x[~done, -1], path_y[~done, -1]
+            ends.append((end_x, end_y))
+
+        # centralizing
+        (x1, y1), (x2, y2) = ends
+        return (x1 + x2) / 2, (y1 + y2) / 2
+
+    def mask_to_tcl_batch(self, pred_sin, pred_cos, pred_radii, lookup, init_x, init_y, direct, max_steps=100):
+        """
+        mask_to_tcl for many walkers at once, every step moves all the walkers still inside their tcl mask
+        Args:
+            pred_sin: predict sin map
+            pred_cos: predict cos map
+            pred_radii: predict radii map
+            lookup: function (walker indices, x, y) -> bool mask of the walkers' own tcl masks
+            init_x, init_y: initial points, (n,)
+            direct: direction of each walker, (n,) of [-1|1]
+            max_steps: most points of one walker
+
+        Returns:
+            list of (k, 3) arrays of (x, y, radii), one per walker
+        """
+        h, w = pred_sin.shape[:2]
+        pred_sin, pred_cos, pred_radii = pred_sin.ravel(), pred_cos.ravel(), pred_radii.ravel()
+
+        def pixel(x, y):
+            # flat index of (int(y), int(x)), kept inside the image
+            ix = np.minimum(np.maximum(np.trunc(x).astype(np.int64), 0), w - 1)
+            iy = np.minimum(np.maximum(np.trunc(y).astype(np.int64), 0), h - 1)
+            return iy * w + ix
+
+        n = len(init_x)
+        walker = np.arange(n)
+        direct = np.asarray(direct, dtype=pred_sin.dtype)
+        index = pixel(init_x, init_y)
+        sin, cos, radii = pred_sin[index], pred_cos[index], pred_radii[index]
+
+        x, y = self.centerlize_batch(init_x, init_y, cos, sin, lookup)
+        prev_x, prev_y = None, None
+        records = []
+
+        for step in range(max_steps):
+            alive = lookup(walker, x, y)
+            if not alive.any():
+                break
+            walker, x, y, radii, direct = walker[alive], x[alive], y[alive], radii[alive], direct[alive]
+            if prev_x is not None:
+                prev_x, prev_y = prev_x[alive], prev_y[alive]
+            records.append(np.stack([walker, x, y, radii], axis=1))
+
+            index = pixel(x, y)
+            sin, cos = pred_sin[index], pred_cos[index]
+
+            local_lookup = lambda idx, _x, _y, walker=walker: lookup(walker[idx], _x, _y)
+            x_c, y_c = self.centerlize_batch(x, y, cos, sin, local_lookup)
+
+            index = pixel(x_c, y_c)
+            sin_c, cos_c, radii = pred_sin[index], pred_cos[index], pred_radii[index]
+
+            # shift stride = +/- 0.5 * [sin|cos](theta)
+            t = 0.5 * radii
+            x_shift_pos = x_c + cos_c * t * direct  # positive direction
+            y_shift_pos = y_c + sin_c * t * direct  # positive direction
+            x_shift_neg = x_c - cos_c * t * direct  # negative direction
+            y_shift_neg = y_c - sin_c * t * direct  # negative direction
+
+            # if first point, select positive direction shift
+            if prev_x is None:
+                forward = np.ones(len(walker), dtype=bool)
+            else:
+                # else select point further by second last point
+                dist_pos = np.sqrt((prev_x - x_shift_pos) ** 2 + (prev_y - y_shift_pos) ** 2)
+                dist_neg = np.sqrt((prev_x - x_shift_neg) ** 2 + (prev_y - y_shift_neg) ** 2)
+                forward = dist_pos > dist_neg
+            prev_x, prev_y = x, y
+            x = np.where(forward, x_shift_pos, x_shift_neg)
+            y = np.where(forward, y_shift_pos, y_shift_neg)
+
+        if len(records) == 0:
+            return [np.zeros((0, 3)) for _ in range(n)]
+        records = np.concatenate(records)
+        records = records[np.argsort(records[:, 0], kind='stable')]
+        counts = np.bincount(records[:, 0].astype(np.int64), minlength=n)
+        return np.split(records[:, 1:], np.cumsum(counts)[:-1])
+
+    def roi_instances(self, tcl_pred_mask, pad=5):
+        """
+        Same filtering and dilation as instance_detect, on a crop around each region instead of the whole image
+        Args:
+            tcl_pred_mask: predict tcl mask
+            pad: margin of the crop, larger than the reach of the dilation
+
+        Returns:
+            list of (x0, y0, dilated roi mask, contours of the dilated mask in image coordinates)
+        """
+        img_h, img_w = tcl_pred_mask.shape[:2]
+        kernel = np.ones((5, 5), np.uint8)
+        instances = []
+        conts, _ = cv2.findContours(tcl_pred_mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        for cont in conts:
+            x, y, w, h = cv2.boundingRect(cont)
+            x0, y0 = max(x - pad, 0), max(y - pad, 0)
+            x1, y1 = min(x + w + pad, img_w), min(y + h + pad, img_h)
+            drawing = np.zeros((y1 - y0, x1 - x0), np.uint8)
+            tcl_per_mask = cv2.fillPoly(drawing, [cont.astype(np.int32)], 1, offset=(-x0, -y0))
+
+            # find disjoint regions
+            tcl_per_mask = fill_hole(tcl_per_mask)
+
+            # remove small regions
+            tcl_per_conts, _ = cv2.findContours(tcl_per_mask.astype(np.uint8), cv2.RETR_EXTERNAL,
+                                                cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))
+            region_area = cv2.contourArea(tcl_per_conts[0])
+            if region_area < 50:
+                continue
+            # remove non-text-like regions
+            _, (w, h), _ = cv2.minAreaRect(tcl_per_conts[0])
+            if float(max(w, h)) / min(w, h) < 3 and region_area < 300:
+                continue
+
+            # slightly enlarge for easier to get tcl
+            tcl_per_mask = cv2.dilate(tcl_per_mask, kernel, iterations=2)
+            dilated_conts, _ = cv2.findContours(tcl_per_mask.astype(np.uint8), cv2.RETR_TREE,
+                                                cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))
+            instances.append((x0, y0, tcl_per_mask, dilated_conts))
+        return instances
+
+    def batch_detect(self, tr_pred_mask, tcl_pred_mask, sin_pred, cos_pred, radii_pred):
+        """
+        Same result as instance_detect, but the masks are cropped to each region and the center lines
+        of all the instances are traced together
+        """
+        # regularize
+        sin_pred, cos_pred = regularize_sin_cos(sin_pred, cos_pred)
+
+        instances = self.roi_instances(tcl_pred_mask)
+        if len(instances) == 0:
+            return []
+
+        # pack the roi masks into one buffer
+        rois = np.zeros((len(instances), 5), np.int64)
+        offset = 0
+        for i, (x0, y0, mask, _) in enumerate(instances):
+            rois[i] = (x0, y0, mask.shape[1], mask.shape[0], offset)
+            offset += mask.size
+        flat = np.concatenate([mask.ravel() for _, _, mask, _ in instances] + [np.zeros(1, np.uint8)])
+
+        # one walker per direction for every inner point
+        owner, walker_roi, init_x, init_y = [], [], [], []
+        for i, (_, _, _, conts) in enumerate(instances):
+            for j, cont in enumerate(conts):
+                init = self.find_innerpoint(cont)
+                if init is None:
+                    continue
+                owner.append((i, j))
+                walker_roi.append(i)
+                init_x.append(init[0])
+                init_y.append(init[1])
+
+        tcls = [[] for _ in instances]
+        if len(owner) > 0:
+            walker_roi = np.array(walker_roi * 2, np.int64)
+            init_x = np.array(init_x * 2, np.float64)
+            init_y = np.array(init_y * 2, np.float64)
+            direct = np.repeat([1, -1], len(owner))
+            lookup = lambda idx, x, y: self.roi_lookup(flat, rois, walker_roi[idx], x, y)
+            traced = self.mask_to_tcl_batch(sin_pred, cos_pred, radii_pred, lookup, init_x, init_y, direct)
+
+            for k, (i, _) in enumerate(owner):
+                # find left tcl and right tcl
+                tcl_left, tcl_right = traced[k], traced[k + len(owner)]
+                if len(tcl_left) == 0 and len(tcl_right) == 0:
+                    tcls[i].append(np.array([]))
+                    continue
+                # concat
+                tcls[i].append(np.concatenate([tcl_left[::-1][:-1], tcl_right]))
+
+        return [tcl for tcl in tcls if len(tcl) > 0]
+
     def full_detect(self, tr_pred_mask, tcl_pred_mask, sin_pred, cos_pred, radii_pred):
         # find tcl in each predicted mask
         tcl_result = []
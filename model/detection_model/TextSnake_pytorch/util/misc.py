@@ -36,6 +36,58 @@ def regularize_sin_cos(sin, cos):
     return sin * scale, cos * scale
 
 
+def polygon_roi(points, shape, value=1):
+    """
+    Fill a polygon inside its bounding box instead of a full-image canvas
+    Args:
+        points: polygon, (n, 2)
+        shape: (h, w) of the image
+        value: fill value
+
+    Returns:
+        x0, y0 and the uint8 mask of the bounding box clipped to the image
+    """
+    points = np.asarray(points, dtype=np.int32).reshape(-1, 2)
+    h, w = shape[:2]
+    x, y, box_w, box_h = cv2.boundingRect(points)
+    x0, y0 = min(max(x, 0), w), min(max(y, 0), h)
+    x1, y1 = min(max(x + box_w, 0), w), min(max(y + box_h, 0), h)
+    mask = np.zeros((y1 - y0, x1 - x0), np.uint8)
+    if mask.size > 0:
+        cv2.fillPoly(mask, [points], value, offset=(-x0, -y0))
+    return x0, y0, mask
+
+
+def calc_confidence(contours, score_map):
+    """
+    Mean text region score inside each contour, contours without any pixel are dropped
+    Args:
+        contours: list of (n, 2) polygons
+        score_map: (2, h, w) text region prediction
+
+    Returns:
+        [{'points', 'confidence'}]
+    """
+    polygons = []
+    for cnt in contours:
+        x0, y0, mask = polygon_roi(cnt, score_map.shape[1:])
+        area = np.count_nonzero(mask)
+        if not area > 0:
+            continue
+
+        h, w = mask.shape
+        confidence = np.sum(score_map[0, y0:y0 + h, x0:x0 + w][mask > 0], dtype=np.float64) / area
+
+        polygon = {
+            'points': cnt,
+            'confidence': confidence
+        }
+
+        polygons.append(polygon)
+
+    return polygons
+
+
 class AverageMeter(object):
     """
     Computes and stores the average and current value
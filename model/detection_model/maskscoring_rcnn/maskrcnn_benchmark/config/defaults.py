@@ -265,6 +265,12 @@ _C.TEST.EXPECTED_RESULTS_SIGMA_TOL = 4
 # This is global, so if we have 8 GPUs and IMS_PER_BATCH = 16, each GPU will
 # see 2 images per batch
 _C.TEST.IMS_PER_BATCH = 8
+# Number of CPU workers pasting and RLE-encoding the masks while the model
+# runs, 0 converts each batch in the main process, -1 converts all the
+# predictions after inference
+_C.TEST.CONVERT_WORKERS = 4
+# Number of batches waiting for conversion before inference blocks
+_C.TEST.MAX_PENDING_BATCHES = 4
 
 
 # ---------------------------------------------------------------------------- #
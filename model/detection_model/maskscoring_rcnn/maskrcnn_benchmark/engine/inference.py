@@ -1,10 +1,13 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved.
 import datetime
 import logging
+import multiprocessing
+import shutil
 import tempfile
 import time
 import os
 from collections import OrderedDict
+from collections import deque
 
 import torch
 
@@ -20,7 +23,7 @@ from maskrcnn_benchmark.modeling.roi_heads.mask_head.inference import Masker
 from maskrcnn_benchmark.structures.boxlist_ops import boxlist_iou
 
 
-def compute_on_dataset(model, data_loader, device):
+def compute_on_dataset(model, data_loader, device, writer=None):
     model.eval()
     results_dict = {}
     cpu_device = torch.device("cpu")
@@ -30,6 +33,13 @@ def compute_on_dataset(model, data_loader, device):
         with torch.no_grad():
             output = model(images)
             output = [o.to(cpu_device) for o in output]
+        if writer is not None:
+            writer.put(image_ids, output)
+            # the masks were handed to the writer, keep only the boxes
+            output = [
+                o.copy_with_fields([f for f in o.fields() if f != "mask"])
+                for o in output
+            ]
         results_dict.update(
             {img_id: result for img_id, result in zip(image_ids, output)}
         )
@@ -69,10 +79,38 @@ def prepare_for_coco_detection(predictions, dataset):
     return coco_results
 
 
-def prepare_for_coco_segmentation(predictions, dataset, maskiou_on):
+def _encode_masks(masker, masks, prediction):
+    """
+    RLE-encodes the masks of a prediction that was already resized to
+    the original image
+    """
     import pycocotools.mask as mask_util
     import numpy as np
 
+    image_width, image_height = prediction.size
+    # Masker is necessary only if masks haven't been already resized.
+    if list(masks.shape[-2:]) != [image_height, image_width]:
+        # paste the box-local masks one at a time into a single canvas
+        # instead of materializing N full-image masks
+        crops, offsets = masker.crop_single_image(masks, prediction)
+        canvas = np.zeros((image_height, image_width, 1), dtype=np.uint8, order="F")
+        rles = []
+        for crop, (x, y) in zip(crops, offsets.tolist()):
+            h, w = crop.shape
+            canvas[y:y + h, x:x + w, 0] = crop.numpy()
+            rles.append(mask_util.encode(canvas)[0])
+            canvas[y:y + h, x:x + w, 0] = 0
+    else:
+        rles = [
+            mask_util.encode(np.array(mask[0, :, :, np.newaxis], order="F"))[0]
+            for mask in masks
+        ]
+    for rle in rles:
+        rle["counts"] = rle["counts"].decode("utf-8")
+    return rles
+
+
+def prepare_for_coco_segmentation(predictions, dataset, maskiou_on):
     masker = Masker(threshold=0.5, padding=1)
     # assert isinstance(dataset, COCODataset)
     coco_results = []
@@ -88,10 +126,7 @@ def prepare_for_coco_segmentation(predictions, dataset, maskiou_on):
         masks = prediction.get_field("mask")
 
         # t = time.time()
-        # Masker is necessary only if masks haven't been already resized.
-        if list(masks.shape[-2:]) != [image_height, image_width]:
-            masks = masker(masks.expand(1, -1, -1, -1, -1), prediction)
-            masks = masks[0]
+        rles = _encode_masks(masker, masks, prediction)
         # logger.info('Time mask: {}'.format(time.time() - t))
         # prediction = prediction.convert('xywh')
 
@@ -104,13 +139,6 @@ def prepare_for_coco_segmentation(predictions, dataset, maskiou_on):
 
         # rles = prediction.get_field('mask')
 
-        rles = [
-            mask_util.encode(np.array(mask[0, :, :, np.newaxis], order="F"))[0]
-            for mask in masks
-        ]
-        for rle in rles:
-            rle["counts"] = rle["counts"].decode("utf-8")
-
         mapped_labels = [dataset.contiguous_category_id_to_json_id[i] for i in labels]
 
         coco_results.extend(
@@ -127,6 +155,174 @@ def prepare_for_coco_segmentation(predictions, dataset, maskiou_on):
     return coco_results
 
 
+def _init_convert_worker():
+    # the workers are forked from the process running the model, keep them
+    # from competing with it for the intra-op threads
+    torch.set_num_threads(1)
+
+
+def _convert_images(images, iou_types):
+    """
+    Converts the predictions of one batch, prepared by
+    COCOResultWriter.prepare, to COCO results.
+
+    Returns:
+        one (json fragment, number of results) pair per iou type, the
+        fragment holds the comma separated results without the brackets
+    """
+    import json
+
+    masker = Masker(threshold=0.5, padding=1)
+    fragments = {iou_type: [] for iou_type in iou_types}
+    for image in images:
+        if "bbox" in iou_types:
+            fragments["bbox"].extend(
+                json.dumps(
+                    {
+                        "image_id": image["image_id"],
+                        "category_id": image["labels"][k],
+                        "bbox": box,
+                        "score": image["scores"][k],
+                    }
+                )
+                for k, box in enumerate(image["xywh"])
+            )
+        if "segm" in iou_types:
+            prediction = BoxList(torch.from_numpy(image["xyxy"]), image["size"])
+            rles = _encode_masks(masker, torch.from_numpy(image["mask"]), prediction)
+            fragments["segm"].extend(
+                json.dumps(
+                    {
+                        "image_id": image["image_id"],
+                        "category_id": image["labels"][k],
+                        "segmentation": rle,
+                        "score": image["mask_scores"][k],
+                    }
+                )
+                for k, rle in enumerate(rles)
+            )
+    return [
+        (",".join(fragments[iou_type]), len(fragments[iou_type]))
+        for iou_type in iou_types
+    ]
+
+
+class COCOResultWriter(object):
+    """
+    Converts the predictions of every batch to COCO results while the
+    model keeps running and appends them to one json file per iou type.
+
+    The masks are pasted and RLE-encoded in a pool of CPU workers, and at
+    most max_pending batches are in flight, so the memory used by the
+    conversion does not grow with the size of the dataset.
+    """
+
+    def __init__(
+        self, dataset, iou_types, output_files, maskiou_on=False,
+        num_workers=4, max_pending=4
+    ):
+        self.dataset = dataset
+        self.iou_types = tuple(t for t in ("bbox", "segm") if t in iou_types)
+        self.maskiou_on = maskiou_on
+        self.max_pending = max(max_pending, 1)
+        self.files = {t: open(output_files[t], "w") for t in self.iou_types}
+        self.num_results = {t: 0 for t in self.iou_types}
+        for f in self.files.values():
+            f.write("[")
+        self.pool = None
+        if num_workers > 0:
+            self.pool = multiprocessing.get_context("fork").Pool(
+                num_workers, initializer=_init_convert_worker
+            )
+        self.pending = deque()
+
+    def prepare(self, image_id, prediction):
+        """
+        Resizes a prediction to its original image and keeps only the
+        plain arrays the workers need
+        """
+        original_id = self.dataset.id_to_img_map[image_id]
+        # TODO replace with get_img_info?
+        image_width = self.dataset.coco.imgs[original_id]["width"]
+        image_height = self.dataset.coco.imgs[original_id]["height"]
+        prediction = prediction.resize((image_width, image_height))
+        labels = prediction.get_field("labels").tolist()
+        image = {
+            "image_id": original_id,
+            "size": (image_width, image_height),
+            "labels": [self.dataset.contiguous_category_id_to_json_id[i] for i in labels],
+            "scores": prediction.get_field("scores").tolist(),
+        }
+        if "bbox" in self.iou_types:
+            image["xywh"] = prediction.convert("xywh").bbox.tolist()
+        if "segm" in self.iou_types:
+            image["xyxy"] = prediction.convert("xyxy").bbox.numpy()
+            image["mask"] = prediction.get_field("mask").numpy()
+            image["mask_scores"] = image["scores"]
+            if self.maskiou_on:
+                image["mask_scores"] = prediction.get_field("mask_scores").tolist()
+        return image
+
+    def put(self, image_ids, predictions):
+        images = [
+            self.prepare(image_id, prediction)
+            for image_id, prediction in zip(image_ids, predictions)
+            if len(prediction) > 0
+        ]
+        if not images:
+            return
+        if self.pool is None:
+            self._write(_convert_images(images, self.iou_types))
+            return
+        self.pending.append(
+            self.pool.apply_async(_convert_images, (images, self.iou_types))
+        )
+        self._drain(block=False)
+
+    def _drain(self, block):
+        # results are written in submission order, waiting for the oldest
+        # batch only when too many are in flight
+        while self.pending and (
+            block or len(self.pending) > self.max_pending or self.pending[0].ready()
+        ):
+            self._write(self.pending.popleft().get())
+
+    def _write(self, fragments):
+        for iou_type, (fragment, count) in zip(self.iou_types, fragments):
+            if count == 0:
+                continue
+            f = self.files[iou_type]
+            if self.num_results[iou_type] > 0:
+                f.write(",")
+            f.write(fragment)
+            self.num_results[iou_type] += count
+
+    def close(self):
+        """
+        Waits for the batches in flight and closes the json files
+
+        Returns:
+            the number of results written per iou type
+        """
+        try:
+            self._drain(block=True)
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+            for f in self.files.values():
+                f.write("]")
+                f.close()
+        return self.num_results
+
+    def terminate(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+        for f in self.files.values():
+            f.close()
+
+
 # inspired from Detectron
 def evaluate_box_proposals(
     predictions, dataset, thresholds=None, area="all", limit=None
@@ -250,8 +446,10 @@ def evaluate_predictions_on_coco(
 ):
     import json
 
-    with open(json_result_file, "w") as f:
-        json.dump(coco_results, f)
+    # coco_results is None when the results were already streamed to the file
+    if coco_results is not None:
+        with open(json_result_file, "w") as f:
+            json.dump(coco_results, f)
 
     from pycocotools.cocoeval import COCOeval
 
@@ -362,7 +560,9 @@ def inference(
     expected_results=(),
     expected_results_sigma_tol=4,
     output_folder=None,
-    maskiou_on=False
+    maskiou_on=False,
+    convert_workers=4,
+    max_pending_batches=4,
 ):
 
     # convert to a torch.device for efficiency
@@ -375,8 +575,31 @@ def inference(
     logger = logging.getLogger("maskrcnn_benchmark.inference")
     dataset = data_loader.dataset
     logger.info("Start evaluation on {} images".format(len(dataset)))
+
+    # on a single device the COCO results are written while the model runs,
+    # the gathered predictions of several devices are converted at the end
+    writer = None
+    result_folder = None
+    if not box_only and num_devices == 1 and convert_workers >= 0:
+        result_folder = output_folder or tempfile.mkdtemp()
+        result_files = {
+            iou_type: os.path.join(result_folder, iou_type + ".json")
+            for iou_type in iou_types
+        }
+        writer = COCOResultWriter(
+            dataset, iou_types, result_files, maskiou_on,
+            convert_workers, max_pending_batches
+        )
+
     start_time = time.time()
-    predictions = compute_on_dataset(model, data_loader, device)
+    try:
+        predictions = compute_on_dataset(model, data_loader, device, writer)
+    except BaseException:
+        if writer is not None:
+            writer.terminate()
+        raise
+    if writer is not None:
+        num_results = writer.close()
     # wait for all processes to complete before measuring the time
     synchronize()
     total_time = time.time() - start_time
@@ -410,18 +633,32 @@ def inference(
         if output_folder:
             torch.save(res, os.path.join(output_folder, "box_proposals.pth"))
         return
-    logger.info("Preparing results for COCO format")
     coco_results = {}
-    if "bbox" in iou_types:
-        logger.info("Preparing bbox results")
-        coco_results["bbox"] = prepare_for_coco_detection(predictions, dataset)
-    if "segm" in iou_types:
-        logger.info("Preparing segm results")
-        coco_results["segm"] = prepare_for_coco_segmentation(predictions, dataset, maskiou_on)
+    if writer is not None:
+        # the results are already on disk, coco_results holds their files
+        for iou_type in iou_types:
+            logger.info(
+                "Wrote {} {} results".format(num_results[iou_type], iou_type)
+            )
+            coco_results[iou_type] = result_files[iou_type]
+    else:
+        logger.info("Preparing results for COCO format")
+        if "bbox" in iou_types:
+            logger.info("Preparing bbox results")
+            coco_results["bbox"] = prepare_for_coco_detection(predictions, dataset)
+        if "segm" in iou_types:
+            logger.info("Preparing segm results")
+            coco_results["segm"] = prepare_for_coco_segmentation(predictions, dataset, maskiou_on)
 
     results = COCOResults(*iou_types)
     logger.info("Evaluating predictions")
     for iou_type in iou_types:
+        if writer is not None:
+            res = evaluate_predictions_on_coco(
+                dataset.coco, None, result_files[iou_type], iou_type
+            )
+            results.update(res)
+            continue
         with tempfile.NamedTemporaryFile() as f:
             file_path = f.name
             if output_folder:
@@ -430,10 +667,11 @@ def inference(
                 dataset.coco, coco_results[iou_type], file_path, iou_type
             )
             results.update(res)
+    if result_folder is not None and not output_folder:
+        shutil.rmtree(result_folder)
     logger.info(results)
     check_expected_results(results, expected_results, expected_results_sigma_tol)
     if output_folder:
         torch.save(results, os.path.join(output_folder, "coco_results.pth"))
 
     return results, coco_results, predictions
-
@@ -154,6 +154,124 @@ def paste_mask_in_image(mask, box, im_h, im_w, thresh=0.5, padding=1):
     return im_mask
 
 
+def _source_index(in_size, out_sizes, out_max, device):
+    """
+    Source indices and weights of a bilinear resize with align_corners=False,
+    computed the same way as F.interpolate, for several output sizes at once.
+
+    Returns (index0, index1, lambda1) of shape [n, out_max]; positions past
+    an output size are clamped to its last pixel.
+    """
+    out_sizes = out_sizes.to(device=device, dtype=torch.float32)
+    dst = torch.arange(out_max, device=device, dtype=torch.float32)
+    scale = in_size / out_sizes[:, None]
+    src = (scale * (dst[None] + 0.5) - 0.5).clamp(min=0)
+    index0 = src.to(torch.int64).clamp(max=in_size - 1)
+    lambda1 = src - index0.to(torch.float32)
+    index1 = (index0 + 1).clamp(max=in_size - 1)
+    return index0, index1, lambda1
+
+
+def _resize_masks(masks, heights, widths):
+    """
+    Bilinear resize of [n, S, S] masks to per-mask sizes, padded to the
+    largest one. Interpolates along x on the small masks first and then
+    gathers whole rows along y, in two batched passes instead of one
+    F.interpolate call per mask. The indices and weights follow
+    F.interpolate's formulas, but its kernel may fuse multiply-adds,
+    depending on the build, so values can differ in the last float bit
+    and a pixel right at the threshold can flip.
+    """
+    n, S = masks.shape[0], masks.shape[-1]
+    y0, y1, ly = _source_index(S, heights, int(heights.max()), masks.device)
+    x0, x1, lx = _source_index(S, widths, int(widths.max()), masks.device)
+    w_max = x0.shape[1]
+    x0 = x0[:, None, :].expand(n, S, w_max)
+    x1 = x1[:, None, :].expand(n, S, w_max)
+    lx = lx[:, None, :]
+    rows = torch.gather(masks, 2, x0) * (1 - lx) + torch.gather(masks, 2, x1) * lx
+    batch = torch.arange(n, device=masks.device)[:, None]
+    ly = ly[:, :, None]
+    return rows[batch, y0] * (1 - ly) + rows[batch, y1] * ly
+
+
+def paste_masks_in_image(masks, boxes, im_h, im_w, thresh=0.5, padding=1, crop=False, chunk_elements=1 << 24):
+    """
+    Batched version of paste_mask_in_image. Thresholded masks can differ
+    from it by a pixel whose value is within float rounding of thresh.
+
+    Masks are resized in chunks of similar box size, bounded by
+    chunk_elements resized pixels, and written into one preallocated
+    [N, 1, im_h, im_w] uint8 tensor.
+
+    With crop=True nothing of image size is allocated: returns the list of
+    box-local masks clipped to the image and an [N, 2] tensor of their
+    (x, y) offsets in the image.
+    """
+    N = masks.shape[0]
+    padded_masks, scale = expand_masks(masks, padding=padding)
+    padded_masks = padded_masks[:, 0].to(torch.float32)
+    boxes = expand_boxes(boxes.to(torch.float32), scale).to(dtype=torch.int32).cpu().to(torch.int64)
+
+    TO_REMOVE = 1
+    widths = (boxes[:, 2] - boxes[:, 0] + TO_REMOVE).clamp(min=1)
+    heights = (boxes[:, 3] - boxes[:, 1] + TO_REMOVE).clamp(min=1)
+    x_0 = boxes[:, 0].clamp(min=0)
+    x_1 = torch.min(boxes[:, 2] + 1, torch.full_like(boxes[:, 2], im_w))
+    y_0 = boxes[:, 1].clamp(min=0)
+    y_1 = torch.min(boxes[:, 3] + 1, torch.full_like(boxes[:, 3], im_h))
+    # boxes entirely outside the image paste nothing
+    x_1 = torch.max(x_1, x_0)
+    y_1 = torch.max(y_1, y_0)
+
+    if crop:
+        res = [None] * N
+    else:
+        res = torch.zeros((N, 1, im_h, im_w), dtype=torch.uint8)
+
+    # text boxes differ mostly in width, chunks of similar widths waste little padding
+    order = sorted(range(N), key=lambda i: (int(widths[i]), int(heights[i])))
+    sizes = (heights * widths).tolist()
+    start = 0
+    while start < N:
+        stop = start + 1
+        h_max, w_max = int(heights[order[start]]), int(widths[order[start]])
+        area = sizes[order[start]]
+        # grow the chunk while the padded output stays under the budget
+        # and not much larger than the masks it holds
+        while stop < N:
+            h, w = max(h_max, int(heights[order[stop]])), max(w_max, int(widths[order[stop]]))
+            padded = (stop + 1 - start) * h * w
+            if padded > chunk_elements or padded > 2 * (area + sizes[order[stop]]) + (1 << 16):
+                break
+            h_max, w_max = h, w
+            area += sizes[order[stop]]
+            stop += 1
+        index = order[start:stop]
+        resized = _resize_masks(padded_masks[index], heights[index], widths[index])
+        if thresh >= 0:
+            resized = resized > thresh
+        else:
+            # for visualization and debugging, we also
+            # allow it to return an unmodified mask
+            resized = (resized * 255).to(torch.uint8)
+        resized = resized.to(torch.uint8).cpu()
+
+        for k, i in enumerate(index):
+            box = boxes[i]
+            mask = resized[k, (y_0[i] - box[1]):(y_1[i] - box[1]), (x_0[i] - box[0]):(x_1[i] - box[0])]
+            if crop:
+                res[i] = mask
+            elif mask.numel() > 0:
+                res[i, 0, y_0[i]:y_1[i], x_0[i]:x_1[i]] = mask
+        start = stop
+
+    if crop:
+        res = [mask if mask is not None else torch.zeros((0, 0), dtype=torch.uint8) for mask in res]
+        return res, torch.stack([x_0, y_0], dim=1)
+    return res
+
+
 class Masker(object):
     """
     Projects a set of masks in an image on the locations
@@ -167,16 +285,25 @@ class Masker(object):
     def forward_single_image(self, masks, boxes):
         boxes = boxes.convert("xyxy")
         im_w, im_h = boxes.size
-        res = [
-            paste_mask_in_image(mask[0], box, im_h, im_w, self.threshold, self.padding)
-            for mask, box in zip(masks, boxes.bbox)
-        ]
-        if len(res) > 0:
-            res = torch.stack(res, dim=0)[:, None]
+        if len(masks) > 0:
+            res = paste_masks_in_image(masks, boxes.bbox, im_h, im_w, self.threshold, self.padding)
         else:
             res = masks.new_empty((0, 1, masks.shape[-2], masks.shape[-1]))
         return res
 
+    def crop_single_image(self, masks, boxes):
+        """
+        Returns:
+            the box-local masks clipped to the image and an [N, 2] tensor
+            with their (x, y) offsets, for consumers that never need
+            full-image masks
+        """
+        boxes = boxes.convert("xyxy")
+        im_w, im_h = boxes.size
+        if len(masks) == 0:
+            return [], torch.zeros((0, 2), dtype=torch.int64)
+        return paste_masks_in_image(masks, boxes.bbox, im_h, im_w, self.threshold, self.padding, crop=True)
+
     def __call__(self, masks, boxes):
         if isinstance(boxes, BoxList):
             boxes = [boxes]
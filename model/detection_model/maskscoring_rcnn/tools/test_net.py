@@ -85,7 +85,9 @@ def main():
             expected_results=cfg.TEST.EXPECTED_RESULTS,
             expected_results_sigma_tol=cfg.TEST.EXPECTED_RESULTS_SIGMA_TOL,
             output_folder=output_folder,
-            maskiou_on=cfg.MODEL.MASKIOU_ON
+            maskiou_on=cfg.MODEL.MASKIOU_ON,
+            convert_workers=cfg.TEST.CONVERT_WORKERS,
+            max_pending_batches=cfg.TEST.MAX_PENDING_BATCHES,
         )
         synchronize()
 
@@ -3,8 +3,14 @@ import json
 from tqdm import tqdm
 import os
 
-from utils.polygon_wrapper import iou
 from utils.polygon_wrapper import iod
+from utils.polygon_wrapper import overlap_table
+
+
+def polygon_xy(polygon):
+    x = list(map(int, np.squeeze(polygon['points'][:, 0])))
+    y = list(map(int, np.squeeze(polygon['points'][:, 1])))
+    return x, y
 
 
 def input_reading(polygons):
@@ -65,7 +71,43 @@ def gt_filtering(groundtruths):
     return groundtruths
 
 
-def eval_func(input_json_path, gt_json_path, cfg):
+def pascal_voc_image(detections, groundtruths, iou_threshold, backend=None):
+    """
+    Match the detections of one image against its groundtruths.
+
+    Returns:
+        tp, fp, fn of the image
+    """
+    _, iou_table, _ = overlap_table([polygon_xy(gt) for gt in groundtruths],
+                                    [polygon_xy(det) for det in detections], backend)
+    det_flag = np.zeros((len(detections), 1))
+    gt_flag = np.zeros((len(groundtruths), 1))
+    tp = 0
+    fp = 0
+    for gt_id, gt in enumerate(groundtruths):
+        if len(detections) > 0:
+            # identified the best matched detection candidates with current groundtruth
+            best_matched_det_id = np.argmax(iou_table[gt_id, :])
+
+            matched_id = np.where(iou_table[gt_id, :] >= iou_threshold)
+            if iou_table[gt_id, best_matched_det_id] >= iou_threshold:
+                tp = tp + 1.0
+                det_flag[best_matched_det_id] = 1
+                gt_flag[gt_id] = 1
+                # if there are more than 1 matched detection, only 1 is contributed to tp, the rest are fp
+                fp = fp + (matched_id[0].shape[0] - 1.0)
+
+    inv_gt_flag = 1 - gt_flag
+    fn = np.sum(inv_gt_flag)
+    inv_det_flag = 1 - det_flag
+    fp = fp + np.sum(inv_det_flag)
+    return tp, fp, fn
+
+
+def eval_func(input_json_path, gt_json_path, cfg, backend=None):
+    """
+    backend: 'exact' or 'raster' polygon areas, see utils.polygon_wrapper
+    """
     generate_json(cfg)
     iou_threshold = cfg.THRESHOLD.iou_threshold
     # load json file as dict
@@ -84,47 +126,9 @@ def eval_func(input_json_path, gt_json_path, cfg):
         detections = input_reading(input_cnts)
         groundtruths = gt_reading(gt_dict, input_img_key)
 
-        iou_table = np.zeros((len(groundtruths), len(detections)))
-        det_flag = np.zeros((len(detections), 1))
-        gt_flag = np.zeros((len(groundtruths), 1))
-        tp = 0
-        fp = 0
-        fn = 0
-        for gt_id, gt in enumerate(groundtruths):
-            gt_x = list(map(int, np.squeeze(gt['points'][:, 0])))
-            gt_y = list(map(int, np.squeeze(gt['points'][:, 1])))
-            if len(detections) > 0:
-                for det_id, detection in enumerate(detections):
-                    # print(detection['points'])
-                    det_x = list(map(int, np.squeeze(detection['points'][:, 0])))
-                    det_y = list(map(int, np.squeeze(detection['points'][:, 1])))
-
-                    iou_table[gt_id, det_id] = iou(det_x, det_y, gt_x, gt_y)
-
-                # identified the best matched detection candidates with current groundtruth
-                best_matched_det_id = np.argmax(iou_table[gt_id, :])
-
-                matched_id = np.where(iou_table[gt_id, :] >= iou_threshold)
-                if iou_table[gt_id, best_matched_det_id] >= iou_threshold:
-                    if matched_id[0].shape[0] < 2:
-                        tp = tp + 1.0
-                        global_tp = global_tp + 1.0
-                        det_flag[best_matched_det_id] = 1
-                        gt_flag[gt_id] = 1
-                    else:
-                        tp = tp + 1.0
-                        global_tp = global_tp + 1.0
-                        det_flag[best_matched_det_id] = 1
-                        gt_flag[gt_id] = 1
-                        # if there are more than 1 matched detection, only 1 is contributed to tp, the rest are fp
-                        fp = fp + (matched_id[0].shape[0] - 1.0)
-
         # Update local and global tp, fp, and fn
-        inv_gt_flag = 1 - gt_flag
-        fn = np.sum(inv_gt_flag)
-        inv_det_flag = 1 - det_flag
-        fp = fp + np.sum(inv_det_flag)
-
+        tp, fp, fn = pascal_voc_image(detections, groundtruths, iou_threshold, backend)
+        global_tp = global_tp + tp
         global_fp = global_fp + fp
         global_fn = global_fn + fn
         if tp + fp == 0:
@@ -0,0 +1,51 @@
+import numpy as np
+
+
+class CodepointTable(object):
+    """Lookup table from unicode codepoints to label indices.
+
+    A whole batch of labels is encoded with one utf-32 conversion and one array
+    index instead of a dict lookup per character.
+
+    Args:
+        mapping (dict): character -> label index, e.g. the `dict` of a label converter.
+        lower (bool, default=False): look up `char.lower()` instead of `char`.
+        missing (int, default=-1): index of the characters that are not in the mapping.
+    """
+
+    def __init__(self, mapping, lower=False, missing=-1):
+        self.mapping = mapping
+        self.lower = lower
+        self.missing = missing
+        size = max([ord(key) + 1 for key in mapping if len(key) == 1] + [0])
+        self.table = np.array([self._slow(chr(cp)) for cp in range(size)], dtype=np.int64)
+
+    def _slow(self, char):
+        return self.mapping.get(char.lower() if self.lower else char, self.missing)
+
+    def lookup(self, text):
+        """
+        Args:
+            text (str): labels joined into one string.
+
+        Returns:
+            np.ndarray of int64: label index of every character of text.
+        """
+        codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.int64)
+        inside = codes < self.table.size
+        if inside.all():
+            return self.table[codes]
+        indices = np.empty(codes.size, dtype=np.int64)
+        indices[inside] = self.table[codes[inside]]
+        # codepoints above the table, e.g. the KELVIN SIGN whose lower case is 'k'
+        for pos in np.flatnonzero(~inside):
+            indices[pos] = self._slow(chr(codes[pos]))
+        return indices
+
+
+def split_labels(text):
+    """Returns the joined string and the lengths of a str or a batch of str."""
+    if isinstance(text, str):
+        return text, [len(text)]
+    text = list(text)
+    return ''.join(text), [len(s) for s in text]
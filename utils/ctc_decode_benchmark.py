@@ -0,0 +1,67 @@
+'''
+Timing harness for the CTC greedy decoder: compares the batched
+strLabelConverterForCTC.decode with the per-step reference decode_loop on
+random argmax outputs and checks that both return the same strings. Usage:
+
+    python -m utils.ctc_decode_benchmark --batch_sizes 64 256 --steps 26 65
+'''
+import argparse
+import string
+import time
+
+import torch
+
+from utils.strLabelConverterForCTC import strLabelConverterForCTC
+
+
+def make_preds(steps, batch_size, num_class, blank_ratio=0.5, seed=0):
+    '''
+    [T, B] argmax indices with runs of repeats and blanks like a trained CTC head
+    '''
+    generator = torch.Generator().manual_seed(seed)
+    preds = torch.randint(1, num_class, (steps, batch_size), generator=generator)
+    blank = torch.rand(steps, batch_size, generator=generator) < blank_ratio
+    preds[blank] = 0
+    repeat = torch.rand(steps, batch_size, generator=generator) < 0.3
+    for step in range(1, steps):
+        preds[step][repeat[step]] = preds[step - 1][repeat[step]]
+    return preds
+
+
+def timeit(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        out = fn()
+        cost = time.time() - start
+        best = cost if best is None else min(best, cost)
+    return out, best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[64, 256])
+    parser.add_argument('--steps', type=int, nargs='+', default=[26, 65])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    converter = strLabelConverterForCTC(string.digits + string.ascii_lowercase)
+    num_class = len(converter.alphabet)
+    for batch_size in args.batch_sizes:
+        for steps in args.steps:
+            preds = make_preds(steps, batch_size, num_class)
+            flat = preds.transpose(1, 0).contiguous().view(-1)
+            length = torch.IntTensor([steps] * batch_size)
+            ref, t_ref = timeit(lambda: converter.decode_loop(flat, length), 1)
+            fast, t_fast = timeit(lambda: converter.decode(flat, length), args.repeat)
+            batch, t_batch = timeit(lambda: converter.decode_batch(preds), args.repeat)
+            if batch_size == 1:
+                # decode returns a str for a single sample
+                ref, fast = [ref], [fast]
+            print('batch {:4d} steps {:3d}  loop {:8.4f}s  decode {:8.4f}s  decode_batch {:8.4f}s  '
+                  'speedup {:7.1f}x  same: {}'.format(batch_size, steps, t_ref, t_fast, t_batch,
+                                                      t_ref / max(t_fast, 1e-9), ref == fast == batch))
+
+
+if __name__ == '__main__':
+    main()
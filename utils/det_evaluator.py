@@ -0,0 +1,144 @@
+import os
+import json
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
+
+from utils.Pascal_VOC import pascal_voc_image
+from utils.Detval import detval_image
+
+'''
+Detection evaluator shared by the Pascal VOC and DetEval protocols.
+
+The groundtruth json is parsed once into an in-memory index (reloaded only
+when the file changes on disk) and the images are scored in a process pool.
+'''
+
+PROTOCOLS = ('pascal_voc', 'deteval')
+
+# abspath -> (mtime, size, index)
+_gt_cache = {}
+
+
+def _parse_polygons(polygons):
+    parsed = []
+    for polygon in polygons:
+        polygon = dict(polygon)
+        polygon['points'] = np.array(polygon['points'])
+        parsed.append(polygon)
+    return parsed
+
+
+def load_groundtruth(gt_json_path):
+    '''
+    Returns:
+        dict of image key -> list of groundtruth polygons with 'points' as arrays.
+        Repeated calls with an unchanged file reuse the parsed index.
+    '''
+    path = os.path.abspath(gt_json_path)
+    stat = os.stat(path)
+    cached = _gt_cache.get(path)
+    if cached is not None and cached[0] == stat.st_mtime and cached[1] == stat.st_size:
+        return cached[2]
+    with open(path, 'r') as f:
+        gt_dict = json.load(f)
+    index = {key: _parse_polygons(polygons) for key, polygons in gt_dict.items()}
+    _gt_cache[path] = (stat.st_mtime, stat.st_size, index)
+    return index
+
+
+def _safe_div(a, b):
+    return a / float(b) if b != 0 else 0
+
+
+def _f_score(precision, recall):
+    return _safe_div(2 * precision * recall, precision + recall)
+
+
+def _score_image(task):
+    protocol, key, detections, groundtruths, iou_threshold, backend = task
+    if protocol == 'pascal_voc':
+        tp, fp, fn = pascal_voc_image(detections, groundtruths, iou_threshold, backend)
+        return key, {'tp': float(tp), 'fp': float(fp), 'fn': float(fn),
+                     'precision': _safe_div(tp, tp + fp), 'recall': _safe_div(tp, tp + fn)}
+    recall_acc, precision_acc, num_gt, num_det = detval_image(detections, groundtruths, backend, verbose=False)
+    return key, {'recall_acc': float(recall_acc), 'precision_acc': float(precision_acc),
+                 'num_gt': num_gt, 'num_det': num_det,
+                 'precision': _safe_div(precision_acc, num_det), 'recall': _safe_div(recall_acc, num_gt)}
+
+
+class DetectionEvaluator(object):
+
+    def __init__(self, gt_json_path, protocol='pascal_voc', iou_threshold=0.5, workers=0, backend=None):
+        '''
+        Args:
+            gt_json_path(string): groundtruth json, {image key: [{'points', 'transcription'}]}
+            protocol(string): 'pascal_voc' or 'deteval'
+            iou_threshold(float): matching threshold of the Pascal VOC protocol
+            workers(int): size of the process pool, 0 scores images in this process
+            backend(string): polygon area backend, see utils.polygon_wrapper
+        '''
+        if protocol not in PROTOCOLS:
+            raise ValueError('Unknown protocol {}, expected one of {}'.format(protocol, PROTOCOLS))
+        self.gt_json_path = gt_json_path
+        self.protocol = protocol
+        self.iou_threshold = iou_threshold
+        self.workers = workers
+        self.backend = backend
+
+    def _gt_key(self, input_key):
+        if self.protocol == 'deteval':
+            return input_key.replace('res', 'gt')
+        return input_key
+
+    def _tasks(self, input_dict):
+        gt_index = load_groundtruth(self.gt_json_path)
+        for key, polygons in input_dict.items():
+            # the matching filters these lists in place, keep the cached index intact
+            groundtruths = list(gt_index[self._gt_key(key)])
+            yield (self.protocol, key, _parse_polygons(polygons), groundtruths, self.iou_threshold, self.backend)
+
+    def evaluate(self, input_json):
+        '''
+        Args:
+            input_json(string or dict): detection json path, or the already loaded dict
+
+        Returns:
+            {'precision', 'recall', 'f_score', 'images': OrderedDict(image key -> per-image result)}
+        '''
+        if isinstance(input_json, dict):
+            input_dict = input_json
+        else:
+            with open(input_json, 'r') as f:
+                input_dict = json.load(f)
+
+        if self.workers > 0 and len(input_dict) > 1:
+            pool = Pool(self.workers)
+            try:
+                scored = pool.map(_score_image, self._tasks(input_dict),
+                                  chunksize=max(1, len(input_dict) // (self.workers * 4)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            scored = [_score_image(task) for task in self._tasks(input_dict)]
+
+        images = OrderedDict()
+        for key, result in scored:
+            result['f_score'] = _f_score(result['precision'], result['recall'])
+            images[key] = result
+
+        if self.protocol == 'pascal_voc':
+            tp = sum(r['tp'] for r in images.values())
+            fp = sum(r['fp'] for r in images.values())
+            fn = sum(r['fn'] for r in images.values())
+            precision, recall = _safe_div(tp, tp + fp), _safe_div(tp, tp + fn)
+        else:
+            precision = _safe_div(sum(r['precision_acc'] for r in images.values()),
+                                  sum(r['num_det'] for r in images.values()))
+            recall = _safe_div(sum(r['recall_acc'] for r in images.values()),
+                               sum(r['num_gt'] for r in images.values()))
+
+        return {'precision': precision, 'recall': recall,
+                'f_score': _f_score(precision, recall), 'images': images}
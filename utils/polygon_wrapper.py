@@ -1,12 +1,27 @@
 import numpy as np
 from skimage.draw import polygon
 """
-All the calculation of 'AREA' in this script is handled by:
-1) First generating a binary mask with the polygon area filled up with 1's
-2) Summing up all the 1's
+Two backends compute the 'AREA' in this script:
+
+'exact':
+    Areas come from the shoelace formula and intersections are clipped
+    analytically: the boundary of (det & gt) is the part of each polygon's
+    edges lying inside the other one, so the intersection area is the sum of
+    the cross products of those edge pieces. Pairs with a self-intersecting
+    polygon fall back to pixel counting. The numbers differ from 'raster'
+    (no pixel discretisation, no +1 smoothing), so it is opt-in.
+
+'raster' (default):
+    The original semantics. A binary mask is generated with the polygon area
+    filled up with 1's and all the 1's are summed up. iou and iod keep their
+    +1 smoothing of the denominator. Masks only cover the bounding box of the
+    pair instead of the whole image extent, which gives the same counts.
+
+Pairs whose bounding boxes do not overlap are skipped by both backends, and
+overlap_table fills a whole groundtruth x detection table at once.
 
 Args:
-    det_x: [1, N] Xs of detection's vertices 
+    det_x: [1, N] Xs of detection's vertices
     det_y: [1, N] Ys of detection's vertices
     gt_x: [1, N] Xs of groundtruth's vertices
     gt_y: [1, N] Ys of groundtruth's vertices
@@ -14,18 +29,194 @@ Args:
 
 """
 
+BACKENDS = ('exact', 'raster')
+_backend = 'raster'
+
+
+def set_backend(name):
+    """
+    Select 'exact' or 'raster' for every function of this module.
+    """
+    global _backend
+    if name not in BACKENDS:
+        raise ValueError('Unknown polygon backend {}, expected one of {}'.format(name, BACKENDS))
+    _backend = name
+
+
+def get_backend():
+    return _backend
+
+
+def _resolve(backend):
+    return _backend if backend is None else backend
+
+
+############################
+# exact geometry
+############################
+
+def _cross(a, b):
+    return a[..., 0] * b[..., 1] - a[..., 1] * b[..., 0]
+
+
+def _as_polygon(x, y):
+    """
+    vertices as a float n*2 array, without repeated consecutive vertices
+    """
+    pts = np.stack([np.asarray(x, dtype=np.float64).ravel(), np.asarray(y, dtype=np.float64).ravel()], axis=1)
+    keep = np.any(pts != np.roll(pts, 1, axis=0), axis=1)
+    if not keep.any():
+        return pts[:1]
+    return pts[keep]
+
+
+def signed_area(pts):
+    return 0.5 * np.sum(_cross(pts, np.roll(pts, -1, axis=0)))
+
+
+def is_simple(pts):
+    """
+    True if no two edges of the polygon touch except adjacent ones at their
+    shared vertex
+    """
+    n = pts.shape[0]
+    if n < 3:
+        return False
+    a0 = pts
+    r = np.roll(pts, -1, axis=0) - pts
+    d = a0[None, :] - a0[:, None]
+    denom = _cross(r[:, None], r[None, :])
+    tn = _cross(d, r[None, :])
+    un = _cross(d, r[:, None])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = tn / denom
+        u = un / denom
+    touch = (denom != 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+    # collinear edges sharing more than a point
+    rr = np.sum(r * r, axis=1)
+    t0 = np.sum(d * r[:, None], axis=-1) / rr[:, None]
+    t1 = np.sum((d + r[None, :]) * r[:, None], axis=-1) / rr[:, None]
+    overlap = (denom == 0) & (un == 0) & (np.maximum(t0, t1) > 0) & (np.minimum(t0, t1) < 1)
+
+    idx = np.arange(n)
+    same = idx[:, None] == idx[None, :]
+    adjacent = same | ((idx[:, None] + 1) % n == idx[None, :]) | ((idx[None, :] + 1) % n == idx[:, None])
+    # adjacent edges may only share their common vertex
+    crossed = (touch & ~adjacent) | (overlap & ~same)
+    return not crossed.any() and signed_area(pts) != 0
+
+
+def _inside_boundary(P, Q, keep_shared):
+    """
+    Sum of the cross products of the pieces of P's edges that lie inside Q.
+    Pieces on Q's boundary count only if keep_shared and both run the same way.
+    P and Q are counter-clockwise.
+    """
+    r = np.roll(P, -1, axis=0) - P
+    s = np.roll(Q, -1, axis=0) - Q
+    d = Q[None, :] - P[:, None]
+    denom = _cross(r[:, None], s[None, :])
+    tn = _cross(d, s[None, :])
+    un = _cross(d, r[:, None])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = tn / denom
+        u = un / denom
+    proper = (denom != 0) & (t >= 0) & (t <= 1) & (u >= 0) & (u <= 1)
+    collinear = (denom == 0) & (un == 0)
+    rr = np.sum(r * r, axis=1)[:, None]
+    tq0 = np.sum(d * r[:, None], axis=-1) / rr
+    tq1 = np.sum((d + s[None, :]) * r[:, None], axis=-1) / rr
+    splits = np.concatenate([
+        np.zeros((P.shape[0], 1)), np.ones((P.shape[0], 1)),
+        np.where(proper, t, np.nan),
+        np.where(collinear & (tq0 > 0) & (tq0 < 1), tq0, np.nan),
+        np.where(collinear & (tq1 > 0) & (tq1 < 1), tq1, np.nan)], axis=1)
+    splits.sort(axis=1)
+    t_lo, t_hi = splits[:, :-1], splits[:, 1:]
+    piece = np.isfinite(t_hi) & (t_hi > t_lo)
+    edge = np.nonzero(piece)[0]
+    start = P[edge] + t_lo[piece][:, None] * r[edge]
+    end = P[edge] + t_hi[piece][:, None] * r[edge]
+    mid = 0.5 * (start + end)
+
+    # midpoints lying on one of Q's edges
+    dm = mid[:, None] - Q[None, :]
+    ss = np.sum(s * s, axis=1)
+    dist = np.abs(_cross(s[None, :], dm)) / np.sqrt(ss)[None, :]
+    proj = np.sum(dm * s[None, :], axis=-1)
+    on_edge = (dist <= 1e-7) & (proj >= 0) & (proj <= ss[None, :])
+    on_boundary = on_edge.any(axis=1)
+
+    # crossing number for the others
+    qy0 = Q[None, :, 1]
+    qy1 = np.roll(Q, -1, axis=0)[None, :, 1]
+    straddle = (qy0 > mid[:, 1:2]) != (qy1 > mid[:, 1:2])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_at = Q[None, :, 0] + (mid[:, 1:2] - qy0) * s[None, :, 0] / s[None, :, 1]
+    inside = (np.sum(straddle & (mid[:, 0:1] < x_at), axis=1) % 2 == 1) & ~on_boundary
+
+    include = inside
+    if keep_shared:
+        same_way = np.any(on_edge & (np.sum(r[edge][:, None] * s[None, :], axis=-1) > 0), axis=1)
+        include = include | (on_boundary & same_way)
+    return np.sum(_cross(start[include], end[include]))
+
+
+def exact_intersection(P, Q):
+    """
+    Area of the intersection of two simple polygons (n*2 and m*2 arrays).
+    """
+    if signed_area(P) < 0:
+        P = P[::-1]
+    if signed_area(Q) < 0:
+        Q = Q[::-1]
+    inter = 0.5 * (_inside_boundary(P, Q, True) + _inside_boundary(Q, P, False))
+    return min(max(inter, 0.0), abs(signed_area(P)), abs(signed_area(Q)))
+
+
+############################
+# rasterized masks
+############################
+
+def _raster_masks(polys):
+    """
+    Pixel masks of the polygons on the bounding box of all of them, offset
+    so that they match masks painted on the full image extent.
+    """
+    ys = np.concatenate([np.asarray(y).ravel() for _, y in polys])
+    xs = np.concatenate([np.asarray(x).ravel() for x, _ in polys])
+    y0 = int(max(0, np.floor(np.min(ys))))
+    x0 = int(max(0, np.floor(np.min(xs))))
+    shape = (int(np.max(ys)) - y0 + 1, int(np.max(xs)) - x0 + 1)
+    masks = []
+    for x, y in polys:
+        mask = np.zeros(shape, dtype=bool)
+        rr, cc = polygon(np.asarray(y) - y0, np.asarray(x) - x0)
+        keep = (rr >= 0) & (cc >= 0)
+        mask[rr[keep], cc[keep]] = True
+        masks.append(mask)
+    return masks
+
+
+def _raster_counts(det_x, det_y, gt_x, gt_y):
+    det_mask, gt_mask = _raster_masks([(det_x, det_y), (gt_x, gt_y)])
+    inter = np.sum(det_mask & gt_mask)
+    return inter, np.sum(det_mask), np.sum(gt_mask), np.sum(det_mask | gt_mask)
+
 
-def area(x, y):
+############################
+# public helpers
+############################
+
+def area(x, y, backend=None):
     """
     This helper calculates the area given x and y vertices.
     """
-    ymax = np.max(y)
-    xmax = np.max(x)
-    bin_mask = np.zeros((ymax, xmax))
-    rr, cc = polygon(y, x)
-    bin_mask[rr, cc] = 1
-    area = np.sum(bin_mask)
-    return area
+    if _resolve(backend) == 'exact':
+        pts = _as_polygon(x, y)
+        if is_simple(pts):
+            return abs(signed_area(pts))
+    return np.sum(_raster_masks([(x, y)])[0])
     #return np.round(area, 2)
 
 
@@ -55,89 +246,124 @@ def approx_area_of_intersection(det_x, det_y, gt_x, gt_y):
 
     return intersect_heights * intersect_widths
 
-def area_of_intersection(det_x, det_y, gt_x, gt_y):
-    """
-    This helper calculates the area of intersection.
-    """
-    if approx_area_of_intersection(det_x, det_y, gt_x, gt_y) > 1: #only proceed if it passes the approximation test
-        ymax = np.maximum(np.max(det_y), np.max(gt_y)) + 1
-        xmax = np.maximum(np.max(det_x), np.max(gt_x)) + 1
-        bin_mask = np.zeros((ymax, xmax))
-        det_bin_mask = np.zeros_like(bin_mask)
-        gt_bin_mask = np.zeros_like(bin_mask)
 
-        rr, cc = polygon(det_y, det_x)
-        det_bin_mask[rr, cc] = 1
+def _min_overlap(backend):
+    # the raster backend only proceeds past an approximate overlap of 1 pixel
+    return 1 if backend == 'raster' else 0
 
-        rr, cc = polygon(gt_y, gt_x)
-        gt_bin_mask[rr, cc] = 1
 
-        final_bin_mask = det_bin_mask + gt_bin_mask
+def _prepare(x, y):
+    """
+    counter-clockwise vertices of a simple polygon, None if it self-intersects
+    """
+    pts = _as_polygon(x, y)
+    if not is_simple(pts):
+        return None
+    return pts if signed_area(pts) > 0 else pts[::-1]
 
-        inter_map = np.where(final_bin_mask == 2, 1, 0)
-        inter = np.sum(inter_map)
-        return inter
-#        return np.round(inter, 2)
-    else:
-        return 0
+
+def _exact_pair(det, gt, det_x, det_y, gt_x, gt_y):
+    if det is None or gt is None:
+        return _raster_counts(det_x, det_y, gt_x, gt_y)
+    det_area = signed_area(det)
+    gt_area = signed_area(gt)
+    inter = exact_intersection(det, gt)
+    return inter, det_area, gt_area, det_area + gt_area - inter
 
 
-def iou(det_x, det_y, gt_x, gt_y):
+def _pair_areas(det_x, det_y, gt_x, gt_y, backend):
     """
-    This helper determine the intersection over union of two polygons.
+    intersection, detection area, groundtruth area and union of one pair
     """
+    if backend == 'exact':
+        return _exact_pair(_prepare(det_x, det_y), _prepare(gt_x, gt_y), det_x, det_y, gt_x, gt_y)
+    return _raster_counts(det_x, det_y, gt_x, gt_y)
 
-    if approx_area_of_intersection(det_x, det_y, gt_x, gt_y) > 1: #only proceed if it passes the approximation test
-        ymax = np.maximum(np.max(det_y), np.max(gt_y)) + 1
-        xmax = np.maximum(np.max(det_x), np.max(gt_x)) + 1
-        bin_mask = np.zeros((ymax, xmax))
-        det_bin_mask = np.zeros_like(bin_mask)
-        gt_bin_mask = np.zeros_like(bin_mask)
 
-        rr, cc = polygon(det_y, det_x)
-        det_bin_mask[rr, cc] = 1
+def _ratios(inter, det_area, union, backend):
+    if backend == 'raster':
+        return inter / float(union + 1.0), inter / float(det_area + 1.0)
+    iou_value = inter / float(union) if union > 0 else 0
+    iod_value = inter / float(det_area) if det_area > 0 else 0
+    return iou_value, iod_value
 
-        rr, cc = polygon(gt_y, gt_x)
-        gt_bin_mask[rr, cc] = 1
 
-        final_bin_mask = det_bin_mask + gt_bin_mask
+def area_of_intersection(det_x, det_y, gt_x, gt_y, backend=None):
+    """
+    This helper calculates the area of intersection.
+    """
+    backend = _resolve(backend)
+    if approx_area_of_intersection(det_x, det_y, gt_x, gt_y) > _min_overlap(backend): #only proceed if it passes the approximation test
+        return _pair_areas(det_x, det_y, gt_x, gt_y, backend)[0]
+    else:
+        return 0
 
-        #inter_map = np.zeros_like(final_bin_mask)
-        inter_map = np.where(final_bin_mask == 2, 1, 0)
-        inter = np.sum(inter_map)
 
-        #union_map = np.zeros_like(final_bin_mask)
-        union_map = np.where(final_bin_mask > 0, 1, 0)
-        union = np.sum(union_map)
-        return inter / float(union + 1.0)
-        #return np.round(inter / float(union + 1.0), 2)
+def iou(det_x, det_y, gt_x, gt_y, backend=None):
+    """
+    This helper determine the intersection over union of two polygons.
+    """
+    backend = _resolve(backend)
+    if approx_area_of_intersection(det_x, det_y, gt_x, gt_y) > _min_overlap(backend): #only proceed if it passes the approximation test
+        inter, det_area, _, union = _pair_areas(det_x, det_y, gt_x, gt_y, backend)
+        return _ratios(inter, det_area, union, backend)[0]
     else:
         return 0
 
-def iod(det_x, det_y, gt_x, gt_y):
+
+def iod(det_x, det_y, gt_x, gt_y, backend=None):
     """
     This helper determine the fraction of intersection area over detection area
     """
-    if approx_area_of_intersection(det_x, det_y, gt_x, gt_y) > 1: #only proceed if it passes the approximation test
-        ymax = np.maximum(np.max(det_y), np.max(gt_y)) + 1
-        xmax = np.maximum(np.max(det_x), np.max(gt_x)) + 1
-        bin_mask = np.zeros((ymax, xmax))
-        det_bin_mask = np.zeros_like(bin_mask)
-        gt_bin_mask = np.zeros_like(bin_mask)
+    backend = _resolve(backend)
+    if approx_area_of_intersection(det_x, det_y, gt_x, gt_y) > _min_overlap(backend): #only proceed if it passes the approximation test
+        inter, det_area, _, union = _pair_areas(det_x, det_y, gt_x, gt_y, backend)
+        return _ratios(inter, det_area, union, backend)[1]
+    else:
+        return 0
 
-        rr, cc = polygon(det_y, det_x)
-        det_bin_mask[rr, cc] = 1
 
-        rr, cc = polygon(gt_y, gt_x)
-        gt_bin_mask[rr, cc] = 1
+def _bbox_overlap_table(gts, dets):
+    """
+    approximate intersection (bounding box overlap area) of every gt x det pair
+    """
+    def boxes(polys):
+        if len(polys) == 0:
+            return np.zeros((0, 4))
+        return np.array([[np.min(x), np.min(y), np.max(x), np.max(y)] for x, y in polys], dtype=np.float64)
+    g = boxes(gts)
+    d = boxes(dets)
+    widths = np.maximum(0.0, np.minimum(g[:, None, 2], d[None, :, 2]) - np.maximum(g[:, None, 0], d[None, :, 0]))
+    heights = np.maximum(0.0, np.minimum(g[:, None, 3], d[None, :, 3]) - np.maximum(g[:, None, 1], d[None, :, 1]))
+    return widths * heights
 
-        final_bin_mask = det_bin_mask + gt_bin_mask
 
-        inter_map = np.where(final_bin_mask == 2, 1, 0)
-        inter = np.round(np.sum(inter_map), 2)
+def overlap_table(gts, dets, backend=None):
+    """
+    Args:
+        gts: list of (gt_x, gt_y)
+        dets: list of (det_x, det_y)
 
-        det = np.round(np.sum(det_bin_mask), 2)
-        return inter / float(det + 1.0)
-        #return np.round(inter / float(det + 1.0), 2)
-    else:
-        return 0
\ No newline at end of file
+    Returns:
+        len(gts) x len(dets) tables of intersection area, iou and iod. Pairs
+        whose bounding boxes do not overlap are not clipped.
+    """
+    backend = _resolve(backend)
+    inter_table = np.zeros((len(gts), len(dets)))
+    iou_table = np.zeros((len(gts), len(dets)))
+    iod_table = np.zeros((len(gts), len(dets)))
+    candidates = np.argwhere(_bbox_overlap_table(gts, dets) > _min_overlap(backend))
+    if backend == 'exact':
+        # every polygon is checked and oriented once, not once per pair
+        gt_polys = [_prepare(x, y) for x, y in gts]
+        det_polys = [_prepare(x, y) for x, y in dets]
+    for gt_id, det_id in candidates:
+        det_x, det_y = dets[det_id]
+        gt_x, gt_y = gts[gt_id]
+        if backend == 'exact':
+            inter, det_area, _, union = _exact_pair(det_polys[det_id], gt_polys[gt_id], det_x, det_y, gt_x, gt_y)
+        else:
+            inter, det_area, _, union = _raster_counts(det_x, det_y, gt_x, gt_y)
+        inter_table[gt_id, det_id] = inter
+        iou_table[gt_id, det_id], iod_table[gt_id, det_id] = _ratios(inter, det_area, union, backend)
+    return inter_table, iou_table, iod_table
@@ -1,7 +1,9 @@
 import torch
 import torch.nn as nn
 from torch.autograd import Variable
-import collections
+import numpy as np
+
+from utils.codepoint_table import CodepointTable, split_labels
 
 
 class strLabelConverterForAttention(object):
@@ -25,36 +27,54 @@ class strLabelConverterForAttention(object):
         for i, item in enumerate(self.alphabet):
             # NOTE: 0 is reserved for 'blank' required by wrap_ctc
             self.dict[item] = i
+        self.table = CodepointTable(self.dict, lower=True)
+        self.keys = np.empty(len(self.alphabet), dtype=object)
+        for item, i in self.dict.items():
+            self.keys[i] = item
 
     def scan(self, text):
-        # print(text)
-        text_tmp = text
-        text = []
-        for i in range(len(text_tmp)):
-            text_result = ''
-            for j in range(len(text_tmp[i])):
-                chara = text_tmp[i][j].lower() if self._ignore_case else text_tmp[i][j]
-                if chara not in self.alphabet:
-                    # 在这里处理
-                    if chara in self._out_of_list:
-                        continue
-                    else:
-                        self._out_of_list += chara
-                        file_out_of_list = open("out_of_list.txt", "a+")
-                        file_out_of_list.write(chara + "\n")
-                        file_out_of_list.close()
-                        print('" %s " is not in alphabet...' % chara)
-                        continue
-                else:
-                    text_result += chara
-            text.append(text_result)
-        text_result = tuple(text)
+        """Drop the characters that are not in the alphabet, the unseen ones are reported once per batch."""
+        texts = [t for t in text]
+        joined, length = split_labels(texts)
+        indices = self._scan_table().lookup(joined)
+        keep = indices >= 0
+
+        unseen = []
+        for pos in np.flatnonzero(~keep).tolist():
+            chara = joined[pos].lower() if self._ignore_case else joined[pos]
+            if chara not in self._out_of_list and chara not in unseen:
+                unseen.append(chara)
+        if unseen:
+            self._out_of_list += ''.join(unseen)
+            # 在这里处理
+            with open("out_of_list.txt", "a+") as file_out_of_list:
+                file_out_of_list.write(''.join(chara + "\n" for chara in unseen))
+            for chara in unseen:
+                print('" %s " is not in alphabet...' % chara)
+
+        starts = np.zeros(len(length) + 1, dtype=np.int64)
+        np.cumsum(length, out=starts[1:])
+        kept = np.zeros(keep.size + 1, dtype=np.int64)
+        np.cumsum(keep, out=kept[1:])
+        kept_text = ''.join(self.keys[indices[keep]].tolist())
+        text_result = tuple(kept_text[begin:end] for begin, end in zip(kept[starts[:-1]].tolist(),
+                                                                      kept[starts[1:]].tolist()))
         self._scanned_list = True
         return text_result
 
+    def _scan_table(self):
+        if self._ignore_case:
+            return self.table
+        if getattr(self, '_case_table', None) is None:
+            self._case_table = CodepointTable(self.dict)
+        return self._case_table
+
     def encode(self, text, scanned=True):
         """Support batch or single str.
 
+        Every character is looked up as `char.lower()` in a codepoint table, the
+        characters that are not in the alphabet are encoded as '0'.
+
         Args:
             text (str or list of str): texts to convert.
 
@@ -66,43 +86,13 @@ class strLabelConverterForAttention(object):
         if not self._scanned_list:
             text = self.scan(text)
 
-        if isinstance(text, str):
-            # *************************************
-
-            text0 = []
-            for char in text:
-                if char == '\'':
-                    pass
-                try:
-                    # print(type(char))
-                    # if char !=
-                    # print(char)
-                    text0.append(self.dict[char.lower()])
-                # 把所有找不到的字符都当成'0'
-                except KeyError:
-                    text0.append(self.dict['0'.lower()])
-            text = text0
-
-            '''
-            for char in text:
-                try:
-                    print(char)
-                    text = [
-                        self.dict[char.lower() if self._ignore_case else char]
-                    ]
-                except KeyError:
-                    print('KeyError')
-            '''
-            # text=list(text)
-            # for ti in range(0,len(text)):
-            # if text[ti] =
-
-            length = [len(text)]
-        elif isinstance(text, collections.Iterable):
-            length = [len(s) for s in text]
-            text = ''.join(text)
-            text, _ = self.encode(text)
-        return (torch.LongTensor(text), torch.LongTensor(length))
+        joined, length = split_labels(text)
+        indices = self.table.lookup(joined)
+        missing = indices < 0
+        if missing.any():
+            # 把所有找不到的字符都当成'0'
+            indices[missing] = self.dict['0']
+        return (torch.from_numpy(indices), torch.LongTensor(length))
 
     def decode(self, t, length):
         """Decode encoded texts back into strs.
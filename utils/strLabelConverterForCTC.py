@@ -1,6 +1,5 @@
 import torch
 import torch.nn as nn
-import collections
 import random
 import numpy as np
 import cv2
@@ -9,37 +8,85 @@ from faker import Faker
 
 import datetime
 
+from utils.codepoint_table import CodepointTable, split_labels
+
+
+def _to_numpy(x):
+    if isinstance(x, torch.Tensor):
+        x = x.cpu().numpy()
+    return np.asarray(x, dtype=np.int64)
+
 
 class strLabelConverterForCTC(object):
 
     def __init__(self, alphabet):
         self.alphabet = alphabet + ' '  # for `-1` index
+        self.char_table = np.array(list(self.alphabet))
 
         self.dict = {}
         for i, char in enumerate(alphabet):
             # NOTE: 0 is reserved for 'blank' required by wrap_ctc
             self.dict[char] = i + 1
+        self.table = CodepointTable(self.dict)
 
     def encode(self, text, depth=0):
-        """Support batch or single str."""
-        if isinstance(text, str):
-            # text = text.lower()
-            for char in text:
-                # Fix the bug
-                if self.alphabet.find(char) == -1:
-                    print(char)
-            text = [self.dict[char] for char in text]
-            length = [len(text)]
-        elif isinstance(text, collections.Iterable):
-            length = [len(s) for s in text]
-            text = ''.join(text)
-            text, _ = self.encode(text)
+        """Support batch or single str, the whole batch is encoded with one table lookup."""
+        joined, length = split_labels(text)
+        indices = self.table.lookup(joined)
+        missing = indices < 0
+        if missing.any():
+            chars = sorted(set(np.array(list(joined))[missing].tolist()))
+            print('characters not in alphabet: %s' % ' '.join(chars))
+            raise KeyError(chars[0])
 
         if depth:
-            return text, len(text)
-        return (torch.IntTensor(text), torch.IntTensor(length))
+            return indices.tolist(), len(indices)
+        return (torch.from_numpy(indices.astype(np.int32)), torch.IntTensor(length))
 
     def decode(self, t, length, raw=False):
+        """Decode the flattened batch-major indices t, length holds the number of steps of every sample.
+
+        Repeats are collapsed and blanks removed for the whole batch with array ops,
+        a single sample returns a str and a batch returns a list of str.
+        """
+        lengths = _to_numpy(length).reshape(-1)
+        t = _to_numpy(t).reshape(-1)
+        if lengths.size == 1:
+            t = t[:int(lengths[0])]
+        texts = self._decode_flat(t, lengths, raw)
+        if lengths.size == 1:
+            return texts[0]
+        return texts
+
+    def decode_batch(self, t, raw=False):
+        """Decode the [T, B] argmax indices of a CTC output, e.g. preds.max(2)[1]."""
+        t = _to_numpy(t)
+        steps, batch = t.shape
+        return self._decode_flat(t.T.reshape(-1), np.full(batch, steps, dtype=np.int64), raw)
+
+    def _decode_flat(self, t, lengths, raw):
+        starts = np.zeros(lengths.size + 1, dtype=np.int64)
+        np.cumsum(lengths, out=starts[1:])
+        t = t[:starts[-1]]
+        # index 0 is the blank, -1 maps it to the trailing ' ' of the alphabet
+        symbols = self.char_table[t - 1]
+        if raw:
+            keep = np.ones(t.size, dtype=bool)
+        else:
+            keep = (t != 0) & (symbols != ' ')
+            repeat = np.zeros(t.size, dtype=bool)
+            repeat[1:] = t[1:] == t[:-1]
+            # the first step of a sample never repeats the last step of the previous one
+            repeat[starts[:-1][lengths > 0]] = False
+            keep &= ~repeat
+        # strings are built once for the whole batch and sliced per sample
+        kept = np.zeros(t.size + 1, dtype=np.int64)
+        np.cumsum(keep, out=kept[1:])
+        joined = ''.join(symbols[keep].tolist())
+        return [joined[begin:end] for begin, end in zip(kept[starts[:-1]].tolist(), kept[starts[1:]].tolist())]
+
+    def decode_loop(self, t, length, raw=False):
+        """Per-step python decoding, the reference for decode."""
         if length.numel() == 1:
             length = length[0]
             t = t[:length]
@@ -56,7 +103,7 @@ class strLabelConverterForCTC(object):
             index = 0
             for i in range(length.numel()):
                 l = length[i]
-                texts.append(self.decode(
+                texts.append(self.decode_loop(
                     t[index:index + l], torch.IntTensor([l]), raw=raw))
                 index += l
-            return texts
\ No newline at end of file
+            return texts